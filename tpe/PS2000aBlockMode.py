@@ -7,6 +7,10 @@
 # PS2000A BLOCK MODE to retrieve data from four channels with a trigger.
 
 from ctypes import c_int16, c_int32, c_float, byref, POINTER
+from numpy import zeros, int16, percentile
+from threading import Event
+from collections import deque
+from time import sleep, perf_counter
 from picosdk.ps2000a import ps2000a as ps, \
      PS2000A_TRIGGER_CONDITIONS, \
      PS2000A_TRIGGER_CHANNEL_PROPERTIES, \
@@ -61,8 +65,42 @@ segment = 0
 
 ratio_mode_none = ps.PS2000A_RATIO_MODE['PS2000A_RATIO_MODE_NONE']
 
-buffer_max = {}
-buffer_min = {}
+# Preallocated pool of int16 buffers: (pool size, channels, samples). The driver
+# writes straight into one slot while the previous slots can still be held by
+# the consumers. Slots are handed out as numpy views, thus no copies are made.
+buffer_pool = None
+buffer_pool_size = 3
+# Slot receiving the next capture and the slot currently registered to driver.
+buffer_index = 0
+registered_index = -1
+
+# How to wait for the triggered block after arming the scope:
+# callback = driver calls block_ready and the waiting thread sleeps on an event,
+# poll = ps2000aIsReady with an exponential back-off sleep,
+# spin = ps2000aIsReady in a tight loop (uses a full cpu core).
+WAIT_MODES = ("callback", "poll", "spin")
+wait_mode = "callback"
+# First poll interval in seconds. Interval is doubled up to the sleep_time of start_capture.
+poll_interval_min = 0.00001
+
+block_ready_event = Event()
+block_ready_time = 0.
+block_ready_status = 0
+# Reference to the ctypes callback must be kept alive as long as the driver may call it.
+block_ready_callback = None
+
+# Wake-up latencies of the latest captures in seconds. In callback mode this is the time
+# from the driver callback to the waiting thread. In poll modes it is the upper bound,
+# i.e. the time since the previous not ready check.
+wakeup_latencies = deque(maxlen = 1000)
+
+# Longest wait for a triggered capture in seconds without the margin: the auto trigger
+# time, zero without a trigger and None if the trigger waits forever (auto trigger 0).
+trigger_timeout = 0.
+# Margin for the arming and the capture itself.
+ready_timeout_margin = 1.
+# Set by cancel_wait to release a wait without a timeout, when the acquisition stops.
+wait_cancelled = False
 
 """
 # Start picoscope.
@@ -126,7 +164,11 @@ def set_channels(voltage_range = ('10V', '10V', '10V', '10V'),
             analogue_offset
         )
 
-def set_buffers(trigger_settings, timebase_settings, advanced_trigger_settings):
+def set_buffers(trigger_settings, timebase_settings, advanced_trigger_settings, pool_size = 3):
+    global buffer_pool_size, wait_cancelled
+
+    buffer_pool_size = max(1, pool_size)
+    wait_cancelled = False
 
     if trigger_settings['enabled'] == 1:
         set_trigger(**trigger_settings)
@@ -138,6 +180,7 @@ def set_buffers(trigger_settings, timebase_settings, advanced_trigger_settings):
 
 def set_trigger(enabled = 1, channel = 0, threshold = 1024, direction = 2, delay = 0, auto_trigger = 1000, alternate_channel = False):
     global chandle
+    set_trigger_timeout(enabled, auto_trigger)
     # Channel source, ps2000a_CHANNEL_A = 0
     # Threshold ADC counts
     # Direction = PS2000A_RISING = 2
@@ -145,6 +188,7 @@ def set_trigger(enabled = 1, channel = 0, threshold = 1024, direction = 2, delay
 
 def set_advanced_trigger(enabled = 1, channels = ('A', 'B'), upper_threshold = 20, upper_hysteresis = 2.5, auto_trigger_ms = 1000):
     global chandle
+    set_trigger_timeout(enabled, auto_trigger_ms)
 
     """
     ("channelA", c_int32),
@@ -293,12 +337,7 @@ def _get_trigger_direction_from_name(direction_name):
     return ps.PS2000A_THRESHOLD_DIRECTION[def_name]
 
 def set_timebase(timebase_n = 8, pre_trigger_samples = 2500, post_trigger_samples = 2500):
-    global chandle, channels, segment, buffer_max, buffer_min, timebase, totalSamples, cTotalSamples, totalSamples, timeIntervalns, oversample, preTriggerSamples, postTriggerSamples
-
-    for channel in channels:
-        #buffer_max[channel] = zeros(shape=totalSamples, dtype=int16)
-        buffer_max[channel] = (c_int16 * totalSamples)()
-        buffer_min[channel] = (c_int16 * totalSamples)()
+    global chandle, segment, timebase, totalSamples, cTotalSamples, timeIntervalns, oversample, preTriggerSamples, postTriggerSamples
 
     timebase = timebase_n
     preTriggerSamples = pre_trigger_samples
@@ -309,6 +348,9 @@ def set_timebase(timebase_n = 8, pre_trigger_samples = 2500, post_trigger_sample
     cTotalSamples = c_int32(totalSamples)
     returnedMaxSamples = c_int32()
 
+    # Buffers must be allocated after the total sample size is known.
+    allocate_buffers()
+
     return ps.ps2000aGetTimebase2(
         chandle,
         timebase,
@@ -319,18 +361,45 @@ def set_timebase(timebase_n = 8, pre_trigger_samples = 2500, post_trigger_sample
         segment
     )
 
+# Allocate all buffer slots once per setup. Min buffers are not needed,
+# because downsampling is not used, so only max buffers are registered.
+def allocate_buffers():
+    global channels, totalSamples, buffer_pool, buffer_pool_size, buffer_index, registered_index
+
+    buffer_pool = zeros(shape=(buffer_pool_size, len(channels), totalSamples), dtype=int16)
+    # First init_capture call rotates to the slot zero.
+    buffer_index = -1
+    registered_index = -1
+
+# Register buffer slot memory to the driver for data collection.
+def register_buffers(index):
+    global chandle, channels, segment, totalSamples, ratio_mode_none, buffer_pool, registered_index
+
+    for i, channel in enumerate(channels):
+        ps.ps2000aSetDataBuffer(
+            chandle,
+            ps.PS2000A_CHANNEL[channel],
+            buffer_pool[index][i].ctypes.data_as(POINTER(c_int16)),
+            totalSamples,
+            segment,
+            ratio_mode_none
+        )
+    registered_index = index
+
 def init_capture():
-    global channels, buffer_max, buffer_min
+    global buffer_pool_size, buffer_index, registered_index
 
-    for channel in channels:
-        #buffer_max[channel] = zeros(shape=totalSamples, dtype=int16)
-        buffer_max[channel] = (c_int16 * totalSamples)()
-        buffer_min[channel] = (c_int16 * totalSamples)()
+    # Rotate to the next slot. The previous slot stays untouched until the pool
+    # wraps around, so a consumer may keep its views while the next capture fills.
+    # With a single slot the registration is done only once.
+    buffer_index = (buffer_index + 1) % buffer_pool_size
+    if buffer_index != registered_index:
+        register_buffers(buffer_index)
 
 def run_block(time_indisposed_ms = None, lp_ready = None, p_parameter = None):
     global chandle, segment, preTriggerSamples, postTriggerSamples, timebase, oversample
 
-    ps.ps2000aRunBlock(
+    return ps.ps2000aRunBlock(
         chandle,
         preTriggerSamples,
         postTriggerSamples,
@@ -342,51 +411,148 @@ def run_block(time_indisposed_ms = None, lp_ready = None, p_parameter = None):
         p_parameter
     )
 
-def start_capture(sleep_time = 0.01):
-    global chandle, segment, totalSamples, cTotalSamples, overflow, ratio_mode_none, buffer_max, buffer_min
-
-    run_block()
+# Called by the driver from its own thread when the block is ready.
+def block_ready(handle, status, p_parameter):
+    global block_ready_time, block_ready_status, block_ready_event
+    block_ready_time = perf_counter()
+    block_ready_status = status
+    block_ready_event.set()
+
+def set_trigger_timeout(enabled, auto_trigger_ms):
+    global trigger_timeout
+    if enabled != 1:
+        trigger_timeout = 0.
+    else:
+        trigger_timeout = auto_trigger_ms / 1000 if auto_trigger_ms > 0 else None
+
+# Release the capture wait of the acquisition thread, so that it can be stopped
+# while the scope is waiting for a trigger.
+def cancel_wait():
+    global wait_cancelled, block_ready_event
+    wait_cancelled = True
+    block_ready_event.set()
+
+# Stop the armed scope and raise, if the block did not become ready.
+def check_wait(started, timeout):
+    global chandle, wait_cancelled
+    if wait_cancelled:
+        ps.ps2000aStop(chandle)
+        raise Exception("PicoScope capture was cancelled.")
+    if timeout is not None and perf_counter() - started > timeout:
+        ps.ps2000aStop(chandle)
+        raise Exception("PicoScope capture was not ready in %.1f seconds." % timeout)
+
+def set_wait_mode(mode = "callback"):
+    global wait_mode, block_ready_callback, wakeup_latencies, WAIT_MODES
+
+    if mode not in WAIT_MODES:
+        print("Unknown capture wait mode: %s. Using poll instead." % mode)
+        mode = "poll"
+
+    if mode == "callback" and block_ready_callback is None:
+        if hasattr(ps, "BlockReadyType"):
+            block_ready_callback = ps.BlockReadyType(block_ready)
+        else:
+            print("PicoSDK does not provide block ready callback type. Using poll instead.")
+            mode = "poll"
+
+    wait_mode = mode
+    wakeup_latencies.clear()
+
+# Arm the scope with the given run block function and wait until the block is ready.
+# Same waiting is used by the rapid mode with its own run block function, which fills
+# the given count of captures. Failed arming, driver errors and a block that is not
+# ready within the trigger timeout raise instead of blocking the caller forever.
+def run_block_and_wait(run_block_function, sleep_time = 0.01, captures = 1):
+    global chandle, wait_mode, poll_interval_min, block_ready_event, block_ready_callback, wakeup_latencies, \
+           trigger_timeout, ready_timeout_margin
+
+    timeout = None if trigger_timeout is None else captures * trigger_timeout + ready_timeout_margin
+    started = perf_counter()
+
+    if wait_mode == "callback":
+        block_ready_event.clear()
+        status = run_block_function(lp_ready = block_ready_callback)
+        if status != 0:
+            raise Exception("PicoScope run block failed with status %s." % status)
+        # Wait in short steps, so that the cancel and the timeout are noticed.
+        while not block_ready_event.wait(sleep_time):
+            check_wait(started, timeout)
+        check_wait(started, None)
+        if block_ready_status != 0:
+            raise Exception("PicoScope block ready failed with status %s." % block_ready_status)
+        wakeup_latencies.append(perf_counter() - block_ready_time)
+        return
+
+    status = run_block_function()
+    if status != 0:
+        raise Exception("PicoScope run block failed with status %s." % status)
 
     # Check for data collection.
     ready = c_int16(0)
     check = c_int16(0)
-    while ready.value == check.value:
-        ps.ps2000aIsReady(chandle, byref(ready))
+    interval = poll_interval_min
+    checked = perf_counter()
+    while True:
+        status = ps.ps2000aIsReady(chandle, byref(ready))
+        if status != 0:
+            raise Exception("PicoScope ready check failed with status %s." % status)
+        now = perf_counter()
+        if ready.value != check.value:
+            break
+        check_wait(started, timeout)
+        checked = now
+        if wait_mode == "poll":
+            sleep(interval)
+            interval = min(interval * 2, sleep_time)
+    wakeup_latencies.append(now - checked)
+
+# Wake-up latency distribution in milliseconds.
+def get_wakeup_latency_stats():
+    global wakeup_latencies
+    if len(wakeup_latencies) == 0:
+        return {"count": 0, "mean": 0., "p50": 0., "p90": 0., "p99": 0., "max": 0.}
+    # Latencies are appended by the acquisition thread, so a copy is taken first.
+    latencies = [latency * 1000 for latency in tuple(wakeup_latencies)]
+    p50, p90, p99 = percentile(latencies, (50, 90, 99))
+    return {
+        "count": len(latencies),
+        "mean": sum(latencies) / len(latencies),
+        "p50": p50,
+        "p90": p90,
+        "p99": p99,
+        "max": max(latencies)
+    }
 
-    # Set data buffer locations for data collection.
-    for channel in channels:
-        ps.ps2000aSetDataBuffers(
-            chandle,
-            ps.PS2000A_CHANNEL[channel],
-            byref(buffer_max[channel]),
-            byref(buffer_min[channel]),
-            totalSamples,
-            segment,
-            ratio_mode_none
-        )
+def start_capture(sleep_time = 0.01):
+    global chandle, segment, cTotalSamples, overflow, ratio_mode_none
+
+    run_block_and_wait(run_block, sleep_time)
 
+    # Data buffer locations were registered in init_capture.
     start_index = 0
     downsample_ratio = 0
     # Note, this is a global variable.
     overflow = c_int16()
-    # Retried data from scope to buffers assigned above.
+    # Retrieve data from scope to the registered buffer slot.
     ps.ps2000aGetValues(chandle, start_index, byref(cTotalSamples), downsample_ratio, ratio_mode_none, segment, byref(overflow))
 
 def get_buffers():
-    global channels, buffer_max
-    for channel in channels:
-        # Return copy of the buffers.
-        yield buffer_max[channel][:]
+    global channels, buffer_pool, buffer_index
+    for i, channel in enumerate(channels):
+        # Return views of the current buffer slot. They are valid until the
+        # pool wraps around, thus the consumer must copy data it wants to keep longer.
+        yield buffer_pool[buffer_index][i]
 
 def get_buffers_adc2mv():
-    global chandle, maxADC, channels, buffer_max, channel_voltage_ranges, VOLTAGE_RANGES
+    global chandle, maxADC, channels, buffer_pool, buffer_index, channel_voltage_ranges, VOLTAGE_RANGES
 
     ps.ps2000aMaximumValue(chandle, byref(maxADC))
 
     # Convert ADC counts data to mV
     for i, channel in enumerate(channels):
         yield adc2mV(
-            buffer_max[channel],
+            buffer_pool[buffer_index][i],
             VOLTAGE_RANGES[channel_voltage_ranges[i]],
             maxADC
         )[:]
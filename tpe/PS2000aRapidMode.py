@@ -5,3 +5,232 @@
 # Copyright (C) 2021-2022 Marko Manninen
 #
 # PS2000A RAPID MODE to retrieve data from four channels with a trigger.
+#
+# Rapid block mode splits the device memory into segments and captures one
+# triggered waveform to each segment with a single ps2000aRunBlock call.
+# The driver re-arms the trigger in hardware between the segments, so the
+# dead time between captures is only a few microseconds instead of the full
+# run block, ready check, and data transfer round trip of the block mode.
+# All segments are then retrieved with one ps2000aGetValuesBulk call.
+
+from ctypes import c_int16, c_int32, c_uint32, c_float, byref, POINTER
+from numpy import zeros, int16
+from time import time as tm
+from picosdk.ps2000a import ps2000a as ps
+from picosdk.functions import adc2mV
+
+# Opening the device, channel setup and trigger setup are identical to the
+# block mode, so they are shared with it. Note that chandle is the same
+# c_int16 instance in both modules.
+from . import PS2000aBlockMode as block
+from . PS2000aBlockMode import chandle, channels, VOLTAGE_RANGES, \
+                               open_picoscope, set_channels, \
+                               set_trigger, set_advanced_trigger, \
+                               set_wait_mode, get_wakeup_latency_stats, cancel_wait, \
+                               stop_picoscope
+
+# Set number of pre and post trigger samples to be collected
+preTriggerSamples = 0
+postTriggerSamples = 0
+totalSamples = 0
+cTotalSamples = None
+
+timebase = 0
+oversample = c_int16(0)
+
+maxADC = c_int16()
+
+# Number of memory segments and the number of captures per run block.
+segments = 0
+# Max samples per segment reported by the driver.
+maxSegmentSamples = c_int32()
+
+ratio_mode_none = ps.PS2000A_RATIO_MODE['PS2000A_RATIO_MODE_NONE']
+
+# Pool of buffers for the runs: (pool size, segments, channels, samples). One slot holds
+# all captures of a single run, so a consumer may keep a slot while the next run fills.
+buffer_pool = None
+buffer_pool_size = 3
+buffer_index = 0
+# Overflow flags for each segment.
+overflow = None
+
+# Elapsed time of the latest run from arming to the end of the bulk transfer.
+# Used to report captures per second.
+run_time = 0.
+
+"""
+# Start picoscope.
+open_picoscope()
+
+set_channels()
+set_buffers(
+    # Trigger settings.
+    {...},
+    # Timebase settings. These are used to calculate the buffer size.
+    {
+        'timebase_n': 8,
+        'pre_trigger_samples': 2500,
+        'post_trigger_samples': 2500
+    },
+    # Advanced trigger settings.
+    {...},
+    # Number of segments i.e. captures in one run.
+    64
+)
+
+# Repeat these functions in a loop for DAQ (data acquisition).
+start_capture()
+get_buffers() # -> (segments, 4, samples) int16 array
+init_capture()
+
+stop_picoscope()
+"""
+
+def set_buffers(trigger_settings, timebase_settings, advanced_trigger_settings, n_segments = 64, pool_size = 3):
+    global buffer_pool_size
+
+    buffer_pool_size = max(1, pool_size)
+    block.wait_cancelled = False
+
+    if trigger_settings['enabled'] == 1:
+        set_trigger(**trigger_settings)
+    elif advanced_trigger_settings['enabled'] == 1:
+        set_advanced_trigger(**advanced_trigger_settings)
+    ret = set_segments(n_segments)
+    if ret == 0:
+        ret = set_timebase(**timebase_settings)
+    # Buffers are allocated only when the segments and the timebase were set.
+    if ret == 0:
+        init_capture()
+    return ret == 0
+
+# Divide device memory to the given number of segments and tell the driver
+# to capture the same amount of waveforms in each run.
+def set_segments(n_segments = 64):
+    global chandle, segments, maxSegmentSamples
+
+    segments = n_segments
+
+    ret = ps.ps2000aMemorySegments(chandle, segments, byref(maxSegmentSamples))
+    if ret == 0:
+        ret = ps.ps2000aSetNoOfCaptures(chandle, segments)
+    return ret
+
+def set_timebase(timebase_n = 8, pre_trigger_samples = 2500, post_trigger_samples = 2500):
+    global chandle, timebase, totalSamples, cTotalSamples, preTriggerSamples, postTriggerSamples, maxSegmentSamples
+
+    timebase = timebase_n
+    preTriggerSamples = pre_trigger_samples
+    postTriggerSamples = post_trigger_samples
+    totalSamples = preTriggerSamples + postTriggerSamples
+
+    if totalSamples > maxSegmentSamples.value:
+        print("Too many samples (%s) for %s segments. Max samples per segment is %s." % (totalSamples, segments, maxSegmentSamples.value))
+        return -1
+
+    cTotalSamples = c_uint32(totalSamples)
+    returnedMaxSamples = c_int32()
+    timeIntervalns = c_float()
+
+    ret = ps.ps2000aGetTimebase2(
+        chandle,
+        timebase,
+        totalSamples,
+        byref(timeIntervalns),
+        oversample,
+        byref(returnedMaxSamples),
+        0
+    )
+
+    if ret == 0:
+        allocate_buffers()
+
+    return ret
+
+# Allocate one contiguous int16 array for all slots and segments once per setup.
+def allocate_buffers():
+    global channels, segments, totalSamples, buffer_pool, buffer_pool_size, buffer_index, overflow
+
+    buffer_pool = zeros(shape=(buffer_pool_size, segments, len(channels), totalSamples), dtype=int16)
+    overflow = (c_int16 * segments)()
+    # First init_capture call rotates to the slot zero.
+    buffer_index = -1
+
+# Register a view of the slot for every segment and channel. The driver keeps
+# the pointers between the runs, so this is needed only when the slot changes.
+def register_buffers(index):
+    global chandle, channels, segments, totalSamples, buffer_pool, ratio_mode_none
+
+    for segment in range(segments):
+        for i, channel in enumerate(channels):
+            ps.ps2000aSetDataBuffer(
+                chandle,
+                ps.PS2000A_CHANNEL[channel],
+                buffer_pool[index][segment][i].ctypes.data_as(POINTER(c_int16)),
+                totalSamples,
+                segment,
+                ratio_mode_none
+            )
+
+def init_capture():
+    global buffer_pool_size, buffer_index
+
+    # Rotate to the next slot. With a single slot the registration is done only once.
+    previous_index = buffer_index
+    buffer_index = (buffer_index + 1) % buffer_pool_size
+    if buffer_index != previous_index:
+        register_buffers(buffer_index)
+
+def run_block(time_indisposed_ms = None, lp_ready = None, p_parameter = None):
+    global chandle, preTriggerSamples, postTriggerSamples, timebase, oversample
+
+    return ps.ps2000aRunBlock(
+        chandle,
+        preTriggerSamples,
+        postTriggerSamples,
+        timebase,
+        oversample,
+        time_indisposed_ms,
+        0,
+        lp_ready,
+        p_parameter
+    )
+
+def start_capture(sleep_time = 0.01):
+    global chandle, segments, cTotalSamples, overflow, ratio_mode_none, run_time
+
+    start_time = tm()
+
+    # Device is ready when all segments are filled.
+    block.run_block_and_wait(run_block, sleep_time, segments)
+
+    # Retrieve all segments from the scope to the bulk buffer in one transfer.
+    samples = c_uint32(cTotalSamples.value)
+    downsample_ratio = 0
+    ps.ps2000aGetValuesBulk(chandle, byref(samples), 0, segments - 1, downsample_ratio, ratio_mode_none, byref(overflow))
+
+    run_time = tm() - start_time
+
+# Return all captures of the latest run as (segments, channels, samples) array.
+def get_buffers():
+    global buffer_pool, buffer_index
+    return buffer_pool[buffer_index]
+
+def get_buffers_adc2mv():
+    global chandle, maxADC, channels, buffer_pool, buffer_index
+
+    ps.ps2000aMaximumValue(chandle, byref(maxADC))
+
+    # Convert ADC counts data to mV, one capture at a time.
+    for capture in buffer_pool[buffer_index]:
+        yield [
+            adc2mV(capture[i], VOLTAGE_RANGES[block.channel_voltage_ranges[i]], maxADC)
+            for i, channel in enumerate(channels)
+        ]
+
+# Captures per second of the latest run. Time includes arming, waiting for
+# all triggers and the bulk transfer.
+def get_capture_rate():
+    global segments, run_time
+    return (segments / run_time) if run_time > 0 else 0
@@ -4,13 +4,14 @@
 # Copyright (C) 2018 Pico Technology Ltd. See LICENSE file for terms.
 # Copyright (C) 2021-2022 Marko Manninen
 #
-# PS2000A STREAM MODE to retrieve data from four channels with a trigger.
+# PS2000A STREAM MODE to retrieve data continuously from four channels.
 
 from ctypes import c_int16, c_int32, byref, POINTER
 from picosdk.ps2000a import ps2000a as ps
 from picosdk.functions import adc2mV
 from numpy import zeros, int16
 from time import sleep
+from threading import Thread, Condition
 
 # Create chandle
 chandle = c_int16()
@@ -58,47 +59,104 @@ def set_channels(voltage_range = ("10V", "10V", "10V", "10V"),
             analogue_offset
         )
 
-# Size of capture
+# Streaming runs continuously. The driver callback copies every new block of samples
+# to a preallocated ring buffer and the consumer reads fixed size chunks from the ring.
+# Each chunk is preceded by a tail of the previous chunk, so pulses and coincidences
+# that straddle the chunk boundaries are detected exactly once. See the overlap notes
+# in get_max_heights_and_time_differences.
+
+# Size of the driver buffer and the chunk handed to the consumer.
 sizeOfOneBuffer = None
 totalSamples = None
-buffer_max = {}
-buffer_complete = {}
+# Samples carried over from the previous chunk to the beginning of the next.
+overlap = 0
+# Driver buffers: (channels, sizeOfOneBuffer).
+buffer_max = None
+# Ring buffer: (channels, ring_size).
+ring = None
+ring_size = 0
+# Absolute sample counters since start of the streaming.
+samples_written = 0
+samples_read = 0
+# Count of the ring overruns and the samples lost because of them.
+overruns = 0
+lost_samples = 0
+ring_condition = Condition()
+
+# Pool of chunk buffers: (pool size, channels, overlap + totalSamples), handed out as views.
+chunk_pool = None
+chunk_pool_size = 3
+chunk_index = 0
+# Absolute sample index of the first sample of the current chunk including the tail.
+chunk_start = 0
+
+# Sample interval returned by the driver and time unit factors in seconds.
+sample_interval = c_int32()
+sample_units = "NS"
+UNIT_SECONDS = {"FS": 1e-15, "PS": 1e-12, "NS": 1e-9, "US": 1e-6, "MS": 1e-3, "S": 1}
 
 ratio_mode_none = ps.PS2000A_RATIO_MODE["PS2000A_RATIO_MODE_NONE"]
 
+# Poller thread collecting the latest values from the driver.
+poller = None
+polling = False
+wasCalledBack = False
+autoStopOuter = False
+
 # Set buffers
-def set_buffers(buffer_size = 500, buffer_count = 2, interval = 128, units = "NS", memory_segment = 0):
-    global chandle, sizeOfOneBuffer, totalSamples, buffer_max, buffer_complete, ratio_mode_none
+def set_buffers(buffer_size = 500, buffer_count = 2, interval = 128, units = "NS", memory_segment = 0, overlap_samples = 128, ring_chunks = 16, pool_size = 3, sleep_time = 0.001):
+    global chandle, channels, sizeOfOneBuffer, totalSamples, overlap, buffer_max, ring, ring_size, \
+           chunk_pool, chunk_pool_size, chunk_index, ratio_mode_none
+
+    # Streaming must be stopped before the buffers are replaced.
+    stop_streaming()
+
     sizeOfOneBuffer = buffer_size
     totalSamples = buffer_size * buffer_count
-    for channel in channels:
-        # Reserve buffers ready for assigning pointers for data collection
-        # (c_int16 * sizeOfOneBuffer)()
-        buffer_max[channel] = zeros(shape=sizeOfOneBuffer, dtype=int16)
-        # We need a big buffer, not registered with the driver, to keep our complete capture in
-        # (c_int16 * totalSamples)()
-        buffer_complete[channel] = zeros(shape=totalSamples, dtype=int16)
+    overlap = overlap_samples
+    # Ring must hold at least the tail, a chunk and a driver buffer.
+    ring_size = max(ring_chunks * totalSamples, overlap + totalSamples + sizeOfOneBuffer)
+
+    # Reserve buffers ready for assigning pointers for data collection.
+    buffer_max = zeros(shape=(len(channels), sizeOfOneBuffer), dtype=int16)
+    ring = zeros(shape=(len(channels), ring_size), dtype=int16)
+    chunk_pool_size = max(1, pool_size)
+    chunk_pool = zeros(shape=(chunk_pool_size, len(channels), overlap + totalSamples), dtype=int16)
+    chunk_index = 0
+
+    for i, channel in enumerate(channels):
         ps.ps2000aSetDataBuffers(
             chandle,
             ps.PS2000A_CHANNEL[channel],
-            buffer_max[channel].ctypes.data_as(POINTER(c_int16)),
+            buffer_max[i].ctypes.data_as(POINTER(c_int16)),
             None,
             sizeOfOneBuffer,
             memory_segment,
             ratio_mode_none
         )
 
-    return start_streaming(interval, units) == 0
+    init_capture()
+
+    return start_streaming(interval, units, sleep_time = sleep_time) == 0
 
 # Start streaming
 # units: = NS (nanoseconds), US (microseconds)
 # maxPreTriggerSamples: We are not triggering in streaming mode
-def start_streaming(interval = 128, units = "NS", maxPreTriggerSamples = 0, autoStopOn = 0, downsampleRatio = 1):
-    global chandle, totalSamples, sizeOfOneBuffer, ratio_mode_none
+def start_streaming(interval = 128, units = "NS", maxPreTriggerSamples = 0, autoStopOn = 0, downsampleRatio = 1, sleep_time = 0.001):
+    global chandle, totalSamples, sizeOfOneBuffer, ratio_mode_none, sample_interval, sample_units, \
+           samples_written, samples_read, overruns, lost_samples, chunk_start, overlap, poller, polling
+    # First chunk has no real tail, so reading starts after the zero filled tail.
+    samples_read = overlap
+    samples_written = overlap
+    chunk_start = 0
+    overruns = 0
+    lost_samples = 0
+    sample_interval = c_int32(interval)
+    sample_units = units
     # Begin streaming mode
-    return ps.ps2000aRunStreaming(
+    ret = ps.ps2000aRunStreaming(
         chandle,
-        byref(c_int32(interval)),
+        byref(sample_interval),
         ps.PS2000A_TIME_UNITS["PS2000A_%s" % units],
         maxPreTriggerSamples,
         totalSamples,
@@ -107,68 +165,144 @@ def start_streaming(interval = 128, units = "NS", maxPreTriggerSamples = 0, auto
         ratio_mode_none,
         sizeOfOneBuffer
     )
+    if ret == 0:
+        polling = True
+        poller = Thread(target = streaming_loop, args = (sleep_time,), daemon = True)
+        poller.start()
+    return ret
 
-nextSample = 0
-wasCalledBack = False
-autoStopOuter = False
+def stop_streaming():
+    global chandle, poller, polling
+    if poller is not None:
+        polling = False
+        poller.join()
+        poller = None
+        ps.ps2000aStop(chandle)
 
-# Define streaming callback
+# Define streaming callback. Called by the driver in the poller thread.
 def streaming_callback(handle, noOfSamples, startIndex, overflow, triggerAt, triggered, autoStop, param):
-    global nextSample, autoStopOuter, wasCalledBack, buffer_max, buffer_complete, channels
+    global autoStopOuter, wasCalledBack, buffer_max, ring, ring_size, samples_written, ring_condition
     wasCalledBack = True
-    destEnd = nextSample + noOfSamples
-    sourceEnd = startIndex + noOfSamples
-    for channel in channels:
-        buffer_complete[channel][nextSample:destEnd] = buffer_max[channel][startIndex:sourceEnd]
-    nextSample += noOfSamples
+    with ring_condition:
+        position = samples_written % ring_size
+        first = min(noOfSamples, ring_size - position)
+        ring[:, position:position + first] = buffer_max[:, startIndex:startIndex + first]
+        if first < noOfSamples:
+            ring[:, :noOfSamples - first] = buffer_max[:, startIndex + first:startIndex + noOfSamples]
+        samples_written += noOfSamples
+        ring_condition.notify()
     if autoStop:
         autoStopOuter = True
 
 # Convert the python function into a C function pointer
 cFuncPtr = ps.StreamingReadyType(streaming_callback)
 
-def start_capture(sleep_time = 0.01):
-    streaming_loop(sleep_time)
-
-# Define streaming loop to get latest values to the buffer
-def streaming_loop(sleep_time = 0.01):
-    global nextSample, autoStopOuter, wasCalledBack, totalSamples, chandle, cFuncPtr
-    while nextSample < totalSamples and not autoStopOuter:
+# Define streaming loop to get latest values to the ring buffer.
+# Runs in the poller thread as long as streaming is on.
+def streaming_loop(sleep_time = 0.001):
+    global autoStopOuter, wasCalledBack, chandle, cFuncPtr, polling, ring_condition
+    while polling and not autoStopOuter:
         wasCalledBack = False
         ps.ps2000aGetStreamingLatestValues(chandle, cFuncPtr, None)
         if not wasCalledBack:
             # If we weren"t called back by the driver, this means no data is ready
             # Sleep for a short while before trying again
             sleep(sleep_time)
+    polling = False
+    with ring_condition:
+        ring_condition.notify()
+
+# Copy samples from the absolute start index of the ring to the destination.
+def copy_from_ring(destination, start):
+    global ring, ring_size
+    length = destination.shape[1]
+    position = start % ring_size
+    first = min(length, ring_size - position)
+    destination[:, :first] = ring[:, position:position + first]
+    if first < length:
+        destination[:, first:] = ring[:, :length - first]
+
+# Wait for the next chunk and copy it with the tail of the previous chunk to the chunk pool.
+def start_capture(sleep_time = 0.01):
+    global totalSamples, overlap, ring_size, samples_written, samples_read, overruns, lost_samples, \
+           ring_condition, chunk_pool, chunk_index, chunk_start, polling
+    with ring_condition:
+        while samples_written - samples_read < totalSamples and polling:
+            ring_condition.wait(sleep_time)
+        if samples_written - samples_read < totalSamples:
+            raise Exception("PicoScope streaming has stopped.")
+        # If the consumer has fallen behind, the oldest samples have been overwritten.
+        # Skip to the oldest chunk that is still intact together with its tail.
+        oldest = samples_written - ring_size + overlap
+        if samples_read < oldest:
+            overruns += 1
+            lost_samples += oldest - samples_read
+            samples_read = oldest
+        chunk_start = samples_read - overlap
+        copy_from_ring(chunk_pool[chunk_index], chunk_start)
+        samples_read += totalSamples
+
+# Streaming stops when the driver auto stops or stop_streaming is called.
+def is_streaming():
+    global polling
+    return polling
 
 def get_buffers():
-    global channels, buffer_complete
-    for channel in channels:
-        yield buffer_complete[channel][:]
+    global chunk_pool, chunk_index
+    # Return views of the current chunk. The first overlap samples are the tail of the previous chunk.
+    for buffer in chunk_pool[chunk_index]:
+        yield buffer
 
 def get_buffers_adc2mv():
-    global chandle, maxADC, channels, buffer_complete, channel_voltage_ranges
+    global chandle, maxADC, chunk_pool, chunk_index, channel_voltage_ranges
 
     ps.ps2000aMaximumValue(chandle, byref(maxADC))
 
     # Convert ADC counts data to mV
-    for i, channel in enumerate(channels):
-        # Return copy of the converted buffers.
-        yield adc2mV(buffer_complete[channel], ps.PS2000A_RANGE["PS2000A_%s" % channel_voltage_ranges[i]], maxADC)[:]
+    for i, buffer in enumerate(chunk_pool[chunk_index]):
+        yield adc2mV(buffer, ps.PS2000A_RANGE["PS2000A_%s" % channel_voltage_ranges[i]], maxADC)
     #time = np.linspace(0, (cTotalSamples.value) * timeIntervalns.value, cTotalSamples.value)
 
-# Define streaming init to be used after getting new values to the buffers
+# Rotate to the next chunk buffer. The previous chunk stays intact until the pool wraps around.
 def init_capture():
-    global nextSample, autoStopOuter, wasCalledBack, totalSamples, buffer_complete, channels
-    for channel in channels:
-        # (c_int16 * totalSamples)()
-        buffer_complete[channel] = zeros(shape=totalSamples, dtype=int16)
-    nextSample = 0
+    global chunk_pool_size, chunk_index, autoStopOuter, wasCalledBack
+    chunk_index = (chunk_index + 1) % chunk_pool_size
     autoStopOuter = False
     wasCalledBack = False
 
+# Number of samples carried over from the previous chunk.
+def get_overlap():
+    global overlap
+    return overlap
+
+# Absolute sample index of the first sample in the current chunk buffer.
+def get_chunk_start():
+    global chunk_start
+    return chunk_start
+
+# Sample interval and length of one chunk in seconds.
+def get_sample_interval():
+    global sample_interval, sample_units, UNIT_SECONDS
+    return sample_interval.value * UNIT_SECONDS[sample_units]
+
+def get_chunk_length():
+    global totalSamples
+    return totalSamples * get_sample_interval()
+
+# Ring buffer statistics. Live time is the share of streamed samples that reached the consumer.
+def get_stream_stats():
+    global samples_read, lost_samples, overruns, overlap
+    streamed = max(samples_read - overlap, 0)
+    return {
+        "samples": streamed,
+        "lost_samples": lost_samples,
+        "overruns": overruns,
+        "live_time": (1 - lost_samples / streamed) if streamed > 0 else 1.
+    }
+
 # Define stop picoscope procedure
 def stop_picoscope():
     global chandle
+    stop_streaming()
     ps.ps2000aStop(chandle)
     ps.ps2000aCloseUnit(chandle)
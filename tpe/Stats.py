@@ -10,6 +10,7 @@ from scipy.signal import find_peaks
 from collections import Counter
 
 from tpe.functions import get_measurement_resolution, get_measurement_configurations
+from tpe.storage import EventFile, statistics_columns
 from datetime import datetime, timedelta, date
 from pandas import Series
 from math import floor
@@ -39,6 +40,8 @@ class Stats():
 
         self.experiment_directory = "../experiments/*"
         self.statistics_filename = "statistics.csv"
+        # Binary event files, events.tpe and its segments events.1.tpe, events.2.tpe...
+        self.event_filename_pattern = "events*.tpe"
         self.get_experiment_stat_files()
         self.detector_labels = detector_labels
 
@@ -77,11 +80,15 @@ class Stats():
         self.calibration_lines_a = []
         self.calibration_lines_b = []
 
+    # Statistics file of the experiments, or the event files, if the experiment has
+    # no statistics.csv file.
     def get_experiment_stat_files(self, directory = None):
         for experiment_directory in glob.glob(self.experiment_directory if directory is None else directory):
             statistics_file = os.path.join(experiment_directory, self.statistics_filename)
             if os.path.isfile(statistics_file):
                 yield statistics_file
+            else:
+                yield from sorted(glob.glob(os.path.join(experiment_directory, self.event_filename_pattern)))
 
     def print_experiment_stat_files(self, directory = None):
         return list(map(print, self.get_experiment_stat_files(directory)))
@@ -91,7 +98,13 @@ class Stats():
 
     def read_stats_dataframe(self, directory, filter = False):
         self.csv_filename = "%s\statistics.csv" % directory
-        df = pd.read_csv(self.csv_filename, sep = ";", names = self.headers)
+        event_filename = os.path.join(directory, "events.tpe")
+        if not os.path.isfile(self.csv_filename) and os.path.isfile(event_filename):
+            # Same columns are derived from the binary event file.
+            self.csv_filename = event_filename
+            df = pd.DataFrame(dict(zip(self.headers, statistics_columns(EventFile(event_filename)).values())))
+        else:
+            df = pd.read_csv(self.csv_filename, sep = ";", names = self.headers)
 
         if filter:
             df = df[(df["APulseHeight"] > 0) | (df["BPulseHeight"] > 0)]
@@ -774,6 +787,12 @@ class Stats():
         return 'https://github.com/markomanninen/tandempiercerexperiment/raw/main%s' % self.csv_filename.replace("\\\\", "/").replace("..", "")
 
     def print_stats_link(self):
+        if self.csv_filename.endswith(".tpe"):
+            # Event file is read together with its pulse file.
+            return md("<br/><center><h3>Download event files: <a target='_blank' href='%s'>%s</a>, <a target='_blank' href='%s'>%s</a></h3></center>" % (
+                self.stats_github_link(), os.path.basename(self.csv_filename),
+                self.stats_github_link() + ".pulses", os.path.basename(self.csv_filename) + ".pulses"
+            ))
         return md("<br/><center><h3>Download csv file: <a target='_blank' href='%s'>statistics.csv</a></h3></center>" % self.stats_github_link())
 
     def start_time_str(self):
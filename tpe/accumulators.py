@@ -0,0 +1,284 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+#
+# Incremental histograms for the live spectra of the GUI.
+#
+# Histogram keeps the counts of the latest capacity values, like np.histogram over
+# a deque with maxlen, but adding values only updates the bins of the new values and
+# of the values that age out. Raw values are kept in a ring, so the histogram can be
+# rebinned, when the bin count or the range changes.
+
+import numpy as np
+
+class HistogramAccumulator():
+
+    # Bin count is the count of the edges given to np.linspace, same as in the
+    # np.histogram calls of the GUI, thus there are bin_count - 1 bins.
+    def __init__(self, low, high, bin_count, capacity):
+        self.capacity = capacity
+        self.values = np.zeros(capacity, dtype=np.float64)
+        # Bin of every stored value or -1, if the value is outside the range.
+        self.bins = np.full(capacity, -1, dtype=np.int64)
+        self.start = 0
+        self.size = 0
+        self.set_bins(low, high, bin_count)
+
+    def __len__(self):
+        return self.size
+
+    def set_bins(self, low, high, bin_count):
+        self.low = low
+        self.high = high
+        self.bin_count = bin_count
+        self.edges = np.linspace(low, high, bin_count)
+        self.counts = np.zeros(max(bin_count - 1, 0), dtype=np.int64)
+        self._rebin()
+
+    # Rebin the stored values, if the bins have changed. This is the only operation
+    # that goes through all stored values.
+    def rebin(self, low = None, high = None, bin_count = None):
+        low = self.low if low is None else low
+        high = self.high if high is None else high
+        bin_count = self.bin_count if bin_count is None else bin_count
+        if low != self.low or high != self.high or bin_count != self.bin_count:
+            self.set_bins(low, high, bin_count)
+            return True
+        return False
+
+    def _rebin(self):
+        slots = self._slots(self.start, self.size)
+        self.bins[slots] = self._bin(self.values[slots])
+        self._count(self.bins[slots], 1)
+
+    # Bins of the values like np.histogram: bins are half open, except the last one,
+    # which includes the high edge. Values outside the range get -1.
+    def _bin(self, values):
+        n = len(self.counts)
+        if n == 0:
+            return np.full(len(values), -1, dtype=np.int64)
+        bins = np.searchsorted(self.edges, values, "right") - 1
+        bins[values == self.edges[-1]] = n - 1
+        bins[(bins < 0) | (bins >= n) | np.isnan(values)] = -1
+        return bins
+
+    def _count(self, bins, sign):
+        bins = bins[bins >= 0]
+        if len(bins) > 0:
+            np.add.at(self.counts, bins, sign)
+
+    def _slots(self, start, count):
+        return (start + np.arange(count)) % self.capacity
+
+    # Add the values and remove the oldest values, which do not fit to the capacity.
+    def extend(self, values):
+        values = np.asarray(values, dtype=np.float64).ravel()
+        if len(values) == 0 or self.capacity == 0:
+            return
+        if len(values) > self.capacity:
+            values = values[-self.capacity:]
+        aged = self.size + len(values) - self.capacity
+        if aged > 0:
+            old = self._slots(self.start, aged)
+            self._count(self.bins[old], -1)
+            self.start = (self.start + aged) % self.capacity
+            self.size -= aged
+        slots = self._slots(self.start + self.size, len(values))
+        bins = self._bin(values)
+        self.values[slots] = values
+        self.bins[slots] = bins
+        self.size += len(values)
+        self._count(bins, 1)
+
+    def clear(self):
+        self.start = 0
+        self.size = 0
+        self.counts[:] = 0
+
+    # Counts and edges in the same order as np.histogram returns them.
+    def histogram(self):
+        return self.counts.copy(), self.edges
+
+# Ring of the latest capacity scatter points with a code per point, for example the
+# trigger channel, and a density grid of the same points. Points are stored in place,
+# so the ring does not grow, and the grid is updated for the new and the overwritten
+# points only. Order of the points is not kept, because it does not matter in a plot.
+class ScatterAccumulator():
+
+    def __init__(self, capacity, x_range, y_range, bins = 128):
+        self.capacity = capacity
+        self.positions = np.zeros((capacity, 2), dtype=np.float64)
+        self.codes = np.zeros(capacity, dtype=np.int8)
+        # Density cell of every point or -1, if the point is outside the ranges.
+        self.cells = np.full(capacity, -1, dtype=np.int64)
+        self.next = 0
+        self.size = 0
+        self.set_ranges(x_range, y_range, bins)
+
+    def __len__(self):
+        return self.size
+
+    def set_ranges(self, x_range, y_range, bins = None):
+        self.x_range = x_range
+        self.y_range = y_range
+        self.bins = self.bins if bins is None else bins
+        self.density = np.zeros((self.bins, self.bins), dtype=np.int64)
+        self.cells[:self.size] = self._cell(self.positions[:self.size])
+        self._count(self.cells[:self.size], 1)
+
+    def _cell(self, positions):
+        x = np.floor((positions[:, 0] - self.x_range[0]) / (self.x_range[1] - self.x_range[0]) * self.bins)
+        y = np.floor((positions[:, 1] - self.y_range[0]) / (self.y_range[1] - self.y_range[0]) * self.bins)
+        inside = (x >= 0) & (x < self.bins) & (y >= 0) & (y < self.bins)
+        return np.where(inside, x * self.bins + y, -1).astype(np.int64)
+
+    def _count(self, cells, sign):
+        cells = cells[cells >= 0]
+        if len(cells) > 0:
+            np.add.at(self.density.reshape(-1), cells, sign)
+
+    # Add points, which overwrite the oldest points when the ring is full. Coordinates
+    # are paired like zip does, so the extra values of the longer list are ignored.
+    def extend(self, x, y, code = 0):
+        x, y = np.ravel(x), np.ravel(y)
+        count = min(len(x), len(y))
+        positions = np.column_stack((x[:count], y[:count])).astype(np.float64)
+        if len(positions) == 0 or self.capacity == 0:
+            return
+        if len(positions) > self.capacity:
+            positions = positions[-self.capacity:]
+        slots = (self.next + np.arange(len(positions))) % self.capacity
+        old = slots[slots < self.size]
+        self._count(self.cells[old], -1)
+        cells = self._cell(positions)
+        self.positions[slots] = positions
+        self.codes[slots] = code
+        self.cells[slots] = cells
+        self._count(cells, 1)
+        self.next = (self.next + len(positions)) % self.capacity
+        self.size = min(self.size + len(positions), self.capacity)
+
+    # Views to the stored positions and codes.
+    def points(self):
+        return self.positions[:self.size], self.codes[:self.size]
+
+    def clear(self):
+        self.next = 0
+        self.size = 0
+        self.density[:] = 0
+
+# Ring of the latest capacity waveforms of a channel as int16 samples. The waveform
+# with the largest sample is kept, when the ring is full, and the oldest of the other
+# waveforms is overwritten instead. Slots are reused, so the same plot item can be
+# kept for every slot.
+class WaveformRing():
+
+    def __init__(self, capacity, samples = 0):
+        self.capacity = capacity
+        self.waveforms = np.zeros((capacity, samples), dtype=np.int16)
+        self.lengths = np.zeros(capacity, dtype=np.int64)
+        self.coincidences = np.zeros(capacity, dtype=bool)
+        self.clear()
+
+    def __len__(self):
+        return len(self.order)
+
+    def clear(self):
+        # Slots from the oldest to the newest waveform.
+        self.order = []
+        self.max_slot = None
+        self.max_value = 0
+
+    # Store the waveform and return its slot.
+    def append(self, data, coincidence = False):
+        data = np.asarray(data)
+        n = len(data)
+        if n > self.waveforms.shape[1]:
+            waveforms = np.zeros((self.capacity, n), dtype=np.int16)
+            waveforms[:, :self.waveforms.shape[1]] = self.waveforms
+            self.waveforms = waveforms
+        if len(self.order) < self.capacity:
+            slot = len(self.order)
+        else:
+            slot = self.order[1] if self.order[0] == self.max_slot and self.capacity > 1 else self.order[0]
+            self.order.remove(slot)
+            if slot == self.max_slot:
+                self.max_slot = None
+                self.max_value = 0
+        self.waveforms[slot, :n] = data
+        self.lengths[slot] = n
+        self.coincidences[slot] = coincidence
+        self.order.append(slot)
+        m = int(data.max()) if n > 0 else 0
+        if m > self.max_value:
+            self.max_slot = slot
+            self.max_value = m
+        return slot
+
+    # View to the samples of the slot.
+    def waveform(self, slot):
+        return self.waveforms[slot, :self.lengths[slot]]
+
+# Minimum and maximum of the data in points bins as a line, which goes down and up
+# in every bin. Drawn with one bin per pixel it looks the same as the full data.
+def min_max_envelope(data, points):
+    data = np.asarray(data)
+    n = len(data)
+    if n <= 2 * points:
+        return np.arange(n), data
+    starts = np.linspace(0, n, points + 1).astype(np.int64)[:-1]
+    x = np.repeat(starts, 2)
+    y = np.empty(2 * points, dtype=data.dtype)
+    y[0::2] = np.minimum.reduceat(data, starts)
+    y[1::2] = np.maximum.reduceat(data, starts)
+    return x, y
+
+# Rate history of the channels at several resolutions. Every level is a ring of the
+# latest capacity points, where a point is the mean of seconds long period. The first
+# level is fed with the values, and the other levels with the means of ratio points of
+# the level below, so the memory stays the same, however long the run is.
+class RateHistory():
+
+    # Levels are (seconds, capacity) pairs from the finest to the coarsest. Seconds of
+    # every level must be a multiple of the seconds of the level below.
+    def __init__(self, channels = 3, levels = ((1, 120), (60, 1440), (3600, 720))):
+        self.channels = channels
+        self.seconds = [seconds for seconds, capacity in levels]
+        self.values = [np.zeros((capacity, channels), dtype=np.float64) for seconds, capacity in levels]
+        # Points of the level below in one point of the level.
+        self.ratios = [1] + [self.seconds[i] // self.seconds[i - 1] for i in range(1, len(levels))]
+        self.clear()
+
+    def __len__(self):
+        return len(self.values)
+
+    def clear(self):
+        # Points added to the levels since the start.
+        self.counts = [0] * len(self.values)
+        # Sums and counts of the unfinished points of the levels.
+        self.sums = np.zeros((len(self.values), self.channels), dtype=np.float64)
+        self.partial = [0] * len(self.values)
+
+    def _add(self, level, values):
+        ring = self.values[level]
+        ring[self.counts[level] % len(ring)] = values
+        self.counts[level] += 1
+        if level + 1 < len(self.values):
+            self.sums[level + 1] += values
+            self.partial[level + 1] += 1
+            if self.partial[level + 1] == self.ratios[level + 1]:
+                means = self.sums[level + 1] / self.ratios[level + 1]
+                self.sums[level + 1] = 0
+                self.partial[level + 1] = 0
+                self._add(level + 1, means)
+
+    # Add the values of the channels for one period of the first level.
+    def append(self, values):
+        self._add(0, np.asarray(values, dtype=np.float64))
+
+    # Point indexes since the start and the values of the level from the oldest to the newest.
+    def series(self, level = 0):
+        ring = self.values[level]
+        count = self.counts[level]
+        size = min(count, len(ring))
+        indexes = np.arange(count - size, count)
+        return indexes, ring[indexes % len(ring)]
@@ -6,8 +6,8 @@ from ast import literal_eval
 
 class PicoScopeModes(argparse.Action):
     def __call__(self, parser, namespace, value, option_string=None):
-        if value != "block" and value != "stream" and value != None:
-            raise ValueError("PicoScope mode must be empty or one of these: block, stream.")
+        if value != "block" and value != "stream" and value != "rapid" and value != None:
+            raise ValueError("PicoScope mode must be empty or one of these: block, rapid, stream.")
         setattr(namespace, self.dest, value)
 
 def boolean_type(value):
@@ -92,12 +92,30 @@ def load_args(default_config):
         default = default_config["store_waveforms_channels"],
         help = "When store_waveforms from buffers to csv files is used, this option defines what channels are stored to the file. Options are some of these characters: ABCD. Default is: %s" % default_config["store_waveforms_channels"])
 
+    parser.add_argument("--waveform_format",
+        dest = "waveform_format",
+        default = default_config.get("waveform_format", "binary"),
+        choices = ["binary", "csv"],
+        help = "Format of the stored waveforms. Options are: binary=waveforms.tpw compressed archive, csv=waveform.csv text file. Default is: %s" % default_config.get("waveform_format", "binary"))
+
+    parser.add_argument("--waveform_compression",
+        dest = "waveform_compression",
+        default = default_config.get("waveform_compression", "zlib"),
+        choices = ["none", "zlib", "lz4"],
+        help = "Compression of the waveform archive. lz4 requires the lz4 package and falls back to zlib without it. Default is: %s" % default_config.get("waveform_compression", "zlib"))
+
     parser.add_argument("--store_statistics",
         dest = "store_statistics",
         default = default_config["store_statistics"],
         type = int_type,
         help = "Store measurement statistics to csv files. 0=disabled, 1=only when coincident pulses are found, 2=if either or both channel A and B has a pulse, 3=everything. Default is: %s" % default_config["store_statistics"])
 
+    parser.add_argument("--statistics_format",
+        dest = "statistics_format",
+        default = default_config.get("statistics_format", "binary"),
+        choices = ["binary", "csv", "both"],
+        help = "Format of the stored statistics. Options are: binary=events.tpe event file with all pulses of the captures, csv=statistics.csv file with the first pulses, both. Default is: %s" % default_config.get("statistics_format", "binary"))
+
     parser.add_argument("--execution_time",
         dest = "execution_time",
         default = default_config["execution_time"],
@@ -119,11 +137,48 @@ def load_args(default_config):
         default = default_config["histogram_queue_size"],
         help = "Queue size for spectrum histogram. Default is: %a" % default_config["histogram_queue_size"])
 
+    parser.add_argument("--scatter_queue_size",
+        dest = "scatter_queue_size",
+        default = default_config.get("scatter_queue_size", 10000),
+        type = int_type,
+        help = "Queue size for the coincidence scatter plot. Default is: %s" % default_config.get("scatter_queue_size", 10000))
+
+    parser.add_argument("--scatter_density_threshold",
+        dest = "scatter_density_threshold",
+        default = default_config.get("scatter_density_threshold", 0),
+        type = int_type,
+        help = "Point count after which the coincidence scatter plot is drawn as a density image. 0 always draws the points. Default is: %s" % default_config.get("scatter_density_threshold", 0))
+
+    parser.add_argument("--target_fps",
+        dest = "target_fps",
+        default = default_config.get("target_fps", 30),
+        type = int_type,
+        help = "Target frame rate of the GUI plots. Default is: %s" % default_config.get("target_fps", 30))
+
     parser.add_argument("--picoscope_mode",
         dest = "picoscope_mode",
         default = "block",
         action = PicoScopeModes,
-        help = "PicoScope mode for importing the data acquisition module. Options are: block, stream, None. Default is: block.")
+        help = "PicoScope mode for importing the data acquisition module. Options are: block, rapid, stream, None. Default is: block.")
+
+    parser.add_argument("--rapid_mode_segments",
+        dest = "rapid_mode_segments",
+        default = default_config.get("rapid_mode_segments", 64),
+        type = int_type,
+        help = "Number of memory segments, i.e. triggered captures per run, in the PicoScope rapid mode. Default is: %s" % default_config.get("rapid_mode_segments", 64))
+
+    parser.add_argument("--capture_wait_mode",
+        dest = "capture_wait_mode",
+        default = default_config.get("capture_wait_mode", "callback"),
+        type = str,
+        choices = ["callback", "poll", "spin"],
+        help = "How to wait for the trigger in the PicoScope block and rapid modes. Options are: callback, poll, spin. Default is: %s" % default_config.get("capture_wait_mode", "callback"))
+
+    parser.add_argument("--detection_processes",
+        dest = "detection_processes",
+        default = default_config.get("detection_processes", 0),
+        type = int_type,
+        help = "Number of processes for the pulse detection in the PicoScope modes. 0 = detect pulses in the data acquisition process. Default is: %s" % default_config.get("detection_processes", 0))
 
     parser.add_argument("--simple_trigger",
         dest = "simple_trigger",
@@ -178,6 +233,64 @@ def load_args(default_config):
         choices = [0, 1],
         help = "Pulse detection mode. 0 = detect pulse from the (SCA) square wave pulse. 1 = detect pulse from the raw pulse. Default is: %s" % default_config["pulse_detection_mode"])
 
+    parser.add_argument("--coincidence_window",
+        dest = "coincidence_window",
+        default = default_config.get("coincidence_window", 0),
+        type = int_type,
+        help = "Max distance of the coincident pulses in the unit of coincidence_window_unit. 0 = pair all pulses in the buffer. Default is: %s" % default_config.get("coincidence_window", 0))
+
+    parser.add_argument("--coincidence_window_unit",
+        dest = "coincidence_window_unit",
+        default = default_config.get("coincidence_window_unit", "samples"),
+        choices = ["samples", "ns"],
+        help = "Unit of the coincidence window. ns is converted to samples with the sample interval of the timebase. Default is: %s" % default_config.get("coincidence_window_unit", "samples"))
+
+    parser.add_argument("--coincidence_pairing",
+        dest = "coincidence_pairing",
+        default = default_config.get("coincidence_pairing", "all"),
+        type = str,
+        choices = ["all", "nearest"],
+        help = "Coincidence pairing. all = every pair inside the coincidence window, nearest = only mutually nearest pulses. Default is: %s" % default_config.get("coincidence_pairing", "all"))
+
+    parser.add_argument("--pulse_height_pre_samples",
+        dest = "pulse_height_pre_samples",
+        default = default_config.get("pulse_height_pre_samples", 100),
+        type = int_type,
+        help = "Samples of the raw channel before the SCA pulse edge, from which the pulse height is taken. Default is: %s" % default_config.get("pulse_height_pre_samples", 100))
+
+    parser.add_argument("--pulse_height_post_samples",
+        dest = "pulse_height_post_samples",
+        default = default_config.get("pulse_height_post_samples", 100),
+        type = int_type,
+        help = "Samples of the raw channel after the SCA pulse edge, from which the pulse height is taken. Default is: %s" % default_config.get("pulse_height_post_samples", 100))
+
+    parser.add_argument("--pulse_timing",
+        dest = "pulse_timing",
+        default = default_config.get("pulse_timing", "sample"),
+        type = str,
+        choices = ["sample", "edge", "cfd"],
+        help = "Timing of the pulses for the time differences. sample = edge or peak sample, edge = interpolated SCA edge, cfd = constant fraction of the raw pulse with sub-sample interpolation. Default is: %s" % default_config.get("pulse_timing", "sample"))
+
+    parser.add_argument("--cfd_fraction",
+        dest = "cfd_fraction",
+        default = default_config.get("cfd_fraction", 0.5),
+        type = float,
+        help = "Fraction of the pulse height for the constant fraction timing. Default is: %s" % default_config.get("cfd_fraction", 0.5))
+
+    parser.add_argument("--raw_filter",
+        dest = "raw_filter",
+        default = default_config.get("raw_filter", {}).get("enabled", 0),
+        type = int,
+        choices = [0, 1],
+        help = "Raw channel filter chain with the baseline tracking, trapezoidal shaping and pile-up flags. 0 = disabled, 1 = enabled. Default is: %s" % default_config.get("raw_filter", {}).get("enabled", 0))
+
+    parser.add_argument("--detection_backend",
+        dest = "detection_backend",
+        default = default_config.get("detection_backend", "auto"),
+        type = str,
+        choices = ["auto", "numpy", "numba"],
+        help = "Pulse detection backend. auto = numba compiled kernels if numba is installed, numpy = NumPy and SciPy, numba = compiled kernels. Default is: %s" % default_config.get("detection_backend", "auto"))
+
     parser.add_argument("--detector_geometry",
         dest = "detector_geometry",
         default = default_config["detector_geometry"],
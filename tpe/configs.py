@@ -82,12 +82,43 @@ sca_module_default_settings = {
     }
 }
 
-# Picoscope was tested with streaming mode first, but its resolution is not suitable for the project. Thus these settings are not used but legacy and testing purposes.
+# Picoscope was tested with streaming mode first, but its resolution is not suitable for the project. Streaming is continuous, so it gives full live time for the rate measurements.
 streaming_mode_settings = {
     "buffer_size": 250,
     "buffer_count": 2,
     "units": "NS",
-    "interval": 128
+    "interval": 128,
+    # Samples carried over from the end of the previous chunk to the beginning of the next one.
+    # Pulses straddling the chunk boundary are found once and this is also the coincidence window.
+    "overlap": 128,
+    # Ring buffer size in chunks. If processing falls behind more than this, samples are lost.
+    "ring_chunks": 16,
+    # Software trigger finds the SCA pulse edges from the streamed chunks and keeps only
+    # the raw pulse windows around them. With coincidence window 0 every SCA pulse triggers,
+    # otherwise only pulses with a pulse in the other SCA channel within the window (samples).
+    # Overlap is increased automatically to hold the event window and the coincidence window.
+    "software_trigger": {
+        "enabled": 1,
+        "threshold": 8192,
+        "pre_trigger_samples": 32,
+        "post_trigger_samples": 96,
+        "coincidence_window": 0
+    }
+}
+
+# Filter chain for the raw pulse channels. Baseline is tracked from the first baseline_samples
+# of the captures (pre-trigger region) with an exponential average of baseline_alpha. Heights
+# are taken from a trapezoidal shaper with the given rise and flat top, and decay of the raw
+# pulses in samples for the pole zero correction. Pulses closer than the trapezoid are piled up.
+raw_filter_settings = {
+    "enabled": 0,
+    "baseline_samples": 100,
+    "baseline_alpha": 0.1,
+    "rise_samples": 20,
+    "flat_samples": 10,
+    "decay_samples": 40,
+    # Threshold of the raw pulse triggers and of the quiet baseline region in ADC units.
+    "threshold": 256
 }
 
 def create_config():
@@ -120,6 +151,18 @@ def create_config():
     data["verbose"] = 0
     # Histogram queue size. After this value the first values will be dropped from the list to maintain a reasonable max size for the graphics data.
     data["histogram_queue_size"] = 30000
+    # Scatter queue size. Coincidence scatter plot keeps the latest points in a ring of this size.
+    data["scatter_queue_size"] = 10000
+    # Scatter plot is drawn as a density image, when it has more points than this. 0 to always draw the points.
+    data["scatter_density_threshold"] = 0
+    # Bin count of both axes of the scatter density image.
+    data["scatter_density_bins"] = 128
+    # Pulse rate time line levels as [seconds per point, points kept] pairs.
+    data["rate_history_levels"] = [[1, 120], [60, 1440], [3600, 720]]
+    # Target frame rate of the GUI plots.
+    data["target_fps"] = 30
+    # Interval in milliseconds for moving the published captures to the GUI histograms.
+    data["ingest_interval"] = 10
     # If pulse voltage range is 20, use 19660 for max adc value since 12V is the maximmum that Ortec SCA module will give.
 
     # (2^16) / 2. Min is -32768
@@ -153,6 +196,10 @@ def create_config():
 
     # Define channels that are used to store signals. Use with store_waveforms options.
     data["store_waveforms_channels"] = "ABCD"
+    # Format of the stored waveforms. binary = waveforms.tpw archive, csv = old waveform.csv file.
+    data["waveform_format"] = "binary"
+    # Compression of the waveform archive: none, zlib or lz4. lz4 needs the lz4 package, zlib is used without it.
+    data["waveform_compression"] = "zlib"
 
     # Channel colors. R=Red, B=Blue, G=Green
     data["channel_colors"] = "RBRB"
@@ -162,10 +209,39 @@ def create_config():
 
     # Store statistics.
     data["store_statistics"] = 0
+    # Format of the stored statistics. binary = events.tpe event file, csv = old statistics.csv file, both = both files.
+    data["statistics_format"] = "binary"
 
     # Pulse detection mode. 0 = detect pulse from the (SCA) square wave pulse. 1 = detect pulse from the raw pulse.
     data["pulse_detection_mode"] = 0
 
+    # Max distance of the coincident pulses in samples. 0 pairs every pulse of the channel A
+    # with every pulse of the channel B in the buffer. Pairing "all" takes every pair inside
+    # the window, "nearest" only the mutually nearest pulses.
+    data["coincidence_window"] = 0
+    # Unit of the coincidence window: samples or ns. Nanoseconds are converted to samples
+    # with the sample interval of the timebase.
+    data["coincidence_window_unit"] = "samples"
+    data["coincidence_pairing"] = "all"
+
+    # Window of the raw channel around the SCA pulse edge in samples, from which the height
+    # of the pulse is taken in the pulse detection mode 0. Every pulse gets its own height.
+    data["pulse_height_pre_samples"] = 100
+    data["pulse_height_post_samples"] = 100
+
+    # Timing of the pulses for the time differences. sample = index of the SCA edge or the
+    # raw pulse peak, edge = interpolated crossing of the SCA square pulse edge (mode 0),
+    # cfd = constant fraction crossing of the raw pulse, interpolated between the samples.
+    # Fraction of the pulse height for the cfd timing.
+    data["pulse_timing"] = "sample"
+    data["cfd_fraction"] = 0.5
+
+    data["raw_filter"] = raw_filter_settings
+
+    # Backend for the raw pulse detection. Options are: auto = compiled kernels if numba
+    # is installed, else numpy, numpy = NumPy and SciPy, numba = compiled kernels.
+    data["detection_backend"] = "auto"
+
     data["simple_trigger"] = simple_trigger
     data["simple_trigger_alternate"] = simple_trigger_alternate_channel
     data["simple_trigger_channel"] = simple_trigger_channel
@@ -178,6 +254,35 @@ def create_config():
 
     data["detector_geometry"] = "tandem"
 
+    # Number of memory segments in the rapid mode. Each segment holds one triggered capture
+    # and all of them are retrieved with one bulk transfer. Segment size is limited by the
+    # scope memory divided by the segment count.
+    data["rapid_mode_segments"] = 64
+
+    # How to wait for the trigger in block and rapid modes. Options are:
+    # callback = driver signals the ready block and the process sleeps meanwhile,
+    # poll = check ready state with increasing sleep intervals up to sleep_time,
+    # spin = check ready state without sleeping, which keeps one cpu core busy.
+    data["capture_wait_mode"] = "callback"
+
+    # Number of captures that can wait for the processing while the acquisition thread
+    # already captures the next one. Buffer pool of the PicoScope module is two larger.
+    data["acquisition_queue_size"] = 1
+
+    # Number of processes for the pulse detection. With 0 the detection is done in the
+    # data acquisition process. More processes help mostly in the raw pulse detection mode.
+    data["detection_processes"] = 0
+
+    # Shared memory ring sizes for passing captures to the GUI. Result ring holds the compact
+    # per capture results and waveform ring the signals. Waveforms longer than the given
+    # sample count are truncated. Overruns of both rings are shown in the status bar.
+    # Time differences and pulse heights of the results go to a value ring of the given
+    # size, results that do not fit in it are counted as result overruns.
+    data["result_ring_slots"] = 4096
+    data["result_ring_values"] = 262144
+    data["waveform_ring_slots"] = 32
+    data["waveform_ring_samples"] = 16384
+
     # Experiment step configurations.
 
     steps = {}
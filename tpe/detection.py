@@ -0,0 +1,198 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+#
+# Pulse detection stage that runs in a pool of processes.
+#
+# Captures are copied to slots in shared memory and only the slot index and
+# the detection settings are sent to the detector processes. Results come back
+# in the order the processes finish and are reordered by the capture sequence
+# number, so the caller sees them in the same order as the captures.
+
+import os
+import numpy as np
+from multiprocessing import Process, Queue, shared_memory, resource_tracker
+from queue import Empty
+from . sharedmemory import attach_shared_memory
+from . functions import get_max_heights_and_time_differences
+from . dsp import create_raw_filters
+from . import kernels
+
+# Detector process. Shared memory is attached once and reattached only if the
+# pool has grown the slots for longer captures.
+def detection_worker(tasks, results, pulse_detection_mode, coincidence_window, nearest, height_window, timing, cfd_fraction,
+                     raw_filter, backend):
+
+    kernels.set_backend(backend)
+    # Every detector tracks the baselines of the captures it gets.
+    filters = create_raw_filters(raw_filter)
+
+    shm = None
+    slots = None
+
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+        seq, name, shape, slot, length, low_limits, high_limits, overlap = task
+        try:
+            if shm is None or shm.name != name:
+                if shm is not None:
+                    slots = None
+                    shm.close()
+                shm = attach_shared_memory(name)
+                slots = np.ndarray(shape, dtype = np.int16, buffer = shm.buf)
+            result = get_max_heights_and_time_differences(
+                slots[slot][:, :length],
+                low_limits,
+                high_limits,
+                pulse_detection_mode,
+                overlap,
+                coincidence_window,
+                nearest,
+                height_window,
+                timing,
+                cfd_fraction,
+                filters
+            )
+        except Exception as e:
+            result = e
+        results.put((seq, result))
+
+    if shm is not None:
+        slots = None
+        shm.close()
+
+class DetectionPool():
+
+    def __init__(self, processes = 2, pulse_detection_mode = 0, coincidence_window = None, nearest = False, slots = None,
+                 height_window = (100, 100), timing = "sample", cfd_fraction = 0.5, raw_filter = None):
+        self.processes = processes
+        self.pulse_detection_mode = pulse_detection_mode
+        self.coincidence_window = coincidence_window
+        self.nearest = nearest
+        self.height_window = height_window
+        self.timing = timing
+        self.cfd_fraction = cfd_fraction
+        self.raw_filter = raw_filter
+        # Two slots per process keep every process busy while the results are handled.
+        self.slot_count = slots if slots else processes * 2
+        self.tasks = Queue()
+        self.results = Queue()
+        self.workers = []
+        self.shm = None
+        self.slots = None
+        self.free_slots = list(range(self.slot_count))
+        # Submitted captures by sequence number: (slot, length, tag).
+        self.in_flight = {}
+        # Finished results waiting for the earlier captures.
+        self.done = {}
+        self.next_seq = 0
+        self.next_result_seq = 0
+
+    def start(self):
+        # Detector processes must share the resource tracker of this process, which
+        # creates and unlinks the shared memory.
+        if os.name == "posix":
+            resource_tracker.ensure_running()
+        for i in range(self.processes):
+            worker = Process(
+                target = detection_worker,
+                name = "detection_worker_%s" % i,
+                args = (self.tasks, self.results, self.pulse_detection_mode, self.coincidence_window, self.nearest, self.height_window,
+                        self.timing, self.cfd_fraction, self.raw_filter, kernels.backend),
+                daemon = True
+            )
+            worker.start()
+            self.workers.append(worker)
+
+    def stop(self):
+        for worker in self.workers:
+            self.tasks.put(None)
+        for worker in self.workers:
+            worker.join(1)
+            if worker.is_alive():
+                worker.terminate()
+        self.workers = []
+        self._release_slots()
+
+    def _release_slots(self):
+        if self.shm is not None:
+            self.slots = None
+            self.shm.close()
+            self.shm.unlink()
+            self.shm = None
+
+    # Slots are allocated for the first capture and grown if a longer capture comes.
+    # Growing is done only when no captures are in flight.
+    def _allocate_slots(self, samples):
+        self._release_slots()
+        shape = (self.slot_count, 4, samples)
+        self.shm = shared_memory.SharedMemory(create = True, size = int(np.prod(shape)) * 2)
+        self.slots = np.ndarray(shape, dtype = np.int16, buffer = self.shm.buf)
+
+    # Copy the capture to a free slot and send it to the detectors. Returns False,
+    # if all slots are in use and the results must be handled first.
+    def submit(self, buffers, low_limits, high_limits, overlap = 0, tag = None):
+        length = len(buffers[0])
+        if self.slots is None or length > self.slots.shape[2]:
+            if len(self.in_flight) > 0:
+                return False
+            self._allocate_slots(length)
+        if len(self.free_slots) == 0:
+            return False
+        slot = self.free_slots.pop()
+        for i, buffer in enumerate(buffers[:4]):
+            self.slots[slot][i][:length] = buffer
+        seq = self.next_seq
+        self.next_seq += 1
+        self.in_flight[seq] = (slot, length, tag)
+        self.tasks.put((seq, self.shm.name, self.slots.shape, slot, length, list(low_limits), list(high_limits), overlap))
+        return True
+
+    def _receive(self, timeout):
+        try:
+            seq, result = self.results.get(timeout = timeout) if timeout > 0 else self.results.get_nowait()
+        except Empty:
+            return False
+        if isinstance(result, Exception):
+            raise result
+        self.done[seq] = result
+        while True:
+            try:
+                seq, result = self.results.get_nowait()
+            except Empty:
+                break
+            if isinstance(result, Exception):
+                raise result
+            self.done[seq] = result
+        return True
+
+    # Yield (buffers, tag, result) of the finished captures in the capture order.
+    # Buffers are views to the slot, which is released when the next item is asked,
+    # so they must not be kept. Waits up to timeout for the next result in order.
+    def collect(self, timeout = 0):
+        if self.next_result_seq not in self.done and len(self.in_flight) > 0:
+            self._receive(timeout)
+        while self.next_result_seq in self.done:
+            seq = self.next_result_seq
+            result = self.done.pop(seq)
+            slot, length, tag = self.in_flight.pop(seq)
+            self.next_result_seq += 1
+            try:
+                yield self.slots[slot][:, :length], tag, result
+            finally:
+                self.free_slots.append(slot)
+            if self.next_result_seq not in self.done:
+                self._receive(0)
+
+    # Submit the captures and yield the finished results in order. Waits for the
+    # results only if all slots are in use, thus the captures submitted on this
+    # call are usually yielded on the later calls.
+    def map(self, captures, low_limits, high_limits, overlap = 0, tag = None):
+        for buffers in captures:
+            while not self.submit(buffers, low_limits, high_limits, overlap, tag):
+                yield from self.collect(timeout = 0.1)
+        yield from self.collect()
+
+    def pending(self):
+        return len(self.in_flight)
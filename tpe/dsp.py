@@ -0,0 +1,138 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+#
+# Filter chain for the raw pulse channels.
+#
+# Baseline is estimated from the pre-trigger region of every capture and tracked
+# over the captures with an exponential average, instead of taking the mean of
+# the whole buffer, which includes the pulses. Pulse heights are taken from the
+# output of a recursive trapezoidal shaper, and pulses closer to each other than
+# the length of the trapezoid are flagged as pile-up, because their heights add up.
+#
+# Filter keeps its scratch buffers between the captures, thus processing a capture
+# does not allocate buffer sized arrays. Raw int16 data is read as is, it is not
+# copied nor modified. Shaped output is valid until the next capture is processed.
+
+import numpy as np
+from . functions import window_maxima
+
+class RawPulseFilter():
+
+    def __init__(self, samples = 0, baseline_samples = 100, baseline_alpha = 0.1,
+                 rise_samples = 20, flat_samples = 10, decay_samples = 40, threshold = 256):
+        self.baseline_samples = baseline_samples
+        self.baseline_alpha = baseline_alpha
+        self.rise_samples = rise_samples
+        self.flat_samples = flat_samples
+        self.threshold = threshold
+        # Pole zero correction of the shaper for the exponential decay of the pulses.
+        # Decay of zero means step like pulses, the limit of an infinite decay, where
+        # the first cumulative sum is already the trapezoid.
+        self.m = 1 / np.expm1(1 / decay_samples) if decay_samples > 0 else None
+        # Flat top of the trapezoid equals the pulse height after the normalization.
+        self.gain = rise_samples * (self.m + 1) if self.m is not None else rise_samples
+        # Pulses closer than this overlap in the shaped output.
+        self.length = 2 * rise_samples + flat_samples
+        self.baseline = None
+        self._allocate(samples)
+
+    def _allocate(self, samples):
+        self.samples = samples
+        self.corrected = np.zeros(samples, dtype=np.float64)
+        self.work = np.zeros(samples, dtype=np.float64)
+        self.shaped = np.zeros(samples, dtype=np.float64)
+        self.above = np.zeros(samples, dtype=bool)
+
+    # Track the baseline from the pre-trigger region. Regions with a pulse, which is
+    # seen as a peak to peak value over the threshold, do not update the baseline.
+    def update_baseline(self, data):
+        region = data[:self.baseline_samples] if self.baseline_samples > 0 else data
+        if len(region) == 0:
+            return self.baseline
+        if self.baseline is None:
+            self.baseline = float(region.mean())
+        elif int(region.max()) - int(region.min()) < self.threshold:
+            self.baseline += self.baseline_alpha * (float(region.mean()) - self.baseline)
+        return self.baseline
+
+    # Trapezoidal shaper of Jordanov and Knoll as cumulative sums over the capture:
+    # d[n] = x[n] - x[n-k] - x[n-l] + x[n-k-l], p[n] = p[n-1] + d[n],
+    # r[n] = p[n] + M d[n] and s[n] = s[n-1] + r[n], where k is the rise and l the
+    # rise plus the flat top of the trapezoid.
+    def shape(self, data):
+        data = np.asarray(data)
+        if len(data) != self.samples:
+            self._allocate(len(data))
+        self.update_baseline(data)
+        x = self.corrected
+        np.subtract(data, self.baseline, out=x)
+        k = self.rise_samples
+        l = self.rise_samples + self.flat_samples
+        d = self.work
+        d[:] = x
+        if k < len(x):
+            d[k:] -= x[:-k]
+        if l < len(x):
+            d[l:] -= x[:-l]
+        if k + l < len(x):
+            d[k + l:] += x[:-(k + l)]
+        np.cumsum(d, out=self.shaped)
+        if self.m is not None:
+            d *= self.m
+            d += self.shaped
+            np.cumsum(d, out=self.shaped)
+        self.shaped /= self.gain
+        return self.shaped
+
+    # Rising crossings of the baseline corrected signal over the threshold.
+    def triggers(self):
+        above = self.above
+        np.greater(self.corrected, self.threshold, out=above)
+        return (~above[:-1] & above[1:]).nonzero()[0] + 1
+
+    # Pulses that have another pulse closer than the trapezoid length on either side.
+    def pileup(self, edges):
+        edges = np.asarray(edges, dtype=np.int64)
+        flags = np.zeros(len(edges), dtype=bool)
+        if len(edges) > 1:
+            close = np.diff(edges) < self.length
+            flags[1:] |= close
+            flags[:-1] |= close
+        return flags
+
+    # Heights from the flat tops of the trapezoids following the triggers.
+    def heights(self, triggers):
+        triggers = np.asarray(triggers, dtype=np.int64)
+        end = np.minimum(triggers + self.length, len(self.shaped) - 1)
+        return window_maxima(self.shaped, np.minimum(triggers, end), end)
+
+    # Shape the capture and return the triggers, pulse heights and pile-up flags.
+    def process(self, data):
+        self.shape(data)
+        triggers = self.triggers()
+        return triggers, self.heights(triggers), self.pileup(triggers)
+
+# Filter from the raw_filter settings.
+def raw_pulse_filter(settings, samples = 0):
+    return RawPulseFilter(
+        samples,
+        settings.get("baseline_samples", 100),
+        settings.get("baseline_alpha", 0.1),
+        settings.get("rise_samples", 20),
+        settings.get("flat_samples", 10),
+        settings.get("decay_samples", 40),
+        settings.get("threshold", 256)
+    )
+
+# Filters of the raw channels C and D, or None if the filter is not enabled.
+def create_raw_filters(settings, samples = 0):
+    if not settings or settings.get("enabled", 0) == 0:
+        return None
+    return raw_pulse_filter(settings, samples), raw_pulse_filter(settings, samples)
+
+# Reprocess stored captures offline, for example the waveforms of a playback file.
+# Yields triggers, heights and pile-up flags of the raw channels for every capture.
+def reprocess_captures(captures, settings, channels = (2, 3)):
+    filters = [raw_pulse_filter(settings) for channel in channels]
+    for buffers in captures:
+        yield [f.process(buffers[channel]) for f, channel in zip(filters, channels)]
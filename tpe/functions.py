@@ -4,7 +4,10 @@
 import os
 import numpy as np
 from scipy.signal import find_peaks
+from . import kernels
 from collections import OrderedDict
+from bisect import bisect_left, bisect_right
+from math import ceil
 from IPython.display import display, Markdown as md
 from IPython.core.display import HTML
 from PIL import Image
@@ -113,9 +116,10 @@ step3_csv_file = "step3_results.csv"
 step4_json_file = "step4_results.json"
 step4_csv_file = "step4_results.csv"
 
-# Normalize signal to zero line.
+# Normalize signal to zero line. Buffers can be numpy views of the PicoScope
+# buffers, so asarray is used to avoid copying them. Subtraction returns a new array.
 def baseline_correct(data):
-    return (lambda x: x - x.mean())(np.array(data))
+    return (lambda x: x - x.mean())(np.asarray(data))
 
 # Remove noise from the signal.
 def filter_spectrum(data, counter_str, limit, self):
@@ -144,127 +148,615 @@ def raising_edges_for_square_pulses(data, low_limit = 4096):
     pos = data > low_limit
     return (pos[:-1] & ~pos[1:]).nonzero()[0]
 
-def get_max_heights_and_time_differences(buffers, spectrum_low_limits, spectrum_high_limits, pulse_detection_mode):
-
-    time_differences = []
+# Max of the data in the windows from start to end, both included. Starts and ends are
+# interleaved for reduceat, which gives the max from each start to the next end on the
+# even positions. The end sample is added separately, because the last end may be the
+# last sample of the data, and reduceat indexes must be inside the data.
+def window_maxima(data, start, end):
+    if len(start) == 0:
+        return np.zeros(0, dtype=np.int64)
+    indexes = np.empty(2 * len(start), dtype=np.intp)
+    indexes[0::2] = start
+    indexes[1::2] = end
+    return np.maximum(np.maximum.reduceat(data, indexes)[0::2], data[end]).astype(np.int64)
+
+# Height of every SCA pulse from the raw channel. Height is the max of the raw channel in
+# the window from pre_samples before to post_samples after the edge, so only the windows
+# are scanned instead of the whole buffer. Heights are int64, because int16 values would
+# overflow in the later voltage range multiplications.
+def pulse_heights_around_edges(data, edges, pre_samples = 100, post_samples = 100):
+    data = np.asarray(data)
+    edges = np.asarray(edges, dtype=np.int64)
+    start = np.maximum(edges - pre_samples, 0)
+    end = np.minimum(edges + post_samples, len(data) - 1)
+    return window_maxima(data, start, end)
+
+# PULSE TIMING
+#
+# Pulse times with sub-sample precision. Interpolated crossings of the SCA square pulse
+# edges, or constant fraction crossings of the raw pulses, where the leading edge of the
+# pulse crosses the given fraction of the pulse height. Constant fraction timing does not
+# depend on the pulse height, so it is used for the coincidence timing of the raw pulses.
+# Data may be a flat array of several captures, and low and high are then the first and
+# the last index of the capture of every pulse, so the windows stay inside the capture.
+
+# Indexes of the windows from pre_samples before to post_samples after the given indexes
+# as (indexes, samples) array. Windows are clipped to the low and high indexes.
+def index_windows(indexes, pre_samples, post_samples, low, high):
+    windows = indexes[:, None] + np.arange(-pre_samples, post_samples + 1)
+    return np.clip(windows, np.asarray(low)[..., None], np.asarray(high)[..., None])
+
+# Interpolated times, where the square pulse falls through the low limit. The sample at
+# the edge is above and the next one at or below the limit, see raising_edges_for_square_pulses.
+def square_edge_times(data, edges, low_limit = 4096):
+    edges = np.asarray(edges, dtype=np.int64)
+    above = data[edges].astype(np.float64)
+    below = data[edges + 1].astype(np.float64)
+    return edges + (above - low_limit) / (above - below)
+
+# Indexes of the raw pulse peaks in the windows around the SCA edges. Peak is the first
+# max of the window, same sample that pulse_heights_around_edges takes the height from.
+def pulse_peaks_around_edges(data, edges, pre_samples = 100, post_samples = 100, low = 0, high = None):
+    edges = np.asarray(edges, dtype=np.int64)
+    windows = index_windows(edges, pre_samples, post_samples, low, len(data) - 1 if high is None else high)
+    return windows[np.arange(len(edges)), np.argmax(data[windows], axis=1)]
+
+# Constant fraction times of the raw pulses with the given peaks. Leading edge is searched
+# from pre_samples before the peak, and the crossing is interpolated linearly between the
+# last sample below the fraction of the height and the next sample. If no sample of the
+# window is below the fraction, or the window has no samples before the peak, the peak
+# index is used as is.
+def cfd_times(data, peaks, baseline, fraction = 0.5, pre_samples = 100, low = 0):
+    peaks = np.asarray(peaks, dtype=np.int64)
+    if len(peaks) == 0 or pre_samples < 1:
+        return peaks.astype(np.float64)
+    windows = index_windows(peaks, pre_samples, 0, low, peaks)
+    values = data[windows] - np.asarray(baseline, dtype=np.float64)[..., None]
+    level = fraction * values[:, -1]
+    below = values[:, :-1] < level[:, None]
+    rows = np.arange(len(peaks))
+    # Last sample below the level before the peak.
+    last = pre_samples - 1 - np.argmax(below[:, ::-1], axis=1)
+    found = below[rows, last]
+    x0 = values[rows, last]
+    x1 = values[rows, last + 1]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        times = windows[rows, last] + (level - x0) / (x1 - x0)
+    return np.where(found, times, peaks.astype(np.float64))
+
+# Constant fraction times of the raw pulses near the given positions, which are SCA
+# edges or the raw pulses of the raw pulse detector. Peak of the pulse is searched from
+# the height window around the position first.
+def raw_pulse_cfd_times(raw, positions, height_window = (100, 100), cfd_fraction = 0.5):
+    raw = np.asarray(raw)
+    peaks = pulse_peaks_around_edges(raw, positions, *height_window)
+    return cfd_times(raw, peaks, raw.mean(), cfd_fraction, height_window[0])
+
+# Times of the SCA pulses at the edges as samples, interpolated edge crossings or
+# constant fraction times of the raw pulses around the edges.
+def sca_pulse_times(square, raw, edges, timing = "sample", threshold = 8192, height_window = (100, 100), cfd_fraction = 0.5):
+    if timing == "edge":
+        return square_edge_times(np.asarray(square), edges, threshold)
+    if timing == "cfd":
+        raw = np.asarray(raw)
+        return raw_pulse_cfd_times(raw, edges, height_window, cfd_fraction)
+    return edges
+
+# Expand index ranges [start, end) of the other channel to pair index arrays without
+# python loops. Returns indexes i of the edges and j of their partners.
+def expand_ranges(start, end):
+    counts = end - start
+    i = np.repeat(np.arange(len(counts)), counts)
+    j = np.arange(len(i)) - np.repeat(np.cumsum(counts) - counts, counts) + np.repeat(start, counts)
+    return i, j
+
+# Index of the nearest edge in the other channel for every edge, -1 if there is none.
+def nearest_edges(edges, other_edges):
+    if len(other_edges) == 0:
+        return np.full(len(edges), -1)
+    right = np.clip(np.searchsorted(other_edges, edges), 0, len(other_edges) - 1)
+    left = np.clip(right - 1, 0, len(other_edges) - 1)
+    return np.where(np.abs(edges - other_edges[left]) <= np.abs(other_edges[right] - edges), left, right)
+
+# Pair the sorted edges of the channels A and B, whose distance is at most window
+# samples. Window None pairs every edge with every other edge. Pairs are found with
+# sorted searches, so the cost grows with the pair count instead of the product of
+# the edge counts. In the nearest mode an edge is paired only with its mutually
+# nearest edge of the other channel. Window in nanoseconds is converted to samples
+# by dividing it with the sample interval. Returns index arrays to edges_a and edges_b.
+def coincidence_pairs(edges_a, edges_b, window = None, nearest = False):
+    edges_a = np.asarray(edges_a)
+    edges_b = np.asarray(edges_b)
+    if len(edges_a) == 0 or len(edges_b) == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    if nearest:
+        i = np.arange(len(edges_a))
+        j = nearest_edges(edges_a, edges_b)
+        # Keep the pairs where A is also the nearest edge of its B partner.
+        mutual = nearest_edges(edges_b, edges_a)[j] == i
+        i, j = i[mutual], j[mutual]
+        if window is not None:
+            inside = np.abs(edges_a[i] - edges_b[j]) <= window
+            i, j = i[inside], j[inside]
+        return i, j
+    if window is None:
+        return expand_ranges(np.zeros(len(edges_a), dtype=np.int64), np.full(len(edges_a), len(edges_b)))
+    start = np.searchsorted(edges_b, edges_a - window, "left")
+    end = np.searchsorted(edges_b, edges_a + window, "right")
+    return expand_ranges(start, end)
+
+# Runs of true values, which do not touch either end of the buffer, as the sums of
+# the change indexes before and at the end of the run. Middle of the run, (sum + 1) // 2,
+# is the same peak that find_peaks gives for a boolean signal with width and distance
+# of one and zero threshold, but found from the changes of the signal without scipy.
+def raw_pulse_runs(mask):
+    changes = (mask[1:] != mask[:-1]).nonzero()[0]
+    if len(mask) > 0 and mask[0]:
+        changes = changes[1:]
+    if len(mask) > 0 and mask[-1]:
+        changes = changes[:-1]
+    return changes[0::2] + changes[1::2]
+
+def raw_pulse_peaks(mask):
+    return (raw_pulse_runs(mask) + 1) // 2
+
+# Smallest integer sample value, that is positive after baseline_correction_and_limit.
+# Subtraction is monotonic, so comparing the raw integer samples to this gives the same
+# mask as correcting the baseline first, without the float temporaries.
+def raw_pulse_threshold(mean, low_limit):
+    mean = float(mean)
+    threshold = ceil(mean + max(low_limit, 0))
+    if low_limit > 0:
+        while threshold - 1 - mean >= low_limit:
+            threshold -= 1
+        while threshold - mean < low_limit:
+            threshold += 1
+    else:
+        while threshold - 1 - mean > 0:
+            threshold -= 1
+        while threshold - mean <= 0:
+            threshold += 1
+    return threshold
+
+# Raw pulse detector of the pulse detection mode 1, used by the worker and the GUI.
+# Select one raw pulse from the buffer for the spectrum. Candidates are the nearest
+# peaks on both sides of the buffer centre, which are below the high limit. Of those,
+# the one farther from the centre is selected. Returns the count of the peaks from the
+# overlap onwards, index of the selected peak or -1, and its baseline corrected height.
+def select_raw_pulse(data, low_limit, high_limit, overlap = 0):
+    data = np.asarray(data)
+    if len(data) == 0:
+        return 0, -1, 0
+    if data.dtype.kind in "iu":
+        # Integer sum is exact, so this equals the mean of NumPy. Sum of less than
+        # 2^16 int16 samples fits to int32, which is faster to accumulate.
+        mean = float(np.add.reduce(data, dtype=np.int32 if data.itemsize <= 2 and len(data) < 65536 else np.int64)) / len(data)
+        mask = data >= raw_pulse_threshold(mean, low_limit)
+    else:
+        mean = data.mean()
+        mask = baseline_correction_and_limit(data, low_limit, high_limit) > 0
+    runs = raw_pulse_runs(mask)
+    # Peaks in the tail were handled with the previous chunk.
+    first = np.searchsorted(runs, 2 * overlap - 1) if overlap > 0 else 0
+    # There are only few peaks, so they are searched as a list. Only the peaks nearest
+    # to the centre are checked against the high limit, instead of all of them.
+    peaks = [(run + 1) // 2 for run in runs[first:].tolist()]
+    centre = len(data) / 2
+    right = bisect_right(peaks, centre)
+    while right < len(peaks) and data[peaks[right]] - mean >= high_limit:
+        right += 1
+    left = bisect_left(peaks, centre) - 1
+    while left >= 0 and data[peaks[left]] - mean >= high_limit:
+        left -= 1
+    has_right = right < len(peaks)
+    has_left = left >= 0
+    if not has_right and not has_left:
+        return len(peaks), -1, 0
+    if not has_left or (has_right and peaks[right] - centre > centre - peaks[left]):
+        peak = peaks[right]
+    else:
+        peak = peaks[left]
+    return len(peaks), peak, data[peak] - mean
+
+# Raw pulse detection with the compiled kernels, if they are in use.
+def detect_raw_pulse(data, low_limit, high_limit, overlap = 0):
+    if kernels.use_kernels():
+        return kernels.select_raw_pulse(data, low_limit, high_limit, overlap)
+    return select_raw_pulse(data, low_limit, high_limit, overlap)
+
+# In the stream mode buffers start with a tail of overlap samples carried over from
+# the previous chunk. Pulses found in the tail were already counted with the previous
+# chunk, but they are still paired with the new pulses of the other channel, so the
+# coincidences over the chunk boundary are found exactly once. Coincidence window
+# is then limited to the overlap length. Time differences are A - B in samples for
+# the pairs inside the coincidence window, which is None for the whole buffer.
+# Returns pulse counts, lists of the pulse heights for A and B, the max heights of
+# the capture as [(A, B)], the time differences and the sample indexes of the pulses
+# with heights for A and B. In the SCA mode every pulse has its height from the raw
+# channel window (pre, post samples) of height_window.
+# Pulses are paired by their edge samples, but the time differences are taken with
+# the pulse timing: sample, edge (SCA mode only) or cfd, which give float differences.
+# With the raw pulse filters of dsp.py, heights are taken from the shaped raw channels
+# and the piled up SCA pulses are left out of the heights, but they are still counted.
+def get_max_heights_and_time_differences(buffers, spectrum_low_limits, spectrum_high_limits, pulse_detection_mode, overlap = 0,
+                                         coincidence_window = None, nearest = False, height_window = (100, 100),
+                                         timing = "sample", cfd_fraction = 0.5, filters = None):
+
+    time_differences = np.zeros(0, dtype=np.int64)
     pulse_heights = []
+    # Heights of the paired pulses, one for each time difference.
+    pair_heights_a = []
+    pair_heights_b = []
 
     if pulse_detection_mode == 0:
 
         #bcl = list(map(lambda x: baseline_correction_and_limit(*x), zip(buffers, settings["spectrum_low_limits"], settings["spectrum_high_limits"])))
         bcl = buffers
 
-        a1 = raising_edges_for_square_pulses(np.array(bcl[0]), 8192)
-        a2 = raising_edges_for_square_pulses(np.array(bcl[1]), 8192)
+        a1 = raising_edges_for_square_pulses(np.asarray(bcl[0]), 8192)
+        a2 = raising_edges_for_square_pulses(np.asarray(bcl[1]), 8192)
+
+        # Edge at index i needs samples i and i + 1, so edges from overlap - 1 onwards are new.
+        l1 = len(a1) if overlap == 0 else np.count_nonzero(a1 >= overlap - 1)
+        l2 = len(a2) if overlap == 0 else np.count_nonzero(a2 >= overlap - 1)
 
-        l1 = len(a1)
-        l2 = len(a2)
+        raw_a, raw_b = bcl[2], bcl[3]
+        if filters is not None:
+            raw_a = filters[0].shape(raw_a)
+            raw_b = filters[1].shape(raw_b)
 
-        m1 = max(bcl[2])
-        if m1 == 0:
+        # One height per new pulse from the raw channel around its edge.
+        new_a = a1 >= overlap - 1
+        new_b = a2 >= overlap - 1
+        indexes_a = a1[new_a]
+        indexes_b = a2[new_b]
+        heights_a = pulse_heights_around_edges(raw_a, indexes_a, *height_window)
+        heights_b = pulse_heights_around_edges(raw_b, indexes_b, *height_window)
+
+        # Empty raw channel.
+        if not heights_a.any():
             l1 = 0
+            heights_a, indexes_a = heights_a[:0], indexes_a[:0]
 
-        m2 = max(bcl[3])
-        if m2 == 0:
+        if not heights_b.any():
             l2 = 0
+            heights_b, indexes_b = heights_b[:0], indexes_b[:0]
+
+        if filters is not None:
+            if len(heights_a) > 0:
+                keep = ~filters[0].pileup(a1)[new_a]
+                heights_a, indexes_a = heights_a[keep], indexes_a[keep]
+            if len(heights_b) > 0:
+                keep = ~filters[1].pileup(a2)[new_b]
+                heights_b, indexes_b = heights_b[keep], indexes_b[keep]
+
+        heights_a = heights_a.tolist()
+        heights_b = heights_b.tolist()
 
-        pulse_heights.append((m1, m2))
+        pulse_heights.append((max(heights_a, default=0), max(heights_b, default=0)))
 
         #if m1 < settings["spectrum_low_limits"][2] or m1 > settings["spectrum_high_limits"][2]:
         #    l1 = 0
         #if m2 < settings["spectrum_low_limits"][3] or m2 > settings["spectrum_high_limits"][3]:
         #    l2 = 0
 
+        i = j = time_differences
+
+        # Pairs must have at least one new pulse and fit into the overlap window.
+        if overlap > 0:
+            if l1 > 0 or l2 > 0:
+                window = overlap - 1 if coincidence_window is None else min(coincidence_window, overlap - 1)
+                i, j = coincidence_pairs(a1, a2, window, nearest)
+                new = np.maximum(a1[i], a2[j]) >= overlap - 1
+                i, j = i[new], j[new]
+
         # If there is a square pulse on both SCA channels,
-        # calculate the time difference between the pulses.
-        if l1 > 0 and l2 > 0:
-            for i in a1:
-                for j in a2:
-                    time_differences.append((i-j)) # 2ns!
-                    #if bcl[2][i] == 0 or bcl[3][j] == 0:
-                    #    pass
-                        # Debug possible empty raw data channels, even if they were triggered.
-                        # There might be occasional cases when in that certain index there is zero value
-                        # but then just before or after there is currant value.
-                        # print(
-                        #     "empty",
-                        #     "idx", (i, j, i-j),
-                        #     "val", (bcl[0][i], bcl[1][j], bcl[2][i], bcl[3][j]),
-                        #     "max", (max(bcl[0]), max(bcl[1]), max(bcl[2]), max(bcl[3]))
-                        # )
-
-        return l1, l2, m1, m2, pulse_heights, time_differences
-
-    #m1 = max(data[2])
-    #m2 = max(data[3])
-    peaks_a, peaks_b = [], []
+        # calculate the time difference between the pulses (2ns!).
+        elif l1 > 0 and l2 > 0:
+            i, j = coincidence_pairs(a1, a2, coincidence_window, nearest)
+
+        if len(i) > 0:
+            t1 = sca_pulse_times(bcl[0], bcl[2], a1, timing, 8192, height_window, cfd_fraction)
+            t2 = sca_pulse_times(bcl[1], bcl[3], a2, timing, 8192, height_window, cfd_fraction)
+            time_differences = t1[i] - t2[j]
+            pair_heights_a = pulse_heights_around_edges(raw_a, a1[i], *height_window).tolist()
+            pair_heights_b = pulse_heights_around_edges(raw_b, a2[j], *height_window).tolist()
+
+        return l1, l2, heights_a, heights_b, pulse_heights, time_differences, indexes_a.tolist(), indexes_b.tolist(), \
+               pair_heights_a, pair_heights_b
+
+    # Width and distance parameters of the raw pulse finder depend on the timebase. Bigger
+    # the timebase (smaller the resolution) smaller the width and distance needs to be.
     # For timebase 52 these are 1, for timebase 2 these are 10...
-    pulse_width = 1
-    pulse_distance = 1
-    threshold = 0
-    #if triggers[0] > 0:
-    #if m1 < self.spectrum_high_limits[2]:
-    d1 = baseline_correction_and_limit(buffers[2], spectrum_low_limits[2], spectrum_high_limits[2])
-    # Width and distance parameters depends of the timebase. Bigger the timebase (smaller the resolution)
-    # smaller the width and distance needs to be in the find_peak algorithm used in the raising edges finder.
-    peaks_a = raising_edges_for_raw_pulses(d1 > 0, width=pulse_width, distance=pulse_distance, threshold=threshold)
-    #if triggers[1] > 0:
-    #if m2 < self.spectrum_high_limits[3]:
-    d2 = baseline_correction_and_limit(buffers[3], spectrum_low_limits[3], spectrum_high_limits[3])
-    peaks_b = raising_edges_for_raw_pulses(d2 > 0, width=pulse_width, distance=pulse_distance, threshold=threshold)
-
-    l1 = len(peaks_a)
-    l2 = len(peaks_b)
-
-    # Center position of the buffers.
-    ld1 = len(d1) / 2
-    ld2 = len(d2) / 2
-
-    peaks_left = [
-        [(i, abs(i - ld1), d1[i]) for i in peaks_a if i > ld1 and d1[i] < spectrum_high_limits[2]][:1],
-        [(i, abs(i - ld2), d2[i]) for i in peaks_b if i > ld2 and d2[i] < spectrum_high_limits[3]][:1]
-    ]
-
-    peaks_right = [
-        [(i, abs(ld1 - i), d1[i]) for i in peaks_a if i < ld1 and d1[i] < spectrum_high_limits[2]][-1:],
-        [(i, abs(ld2 - i), d2[i]) for i in peaks_b if i < ld2 and d2[i] < spectrum_high_limits[3]][-1:]
-    ]
-
-    peaks_left[0].extend(peaks_right[0])
-    peaks_left[1].extend(peaks_right[1])
-
-    peaks = [
-        (lambda a: [([a[0][0], a[0][2]] if a[0][1] > a[1][1] else [a[1][0], a[1][2]]) if len(a) > 1 else [a[0][0], a[0][2]]] if len(a) > 0 else [])(peaks_left[0]),
-        (lambda a: [([a[0][0], a[0][2]] if a[0][1] > a[1][1] else [a[1][0], a[1][2]]) if len(a) > 1 else [a[0][0], a[0][2]]] if len(a) > 0 else [])(peaks_left[1])
-    ]
-
-    # maxes = [
-    #     (lambda a: [(a[0][2] if a[0][1] > a[1][1] else a[1][2]) if len(a) > 1 else a[0][2]] if len(a) > 0 else [])(peaks_left[0]),
-    #     (lambda a: [(a[0][2] if a[0][1] > a[1][1] else a[1][2]) if len(a) > 1 else a[0][2]] if len(a) > 0 else [])(peaks_left[1])
-    # ]
-
-    maxes = [
-        [a[1] for a in peaks[0][-1:]],
-        [a[1] for a in peaks[1][-1:]]
-    ]
-
-    m1 = peaks[0][-1:][0][1] if len(peaks[0]) > 0 else 0
+    l1, i, m1 = detect_raw_pulse(buffers[2], spectrum_low_limits[2], spectrum_high_limits[2], overlap)
+    l2, j, m2 = detect_raw_pulse(buffers[3], spectrum_low_limits[3], spectrum_high_limits[3], overlap)
+
     if m1 == 0:
         l1 = 0
 
-    m2 = peaks[1][-1:][0][1] if len(peaks[1]) > 0 else 0
     if m2 == 0:
         l2 = 0
 
+    # Heights of the selected raw pulses from the shaped channels.
+    if filters is not None:
+        shaped_a = filters[0].shape(buffers[2])
+        shaped_b = filters[1].shape(buffers[3])
+        if l1 > 0:
+            m1 = int(pulse_heights_around_edges(shaped_a, [i], *height_window)[0])
+        if l2 > 0:
+            m2 = int(pulse_heights_around_edges(shaped_b, [j], *height_window)[0])
+
     pulse_heights.append((m1, m2))
 
-    if l1 > 0 and l2 > 0:
-        for i, t in peaks[0]:
-            for j, u in peaks[1]:
-                # timebase_n per unit!
-                time_differences.append((i-j))
+    # One pulse per channel is the only pair and also mutually nearest, so only the
+    # window is checked, same as coincidence_pairs does for single edges.
+    if l1 > 0 and l2 > 0 and (coincidence_window is None or abs(i - j) <= coincidence_window):
+        # timebase_n per unit!
+        edges_a = np.array([i], dtype=np.int64)
+        edges_b = np.array([j], dtype=np.int64)
+        time_differences = edges_a - edges_b
+        if timing == "cfd":
+            time_differences = raw_pulse_cfd_times(buffers[2], edges_a, height_window, cfd_fraction) - \
+                               raw_pulse_cfd_times(buffers[3], edges_b, height_window, cfd_fraction)
+        pair_heights_a = [m1]
+        pair_heights_b = [m2]
+
+    return l1, l2, [m1] if l1 > 0 else [], [m2] if l2 > 0 else [], pulse_heights, time_differences, \
+           [i] if l1 > 0 else [], [j] if l2 > 0 else [], pair_heights_a, pair_heights_b
+
+# BATCHED DETECTION
+#
+# Batched versions of the detection helpers work on (captures, samples) arrays of
+# one channel or on (captures, channels, samples) arrays of whole captures, for
+# example a rapid mode run or a chunk of stored waveforms. Edges are returned as
+# flat arrays with the capture index of every edge, sorted by capture and sample.
+
+# Falling edges of the SCA square pulses, same as raising_edges_for_square_pulses.
+def raising_edges_for_square_pulses_batch(data, low_limit = 4096):
+    pos = np.asarray(data) > low_limit
+    return (pos[:, :-1] & ~pos[:, 1:]).nonzero()
+
+# Same peaks as raising_edges_for_raw_pulses with width, distance and threshold of
+# one and zero for a boolean signal: middle of every run of true values, which does
+# not touch either end of the buffer.
+def raising_edges_for_raw_pulses_batch(data):
+    pos = np.asarray(data, dtype=bool)
+    padded = np.zeros((pos.shape[0], pos.shape[1] + 2), dtype=np.int8)
+    padded[:, 1:-1] = pos
+    steps = np.diff(padded, axis=1)
+    captures, starts = (steps == 1).nonzero()
+    ends = (steps == -1).nonzero()[1] - 1
+    inside = (starts > 0) & (ends < pos.shape[1] - 1)
+    return captures[inside], (starts[inside] + ends[inside]) // 2
+
+def baseline_correction_and_limit_batch(data, low_limit, high_limit = None):
+    data = np.asarray(data)
+    bca = data - data.mean(axis=1, keepdims=True)
+    bca[(bca < low_limit) & (bca > -low_limit)] = 0
+    return bca
+
+# Start offsets of every capture in the flat edge arrays. Edges of the capture k are
+# edges[offsets[k]:offsets[k + 1]].
+def capture_offsets(captures, count):
+    return np.searchsorted(captures, np.arange(count + 1))
+
+# Pair the edges inside the same capture. Edges of the different captures are spaced
+# apart by more than a capture length, so a single sorted search pairs the whole batch.
+def coincidence_pairs_batch(captures_a, edges_a, captures_b, edges_b, offsets_b, samples, window = None, nearest = False):
+    if window is None and not nearest:
+        return expand_ranges(offsets_b[captures_a], offsets_b[captures_a + 1])
+    stride = 2 * samples + 1 + (window if window is not None else 0)
+    i, j = coincidence_pairs(captures_a * stride + edges_a, captures_b * stride + edges_b, window, nearest)
+    same = captures_a[i] == captures_b[j]
+    return i[same], j[same]
+
+# Heights of the batch edges from the raw channel of their captures. Captures are
+# handled as one flat array, and the windows are clipped to the capture of the edge.
+def pulse_heights_around_edges_batch(captures, channel, capture, edges, pre_samples = 100, post_samples = 100):
+    count, channels, samples = captures.shape
+    base = (capture * channels + channel) * samples
+    start = base + np.maximum(edges - pre_samples, 0)
+    end = base + np.minimum(edges + post_samples, samples - 1)
+    return window_maxima(np.ascontiguousarray(captures).reshape(-1), start, end)
+
+# Pulse times of the batch edges with the same timings as sca_pulse_times. Times are
+# relative to the start of the capture of the edge.
+def sca_pulse_times_batch(captures, channel, capture, edges, timing = "sample", threshold = 8192,
+                          height_window = (100, 100), cfd_fraction = 0.5):
+    if timing not in ("edge", "cfd"):
+        return edges
+    count, channels, samples = captures.shape
+    flat = np.ascontiguousarray(captures).reshape(-1)
+    if timing == "edge":
+        base = (capture * channels + channel) * samples
+        return square_edge_times(flat, base + edges, threshold) - base
+    base = (capture * channels + channel + 2) * samples
+    peaks = pulse_peaks_around_edges(flat, base + edges, *height_window, low = base, high = base + samples - 1)
+    baselines = captures[:, channel + 2].mean(axis=1)[capture]
+    return cfd_times(flat, peaks, baselines, cfd_fraction, height_window[0], low = base) - base
+
+# Per capture max of the heights, 0 for the captures without pulses, and the count
+# of the nonzero heights per capture. Heights may be negative, so the maxima start
+# from the smallest value, same as the max of the single capture path.
+def capture_maxima(capture, heights, count):
+    maxima = np.full(count, np.iinfo(np.int64).min, dtype=np.int64)
+    np.maximum.at(maxima, capture, heights)
+    maxima[np.bincount(capture, minlength=count) == 0] = 0
+    return maxima, np.bincount(capture[heights != 0], minlength=count)
+
+# Square pulse detection of get_max_heights_and_time_differences for a batch of
+# captures in one pass. Returns struct of arrays: edges and their capture indexes
+# and offsets for A and B, pulse counts l1 and l2 and max heights (captures, 2) of
+# the pulses per capture, height of every pulse from the raw channel window given by
+# height_window, and pair indexes to the edges with their captures, offsets and time
+# differences A - B with the pulse timing.
+def get_max_heights_and_time_differences_batch(captures, coincidence_window = None, nearest = False, threshold = 8192,
+                                               height_window = (100, 100), timing = "sample", cfd_fraction = 0.5):
+
+    captures = np.asarray(captures)
+    count, channels, samples = captures.shape
+
+    capture_a, edges_a = raising_edges_for_square_pulses_batch(captures[:, 0], threshold)
+    capture_b, edges_b = raising_edges_for_square_pulses_batch(captures[:, 1], threshold)
+    offsets_a = capture_offsets(capture_a, count)
+    offsets_b = capture_offsets(capture_b, count)
+
+    pulse_heights_a = pulse_heights_around_edges_batch(captures, 2, capture_a, edges_a, *height_window)
+    pulse_heights_b = pulse_heights_around_edges_batch(captures, 3, capture_b, edges_b, *height_window)
+    max_a, nonzero_a = capture_maxima(capture_a, pulse_heights_a, count)
+    max_b, nonzero_b = capture_maxima(capture_b, pulse_heights_b, count)
+    heights = np.stack((max_a, max_b), axis=1)
+
+    # Captures with empty raw channel have no pulses.
+    l1 = np.diff(offsets_a)
+    l2 = np.diff(offsets_b)
+    l1[nonzero_a == 0] = 0
+    l2[nonzero_b == 0] = 0
+
+    pair_a, pair_b = coincidence_pairs_batch(capture_a, edges_a, capture_b, edges_b, offsets_b, samples, coincidence_window, nearest)
+    pair_capture = capture_a[pair_a]
+    # Pairs only when both channels have pulses.
+    keep = (l1[pair_capture] > 0) & (l2[pair_capture] > 0)
+    pair_a, pair_b, pair_capture = pair_a[keep], pair_b[keep], pair_capture[keep]
+
+    times_a = sca_pulse_times_batch(captures, 0, capture_a[pair_a], edges_a[pair_a], timing, threshold, height_window, cfd_fraction)
+    times_b = sca_pulse_times_batch(captures, 1, capture_b[pair_b], edges_b[pair_b], timing, threshold, height_window, cfd_fraction)
 
-    return l1, l2, m1, m2, pulse_heights, time_differences
+    return {
+        "capture_a": capture_a,
+        "edges_a": edges_a,
+        "offsets_a": offsets_a,
+        "pulse_heights_a": pulse_heights_a,
+        "capture_b": capture_b,
+        "edges_b": edges_b,
+        "offsets_b": offsets_b,
+        "pulse_heights_b": pulse_heights_b,
+        "l1": l1,
+        "l2": l2,
+        "heights": heights,
+        "pair_capture": pair_capture,
+        "pair_a": pair_a,
+        "pair_b": pair_b,
+        "pair_offsets": capture_offsets(pair_capture, count),
+        "pair_heights_a": pulse_heights_a[pair_a],
+        "pair_heights_b": pulse_heights_b[pair_b],
+        "time_differences": times_a - times_b
+    }
+
+# Split the batch results to the same per capture tuples that
+# get_max_heights_and_time_differences returns.
+def split_batch_results(results):
+    l1 = results["l1"].tolist()
+    l2 = results["l2"].tolist()
+    heights = results["heights"].tolist()
+    offsets = results["pair_offsets"]
+    offsets_a = results["offsets_a"].tolist()
+    offsets_b = results["offsets_b"].tolist()
+    heights_a = results["pulse_heights_a"].tolist()
+    heights_b = results["pulse_heights_b"].tolist()
+    edges_a = results["edges_a"].tolist()
+    edges_b = results["edges_b"].tolist()
+    time_differences = results["time_differences"]
+    pair_heights_a = results["pair_heights_a"].tolist()
+    pair_heights_b = results["pair_heights_b"].tolist()
+    for k in range(len(l1)):
+        yield l1[k], l2[k], \
+              heights_a[offsets_a[k]:offsets_a[k + 1]] if l1[k] > 0 else [], \
+              heights_b[offsets_b[k]:offsets_b[k + 1]] if l2[k] > 0 else [], \
+              [tuple(heights[k])], time_differences[offsets[k]:offsets[k + 1]], \
+              edges_a[offsets_a[k]:offsets_a[k + 1]] if l1[k] > 0 else [], \
+              edges_b[offsets_b[k]:offsets_b[k + 1]] if l2[k] > 0 else [], \
+              pair_heights_a[offsets[k]:offsets[k + 1]], pair_heights_b[offsets[k]:offsets[k + 1]]
+
+# Event record of the software trigger. Sample is the absolute index of the SCA edge
+# in the stream, channel is 0 for A and 1 for B, height is the max of the raw channel
+# (C for A, D for B) in the window, partners is the count of the earlier coincident
+# edges in the other channel and waveform holds the raw channels C and D around the edge.
+def event_dtype(pre_trigger_samples, post_trigger_samples):
+    return np.dtype([
+        ("sample", np.int64),
+        ("channel", np.int8),
+        ("height", np.int16),
+        ("partners", np.int16),
+        ("waveform", np.int16, (2, pre_trigger_samples + post_trigger_samples))
+    ])
+
+# Count, for each edge, the edges of the other channel in the window before it. Pairs
+# are found with sorted searches, so the cost does not grow with the product of the
+# pulse counts. Include equal marks if the same sample index counts as earlier.
+def earlier_partners(edges, other_edges, window, include_equal = False):
+    side = "right" if include_equal else "left"
+    end = np.searchsorted(other_edges, edges, side)
+    start = np.searchsorted(other_edges, edges - window, "left")
+    return start, end
+
+# Software trigger for the streamed chunks. Scans the SCA channels A and B for the
+# pulse edges and cuts pre and post trigger windows from the raw channels C and D around
+# the hits. Chunk buffers start with a tail of overlap samples from the previous chunk.
+# Edge is accepted in the chunk where its whole window fits in, i.e. local index from
+# overlap - post to length - post, so every edge is handled exactly once. A coincidence
+# pair is handled with its later edge (A before B on the same sample), so the earlier
+# edge must still be in the buffer. Thus overlap must be at least pre + post and post +
+# coincidence_window. If coincidence window is zero, every edge triggers. Otherwise only
+# the edges with an earlier partner trigger. Returns event records, accepted edge counts
+# of A and B, the time differences of the coincident pairs (A - B in samples) and the
+# raw pulse heights of both edges of the pairs.
+def extract_events(buffers, overlap, chunk_start, pre_trigger_samples, post_trigger_samples, threshold = 8192, coincidence_window = 0):
+
+    length = len(buffers[0])
+    window = np.arange(-pre_trigger_samples, post_trigger_samples)
+
+    a1 = raising_edges_for_square_pulses(np.asarray(buffers[0]), threshold)
+    a2 = raising_edges_for_square_pulses(np.asarray(buffers[1]), threshold)
+
+    low = overlap - post_trigger_samples
+    high = length - post_trigger_samples
+    new_a1 = a1[(a1 >= low) & (a1 < high)]
+    new_a2 = a2[(a2 >= low) & (a2 < high)]
+
+    time_differences = np.zeros(0, dtype=np.int64)
+    pair_heights = (np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64))
+    partners_1 = np.zeros(len(new_a1), dtype=np.int16)
+    partners_2 = np.zeros(len(new_a2), dtype=np.int16)
+
+    if coincidence_window > 0:
+        # B edges strictly before A and A edges before or on B.
+        start_1, end_1 = earlier_partners(new_a1, a2, coincidence_window)
+        start_2, end_2 = earlier_partners(new_a2, a1, coincidence_window, True)
+        partners_1 = (end_1 - start_1).astype(np.int16)
+        partners_2 = (end_2 - start_2).astype(np.int16)
+        i1, j1 = expand_ranges(start_1, end_1)
+        i2, j2 = expand_ranges(start_2, end_2)
+        edges_a = np.concatenate((new_a1[i1], a1[j2]))
+        edges_b = np.concatenate((a2[j1], new_a2[i2]))
+        time_differences = edges_a - edges_b
+        # Same windows as the event heights.
+        pair_heights = (
+            pulse_heights_around_edges(buffers[2], edges_a, pre_trigger_samples, post_trigger_samples - 1),
+            pulse_heights_around_edges(buffers[3], edges_b, pre_trigger_samples, post_trigger_samples - 1)
+        )
+        triggers = (partners_1 > 0, partners_2 > 0)
+    else:
+        triggers = (np.ones(len(new_a1), dtype=bool), np.ones(len(new_a2), dtype=bool))
+
+    edges = np.concatenate((new_a1[triggers[0]], new_a2[triggers[1]]))
+    channels = np.concatenate((np.zeros(np.count_nonzero(triggers[0]), dtype=np.int8), np.ones(np.count_nonzero(triggers[1]), dtype=np.int8)))
+    partners = np.concatenate((partners_1[triggers[0]], partners_2[triggers[1]]))
+    order = np.argsort(edges, kind="stable")
+
+    events = np.zeros(len(edges), dtype=event_dtype(pre_trigger_samples, post_trigger_samples))
+    if len(edges) > 0:
+        edges, channels, partners = edges[order], channels[order], partners[order]
+        # Windows of the raw channels with one fancy indexing: (events, 2, window).
+        raw = np.asarray([buffers[2], buffers[3]])
+        waveforms = raw[:, edges[:, None] + window].transpose(1, 0, 2)
+        events["sample"] = chunk_start + edges
+        events["channel"] = channels
+        events["height"] = waveforms[np.arange(len(edges)), channels].max(axis=1)
+        events["partners"] = partners
+        events["waveform"] = waveforms
+
+    return events, len(new_a1), len(new_a2), time_differences, pair_heights
 
 # Use the show_image helper function as a shortcut to display images.
 def show_image(file, width=None, height=None):
@@ -325,7 +817,10 @@ def write_buffers(buffers, file):
         print(*([i]+list(b)), sep = ";", file = f)
     f.close()
 
-def load_buffers(file, buffers = [], b = [], first_line = True):
+# Whole waveform.csv file as lists. Playback uses storage.PlaybackReader, which reads
+# the captures one at a time.
+def load_buffers(file):
+    buffers, b, first_line = [], [], True
     with open(file, "r") as f:
         for line in f:
             items = line.strip().split(";")
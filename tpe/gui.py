@@ -14,10 +14,7 @@ from pyqtgraph.graphicsItems.LegendItem import ItemSample
 from time import strftime, time as tm
 #from operator import add
 from datetime import timedelta
-from collections import deque
-from . functions import baseline_correction_and_limit, \
-                        raising_edges_for_raw_pulses, \
-                        raising_edges_for_square_pulses
+from . accumulators import HistogramAccumulator, ScatterAccumulator, WaveformRing, RateHistory, min_max_envelope
 from pandas import Series
 from scipy.signal import find_peaks
 
@@ -125,6 +122,15 @@ def add_menu(qtapplication):
     resumeAction.triggered.connect(qtapplication.resume)
     resumeAction.setShortcut('Ctrl+R')
 
+    # TIMELINE MENU
+    menuTimeline = menubar.addMenu("Timeline")
+    # Show the pulse rate time line in seconds, minutes or hours.
+    for level, name in enumerate(('Seconds', 'Minutes', 'Hours')[:len(qtapplication.rate_history_levels)]):
+        levelAction = QtGui.QAction(QtGui.QIcon('exit24.png'), name, qtapplication)
+        menuTimeline.addAction(levelAction)
+        levelAction.triggered.connect(lambda checked = False, level = level: qtapplication.set_rate_level(level))
+        levelAction.setShortcut('Alt+%s' % (level + 1))
+
     # TODO: Do we need clear graphs menu?
 
     # QUIT MENU
@@ -337,8 +343,8 @@ class Settings(QtWidgets.QDialog):
 
             settings = self.app.settings_acquire_value['value']['picoscope']
 
-            spectrum_low_limits = self.app.settings_acquire_value['value']['spectrum_low_limits']
-            spectrum_high_limits = self.app.settings_acquire_value['value']['spectrum_high_limits']
+            spectrum_low_limits = self.app.control.get('spectrum_low_limits')
+            spectrum_high_limits = self.app.control.get('spectrum_high_limits')
 
             settings['sleep_time'] = float(self.picoscope_settings['sleep_time'].text())
 
@@ -355,23 +361,36 @@ class Settings(QtWidgets.QDialog):
                 self.picoscope_settings['voltage_range'][3].currentText()
             )
 
-            if self.app.spectrum_low_limits != spectrum_low_limits or \
-               self.app.spectrum_high_limits != spectrum_high_limits or \
-               settings['sleep_time'] != self.original_picoscope_settings['sleep_time'] or \
+            limits_changed = self.app.spectrum_low_limits != spectrum_low_limits or \
+                             self.app.spectrum_high_limits != spectrum_high_limits
+
+            # Spectrum limits are applied by the worker without restarting the Picoscope.
+            if limits_changed:
+                self.app.control.write(
+                    spectrum_low_limits = self.app.spectrum_low_limits,
+                    spectrum_high_limits = self.app.spectrum_high_limits
+                )
+
+            picoscope_changed = settings['sleep_time'] != self.original_picoscope_settings['sleep_time'] or \
                (self.app.picoscope_mode == 'stream' and (
                settings['interval'] != self.original_picoscope_settings['interval'] or \
                settings['units'] != self.original_picoscope_settings['units'] or \
                settings['buffer_size'] != self.original_picoscope_settings['buffer_size'] or \
                settings['buffer_count'] != self.original_picoscope_settings['buffer_count'])) or \
-               settings['voltage_range'] != self.original_picoscope_settings['voltage_range']:
+               list(settings['voltage_range']) != list(self.original_picoscope_settings['voltage_range'])
 
+            # Other Picoscope settings need the worker to restart the Picoscope.
+            if picoscope_changed:
                 self.original_picoscope_settings['voltage_range'] = settings['voltage_range']
+                self.app.voltage_ranges = list(settings['voltage_range'])
                 settings_acquire_value = self.app.settings_acquire_value['value']
                 settings_acquire_value['spectrum_low_limits'] = self.app.spectrum_low_limits
                 settings_acquire_value['spectrum_high_limits'] = self.app.spectrum_high_limits
                 settings_acquire_value['picoscope'] = settings
                 self.app.settings_acquire_value['value'] = settings_acquire_value
                 self.app.settings_acquire_event.set()
+
+            if limits_changed or picoscope_changed:
                 self.app.set_signal_region_adc_a()
                 self.app.set_signal_region_adc_b()
                 self.app.init_spectrum_histograms()
@@ -395,28 +414,39 @@ class Signals(QtGui.QWidget):
         plot_labels = {'left': 'Volts', 'bottom': 'Time (ns)'}
 
         self.curves = [
-            {'title': 'Channel A (SCA C)', 'curves': [], 'peaks': [], 'position': [0, 0], 'plot': None, 'pen': pg.mkPen('r', width=1), 'max': {'index': 0, 'value': 0}, 'labels': plot_labels},
-            {'title': 'Channel B (SCA D)', 'curves': [], 'peaks': [], 'position': [0, 1], 'plot': None, 'pen': pg.mkPen('g', width=1), 'max': {'index': 0, 'value': 0}, 'labels': plot_labels},
-            {'title': 'Channel C', 'curves': [], 'peaks': [], 'position': [1, 0], 'plot': None, 'pen': pg.mkPen('r', width=1), 'max': {'index': 0, 'value': 0}, 'labels': plot_labels},
-            {'title': 'Channel D', 'curves': [], 'peaks': [], 'position': [1, 1], 'plot': None, 'pen': pg.mkPen('g', width=1), 'max': {'index': 0, 'value': 0}, 'labels': plot_labels},
+            {'title': 'Channel A (SCA C)', 'position': [0, 0], 'plot': None, 'color': 'r', 'labels': plot_labels},
+            {'title': 'Channel B (SCA D)', 'position': [0, 1], 'plot': None, 'color': 'g', 'labels': plot_labels},
+            {'title': 'Channel C', 'position': [1, 0], 'plot': None, 'color': 'r', 'labels': plot_labels},
+            {'title': 'Channel D', 'position': [1, 1], 'plot': None, 'color': 'g', 'labels': plot_labels},
         ]
 
         self.max_curves_in_plot = 25
 
         self.filter_coincidences = True
 
-        # Add curves deque and plot widget instance to the layout.
+        # Every channel has a ring of the latest waveforms and a fixed pool of plot items,
+        # one for every slot of the ring. Items are only restyled by swapping the pens.
         for i, data in enumerate(self.curves):
-            data['curves'] = []
             # TODO: could not find out the way to position title little bit lower.
             data['plot'] = pg.PlotWidget(title = data['title'])
-            data['plot'].setDownsampling(auto=True, mode='peak')
             voltage_range = VOLTAGE_RANGES[self.app.settings_acquire_value['value']['picoscope']['voltage_range'][i]]
             data['plot'].setYRange(-voltage_range, voltage_range, padding=0)
             data['plot'].showGrid(x=True, y=True, alpha=.5)
             for k, v in data['labels'].items():
                 data['plot'].setLabel(k, v)
             self.layout.addWidget(data['plot'], *data['position'])
+            data['ring'] = WaveformRing(self.max_curves_in_plot)
+            data['pens'] = {
+                'normal': pg.mkPen(data['color'], width=1),
+                'coincidence': pg.mkPen(data['color'], width=2),
+                'max': pg.mkPen('w', width=1),
+                'selected': pg.mkPen('c', width=1)
+            }
+            data['items'] = [data['plot'].getPlotItem().plot(pen = data['pens']['normal']) for slot in range(self.max_curves_in_plot)]
+            # Pen and alpha of the items, so that only the changed styles are set.
+            data['styles'] = [None] * self.max_curves_in_plot
+            for item in data['items']:
+                item.hide()
 
         self.buffer_selection = pg.ComboBox()
         self.init_buffer_items = {'All buffers': 0}
@@ -439,16 +469,10 @@ class Signals(QtGui.QWidget):
 
         def clear_button_action(c):
             self.update_graph = False
-            for channel in range(4):
-                for curve in self.curves[channel]['curves']:
-                    curve.clear()
-                for curve in self.curves[channel]['peaks']:
-                    curve.clear()
-                self.curves[channel]['curves'] = []
-                self.curves[channel]['peaks'] = []
-                self.curves[channel]['max'] = {'index': 0, 'value': 0}
-                self.curves[channel]['coincidence'] = False
-                self.curves[channel]['pen'] = pg.mkPen('r', width=1) if (channel == 0 or channel == 2) else pg.mkPen('g', width=1)
+            for data in self.curves:
+                data['ring'].clear()
+                for item in data['items']:
+                    item.hide()
             self.buffer_mode = 0
             self.buffer_selection.setItems(self.init_buffer_items.copy())
             self.buffer_selection.setValue(0)
@@ -493,44 +517,56 @@ class Signals(QtGui.QWidget):
         # Start refreshing the real time plot content.
         self.update_graph = True
 
+    # Set the pen, alpha and z value of the item, if they have changed.
+    def set_curve_style(self, channel, slot, pen, alpha, z):
+        data = self.curves[channel]
+        item = data['items'][slot]
+        style = data['styles'][slot]
+        if style is None or style[0] != pen:
+            item.setPen(data['pens'][pen])
+        if style is None or style[1] != alpha:
+            item.setAlpha(alpha, False)
+        if style is None or style[2] != z:
+            item.setZValue(z)
+        data['styles'][slot] = (pen, alpha, z)
+        item.show()
+
     def refresh_graph(self):
         items = self.init_buffer_items.copy()
-        for channel in range(4):
-            # No need to handle the last curve, because it has 100% alpha and is shown in the graph.
-            l = len(self.curves[channel]['curves'])
-            for i, (curve, peak) in enumerate(zip(self.curves[channel]['curves'], self.curves[channel]['peaks'])):
+        for channel, data in enumerate(self.curves):
+            ring = data['ring']
+            l = len(ring)
+            # Newest curve has 100% alpha and the max curve is drawn on top of the others.
+            for i, slot in enumerate(ring.order):
                 if self.buffer_mode > 0:
                     if i+1 != self.buffer_mode:
-                        curve.hide()
-                        #peak.hide()
+                        data['items'][slot].hide()
                     else:
-                        #peak.show()
-                        curve.setPen('c')
-                        curve.setAlpha(1, False)
-                        curve.show()
+                        self.set_curve_style(channel, slot, 'selected', 1, i)
+                elif slot == ring.max_slot:
+                    self.set_curve_style(channel, slot, 'max', 1, self.max_curves_in_plot)
                 else:
-                    #peak.clear()
-                    #peak.hide()
-                    if i == self.curves[channel]['max']['index']:
-                        curve.setPen('w')
-                        curve.setAlpha(1, False)
-                        curve.setZValue(self.max_curves_in_plot)
-                    else:
-                        curve.setPen(self.curves[channel]['pen'])
-                        curve.setAlpha((i+1)/l, False)
-                    curve.show()
-            if channel == 0:
-                for j in range(1, l+1):
-                    c = ' (oldest)' if (j == 2 and (self.curves[2]['max']['index'] == 0 and self.curves[3]['max']['index'] == 0)) or (j == 1 and (self.curves[2]['max']['index'] != 0 and self.curves[3]['max']['index'] != 0)) else ''
-                    c += ' (newist)' if j == l else ''
-                    c += ' (coincidence)' if self.curves[channel]['coincidence'] else ''
-                    c += ' (max A)' if j-1 == self.curves[2]['max']['index'] else ''
-                    c += ' (max B)' if j-1 == self.curves[3]['max']['index'] else ''
-                    label_data = (str(j), c)
-                    items['Buffer #%s%s' % label_data] = j
+                    self.set_curve_style(channel, slot, 'coincidence' if ring.coincidences[slot] else 'normal', (i+1)/l, i)
+        ring = self.curves[0]['ring']
+        for j, slot in enumerate(ring.order, 1):
+            c = ' (oldest)' if j == 1 else ''
+            c += ' (newist)' if j == len(ring) else ''
+            c += ' (coincidence)' if ring.coincidences[slot] else ''
+            c += ' (max A)' if j-1 < len(self.curves[2]['ring']) and self.curves[2]['ring'].order[j-1] == self.curves[2]['ring'].max_slot else ''
+            c += ' (max B)' if j-1 < len(self.curves[3]['ring']) and self.curves[3]['ring'].order[j-1] == self.curves[3]['ring'].max_slot else ''
+            label_data = (str(j), c)
+            items['Buffer #%s%s' % label_data] = j
 
         self.buffer_selection.setItems(items)
 
+    # Draw the waveform of the slot as a min/max envelope with one bin per pixel of the plot.
+    def draw_curve(self, channel, slot):
+        data = self.curves[channel]
+        x, y = min_max_envelope(data['ring'].waveform(slot), max(1, data['plot'].width()))
+        # Change ADC values to volts.
+        voltage_range = VOLTAGE_RANGES[self.app.voltage_ranges[channel]]
+        data['items'][slot].setData(x, y * (voltage_range / self.app.spectrum_time_window))
+
     # Poll signal data from the main app.
     def update(self, coincidence = False):
 
@@ -540,67 +576,12 @@ class Signals(QtGui.QWidget):
         # will be updated and drawn.
         if self.update_graph and (not self.filter_coincidences or coincidence):
 
-            #blcd = map(lambda x: baseline_correction_and_limit(*x), zip(self.app.signals_data, self.app.spectrum_low_limits, self.app.spectrum_high_limits))
-
             for channel, data in enumerate(self.app.signals_data):
 
-                ld = len(data)
-
                 c = self.curves[channel]
-                cc = c['curves']
-                l = len(cc)
-                color = c['pen']
-                c['coincidence'] = coincidence
-
-                m = max(data) if ld > 0 else 0
-                if m > c['max']['value']:
-                    # New max value for the next index.
-                    c['max']['index'] = l
-                    c['max']['value'] = m
-                    # Use white color for pen.
-                    color = 'w'
-
-                # If length of the stack is max, clear away the oldest curve.
-                if l == self.max_curves_in_plot:
-                    # If maximum value curve resides in the first index, do not remove it,
-                    # but the second last.
-                    if c['max']['index'] == 0:
-                        cc[1].clear()
-                        cc.pop(1)
-                    # Else remove the last curve.
-                    else:
-                        cc[0].clear()
-                        cc.pop(0)
-                        # Shift max curve index by decreasing it by one.
-                        if c['max']['index'] > 0:
-                            c['max']['index'] -= 1
-                # If stack is still getting populated, we just add a new curve.
-                cc.append(
-                    c['plot'].getPlotItem().plot(pen = color)
-                )
-
-                c['peaks'].append(
-                    self.curves[channel]['plot'].getPlotItem().plot(pen = 'y')
-                )
 
-                # Change ADC values to volts.
-                if ld > 0:
-                    voltage_range = VOLTAGE_RANGES[self.app.settings_acquire_value['value']['picoscope']['voltage_range'][channel]]
-                    data = list(map(lambda x: voltage_range * x / self.app.spectrum_time_window, data))
-
-                # Add data to the new curve.
-                cc[-1].setData(data)
-
-                # pdata = np.zeros(len(data))
-                # peaks = raising_edges_for_raw_pulses(np.array(data) > 1, width=100, distance=100, threshold=0)
-                # for peak in peaks:
-                #     peak_corr = peak - len(data)/2
-                #     if peak_corr > -10:
-                #         pdata[peak] = 10 + ((10 + peak_corr) / 20)
-                #     else:
-                #         pdata[peak] = data[peak]
-                # c['peaks'][-1].hide()
-                # c['peaks'][-1].setData(pdata)
+                # Waveform is copied to the ring, the oldest waveform is overwritten when the ring is full.
+                self.draw_curve(channel, c['ring'].append(data, coincidence))
 
                 # Resize plot to match max area.
                 c['plot'].enableAutoRange(axis='y')
@@ -608,6 +589,13 @@ class Signals(QtGui.QWidget):
 
             self.refresh_graph()
 
+    # Envelopes depend on the plot width, so they are redrawn from the rings on resize.
+    def resizeEvent(self, event):
+        QtGui.QWidget.resizeEvent(self, event)
+        for channel, data in enumerate(self.curves):
+            for slot in data['ring'].order:
+                self.draw_curve(channel, slot)
+
     def closeEvent(self, event):
         self.update_graph = False
         event.accept()
@@ -1376,6 +1364,16 @@ class App(QtGui.QMainWindow):
         self.spectrum_time_window = application_configuration["spectrum_time_window"]
         # Spectrum queue size.
         self.spectrum_queue_size = application_configuration["spectrum_queue_size"]
+        # Scatter queue size and the point count, after which the scatter is drawn as a density image.
+        self.scatter_queue_size = application_configuration.get("scatter_queue_size", 10000)
+        self.scatter_density_threshold = application_configuration.get("scatter_density_threshold", 0)
+        self.scatter_density_bins = application_configuration.get("scatter_density_bins", 128)
+        # Pulse rate history levels as (seconds, points) pairs and the level shown in the time line.
+        self.rate_history_levels = application_configuration.get("rate_history_levels", ((1, 120), (60, 1440), (3600, 720)))
+        self.rate_level = 0
+        # Plots are drawn at the target frame rate and captures ingested every ingest interval milliseconds.
+        self.target_fps = application_configuration.get("target_fps", 30)
+        self.ingest_interval = application_configuration.get("ingest_interval", 10)
         # Time difference and spectrum histograms bin count.
         self.bin_count = application_configuration["bin_count"]
         # Time window in nanoseconds (T_w).
@@ -1397,12 +1395,18 @@ class App(QtGui.QMainWindow):
 
         # Multiprocessing events and values that are shared between the processes.
         self.set_multiprocessing_arguments(multiprocessing_arguments)
+        # Voltage ranges are needed for every capture, so they are kept here instead
+        # of reading them from the manager.
+        self.voltage_ranges = list(self.settings_acquire_value['value']['picoscope']['voltage_range'])
 
         # Results table window.
         self.table = None
         # Signal plot window.
         self.signal = None
         self.signals_data = [[],[],[],[]]
+        self.signals_coincidence = False
+        # Plots that have new data to draw in the next frame.
+        self.dirty_plots = set()
         # Application settings window.
         self.setting = None
 
@@ -1463,8 +1467,6 @@ class App(QtGui.QMainWindow):
         self.start_measurement2 = False
         self.start_measurement3 = False
 
-        self.rate_timeline = 120
-
         self.logarithmic_scale_threshold = 10
         #self.logarithmic_scale = ' - lin(y)'
         self.logarithmic_scale = ''
@@ -1509,6 +1511,9 @@ class App(QtGui.QMainWindow):
         self.collect_start_time = tm()
         self.collect_start_time_str = strftime("%Y-%m-%d %H:%M:%S")
 
+        # Colors of the trigger channels A, B and both in the scatter and the rate graphs.
+        self.symbolBrush = ['r', 'g', 'c']
+
         self.create_time_difference_histogram()
 
         self.create_time_difference_scatter()
@@ -1545,10 +1550,13 @@ class App(QtGui.QMainWindow):
         # Application start time, different than measurement start time.
         self.start_time = tm()
         self.start_time_str = strftime("%Y-%m-%d %H:%M:%S")
-        # Frames per second indicator initial values.
+        # Frames per second and backlog indicator initial values.
         self.counter = 0
         self.fps = 0.
         self.lastupdate = tm()
+        self.ingested_captures = 0
+        self.ingest_rate = 0.
+        self.ingest_backlog = 0
         # How often graphs will be updated in seconds?
         self.interval = 1.
         self.lasttime = tm()
@@ -1573,18 +1581,12 @@ class App(QtGui.QMainWindow):
 
         self.init_line_graph()
 
-        # Initial x ticks starting from 0 in the right and having negative values up to the left
-        self.pointer = -self.rate_timeline
-
         self.lineplota = self.lineplot.plot(pen = 'r', name = 'A (SCA)')
-        self.lineplota.setPos(self.pointer, 0)
 
         self.lineplotb = self.lineplot.plot(pen = 'g', name = 'B (SCA)')
-        self.lineplotb.setPos(self.pointer, 0)
         self.lineplotb.setAlpha(0.40, False)
 
         self.lineplotc = self.lineplot.plot(pen = 'c', name = 'Coincidence')
-        self.lineplotc.setPos(self.pointer, 0)
         self.lineplotc.setAlpha(0.40, False)
 
         legend = LegendItem((120, 60), offset=(15,15))
@@ -1601,15 +1603,29 @@ class App(QtGui.QMainWindow):
         self.lineplot.setMouseEnabled(x=False, y=False)
 
     def init_line_graph(self):
-        # values for the line plots, repeat 0 n times
-        self.plot_values = {0: [], 1: [], 2: []}
-        plot_range = [0 for i in range(self.rate_timeline)]
-        self.plot_values[0] = plot_range[:]
-        self.plot_values[1] = plot_range[:]
-        self.plot_values[2] = plot_range[:]
+        # Rates of A, B and coincidences per second, and their minute and hour means.
+        self.rate_history = RateHistory(3, self.rate_history_levels)
 
         self.channels_pulse_height_value_data = []
 
+    # Draw the time line from the rate history level. X axis is the time elapsed in
+    # the units of the level, so switching the level does not need any other data.
+    def draw_line_graph(self):
+        x, values = self.rate_history.series(self.rate_level)
+        seconds = self.rate_history.seconds[self.rate_level]
+        # A (SCA C).
+        self.lineplota.setData(x * seconds, values[:, 0])
+        # B (SCA D).
+        self.lineplotb.setData(x * seconds, values[:, 1])
+        # A & B coincidence.
+        self.lineplotc.setData(x * seconds, values[:, 2])
+
+    def set_rate_level(self, level):
+        self.rate_level = level
+        seconds = self.rate_history.seconds[level]
+        self.lineplot.setLabel('right', 'Rate / s (%s s mean)' % seconds if seconds > 1 else 'Rate / s', **self.plot_label_style)
+        self.draw_line_graph()
+
     #####################################
     # Create signal spectrum histograms #
     #####################################
@@ -1645,6 +1661,8 @@ class App(QtGui.QMainWindow):
         #self.signal_spectrum_region_a.sigRegionChanged.connect(self.region_update_a)
         #self.signal_spectrum_region_b.sigRegionChanged.connect(self.region_update_b)
 
+        self.spectra_bin_count = 64
+
         self.init_spectrum_histograms()
 
         # Signal spectrum plots.
@@ -1656,11 +1674,7 @@ class App(QtGui.QMainWindow):
         self.lines_a = []
         self.lines_b = []
 
-        self.spectra_bin_count = 64
-        y, x = np.histogram(
-            self.signal_spectrum_data_a,
-            bins = np.linspace(0, VOLTAGE_RANGES[self.settings_acquire_value['value']['picoscope']['voltage_range'][2]], self.spectra_bin_count)
-        )
+        y, x = self.signal_spectrum_data_a.histogram()
 
         #x = np.zeros(len(self.signal_spectrum_data_a))
         #y = self.signal_spectrum_data_a
@@ -1679,10 +1693,7 @@ class App(QtGui.QMainWindow):
             brush = self.orange_color
         )
 
-        y, x = np.histogram(
-            self.signal_spectrum_data_b,
-            bins = np.linspace(0, VOLTAGE_RANGES[self.settings_acquire_value['value']['picoscope']['voltage_range'][3]], self.spectra_bin_count)
-        )
+        y, x = self.signal_spectrum_data_b.histogram()
 
         self.signal_spectrum_plot_b = self.signal_spectrum_plot.plot(x, y,
             name = 'B',
@@ -1709,10 +1720,7 @@ class App(QtGui.QMainWindow):
         ])
 
         # Time difference spectrum plots.
-        y, x = np.histogram(
-            self.time_difference_spectrum_data_a,
-            bins = np.linspace(0, VOLTAGE_RANGES[self.settings_acquire_value['value']['picoscope']['voltage_range'][2]], self.bin_count)
-        )
+        y, x = self.time_difference_spectrum_data_a.histogram()
 
         self.time_difference_spectrum_plot_a = self.time_difference_spectrum_plot.plot(x, y,
             name = 'A',
@@ -1722,10 +1730,7 @@ class App(QtGui.QMainWindow):
             pen = pg.mkPen('r', width=0, style=None)
         )
 
-        y, x = np.histogram(
-            self.time_difference_spectrum_data_b,
-            bins = np.linspace(0, VOLTAGE_RANGES[self.settings_acquire_value['value']['picoscope']['voltage_range'][3]], self.bin_count)
-        )
+        y, x = self.time_difference_spectrum_data_b.histogram()
 
         self.time_difference_spectrum_plot_b = self.time_difference_spectrum_plot.plot(x, y,
             name = 'B',
@@ -1783,23 +1788,26 @@ class App(QtGui.QMainWindow):
         voltage_range = VOLTAGE_RANGES[self.settings_acquire_value['value']['picoscope']['voltage_range'][ind]]
         self.spectrum_low_limits[ind] = int(limits[0] * self.spectrum_time_window / voltage_range)
         self.spectrum_high_limits[ind] = int(limits[1] * self.spectrum_time_window / voltage_range)
-        # Restart Picoscope multiprocess worker with new settings.
-        settings_acquire_value = self.settings_acquire_value['value']
-        settings_acquire_value['spectrum_low_limits'] = self.spectrum_low_limits
-        settings_acquire_value['spectrum_high_limits'] = self.spectrum_high_limits
-        self.settings_acquire_value['value'] = settings_acquire_value
-        self.settings_acquire_event.set()
+        # Worker applies the new limits from the control block.
+        self.control.write(
+            spectrum_low_limits = self.spectrum_low_limits,
+            spectrum_high_limits = self.spectrum_high_limits
+        )
 
 
     def init_spectrum_histograms(self, spectrum_queue_size = None):
 
         queue_size = spectrum_queue_size if spectrum_queue_size != None else self.spectrum_queue_size
 
-        self.signal_spectrum_data_a = deque([], maxlen=queue_size)
-        self.signal_spectrum_data_b = deque([], maxlen=queue_size)
+        # Spectra are kept as histograms of the latest queue size pulse heights in volts.
+        voltage_range_a = VOLTAGE_RANGES[self.voltage_ranges[2]]
+        voltage_range_b = VOLTAGE_RANGES[self.voltage_ranges[3]]
 
-        self.time_difference_spectrum_data_a = deque([], maxlen=queue_size)
-        self.time_difference_spectrum_data_b = deque([], maxlen=queue_size)
+        self.signal_spectrum_data_a = HistogramAccumulator(0, voltage_range_a, self.spectra_bin_count, queue_size)
+        self.signal_spectrum_data_b = HistogramAccumulator(0, voltage_range_b, self.spectra_bin_count, queue_size)
+
+        self.time_difference_spectrum_data_a = HistogramAccumulator(0, voltage_range_a, self.spectra_bin_count, queue_size)
+        self.time_difference_spectrum_data_b = HistogramAccumulator(0, voltage_range_b, self.spectra_bin_count, queue_size)
 
         self.time_difference_spectrum_plot.setLabel('right', self.coincidence_count_graph_label % (0, self.logarithmic_scale), **self.plot_label_style)
 
@@ -1843,7 +1851,6 @@ class App(QtGui.QMainWindow):
         # Create a graph item for current rate indicators.
 
         self.rate_bar_size = .75
-        self.symbolBrush = ['r', 'g', 'c']
 
         self.rate_graph_labels = [{
             'pen': 'r',
@@ -1937,20 +1944,65 @@ class App(QtGui.QMainWindow):
 
         queue_size = spectrum_queue_size if spectrum_queue_size != None else self.spectrum_queue_size
 
-        self.histogram_data = deque([], maxlen=queue_size)
+        self.histogram_data = HistogramAccumulator(-self.time_window, self.time_window, self.bin_count, queue_size)
 
         self.histogramplot.clear()
 
         # Initial values for histogram.
-        y, x = np.histogram(self.histogram_data, bins = np.linspace(-self.time_window, self.time_window, self.bin_count))
+        y, x = self.histogram_data.histogram()
         self.histogramplotp = self.histogramplot.plot(x, y, stepMode = True, fillLevel = 0, brush = (0, 0, 255, 150))
 
         self.histogramplot.setLabel('left', self.coincidence_count_graph_label % (0, self.logarithmic_scale), **self.plot_label_style)
 
 
+    # Scatter is a single item, which is redrawn from the ring of the latest points once
+    # per frame. Density image replaces the points, when there are too many to draw.
     def init_time_difference_scatter(self):
         self.scatterplot.clear()
 
+        voltage_range_a = VOLTAGE_RANGES[self.voltage_ranges[2]]
+        voltage_range_b = VOLTAGE_RANGES[self.voltage_ranges[3]]
+
+        self.scatter_data = ScatterAccumulator(
+            self.scatter_queue_size,
+            (0, voltage_range_a),
+            (0, voltage_range_b),
+            self.scatter_density_bins
+        )
+
+        # Brushes by the trigger channel code of the points, last one for unknown channel.
+        self.scatter_brushes = np.empty(len(self.symbolBrush) + 1, dtype=object)
+        self.scatter_brushes[:] = [pg.mkBrush(color) for color in self.symbolBrush + ['w']]
+
+        self.scatter = pg.ScatterPlotItem(pxMode=False, pen=None, size=.25)
+        self.scatterplot.addItem(self.scatter)
+
+        self.scatter_image = pg.ImageItem()
+        self.scatter_image.setVisible(False)
+        self.scatterplot.addItem(self.scatter_image)
+
+    def update_time_difference_scatter(self):
+
+        voltage_range_a = VOLTAGE_RANGES[self.voltage_ranges[2]]
+        voltage_range_b = VOLTAGE_RANGES[self.voltage_ranges[3]]
+
+        if self.scatter_data.x_range[1] != voltage_range_a or self.scatter_data.y_range[1] != voltage_range_b:
+            self.scatter_data.set_ranges((0, voltage_range_a), (0, voltage_range_b))
+
+        if self.scatter_density_threshold > 0 and len(self.scatter_data) > self.scatter_density_threshold:
+            if self.scatter.isVisible():
+                self.scatter.setData([])
+                self.scatter.setVisible(False)
+                self.scatter_image.setVisible(True)
+            self.scatter_image.setImage(self.scatter_data.density, autoLevels=True)
+            self.scatter_image.setRect(QtCore.QRectF(0, 0, voltage_range_a, voltage_range_b))
+        else:
+            if self.scatter_image.isVisible():
+                self.scatter_image.setVisible(False)
+                self.scatter.setVisible(True)
+            positions, codes = self.scatter_data.points()
+            self.scatter.setData(pos=positions, brush=self.scatter_brushes[codes])
+
 
     #####################################
     #         EXPERIMENT STEPS
@@ -2099,11 +2151,10 @@ class App(QtGui.QMainWindow):
                 self.spectrum_low_limits[3] = int(measurement_settings['channel_b']['spectrum_low_limit'])
                 self.spectrum_high_limits[3] = int(measurement_settings['channel_b']['spectrum_high_limit'])
 
-        settings_acquire_value = self.settings_acquire_value['value']
-        settings_acquire_value['spectrum_low_limits'] = self.spectrum_low_limits
-        settings_acquire_value['spectrum_high_limits'] = self.spectrum_high_limits
-        self.settings_acquire_value['value'] = settings_acquire_value
-        self.settings_acquire_event.set()
+        self.control.write(
+            spectrum_low_limits = self.spectrum_low_limits,
+            spectrum_high_limits = self.spectrum_high_limits
+        )
 
         self.set_signal_region_adc_a()
         self.set_signal_region_adc_b()
@@ -2394,7 +2445,7 @@ class App(QtGui.QMainWindow):
 
     def open_playback_file(self):
 
-        playback_file = QtGui.QFileDialog.getOpenFileName(self, 'Open playback file', '', "Data files (*.dat)")
+        playback_file = QtGui.QFileDialog.getOpenFileName(self, 'Open playback file', '', "Playback files (*.tpw *.csv *.dat);;All files (*)")
 
         self.playback_file = playback_file[0]
 
@@ -2415,6 +2466,8 @@ class App(QtGui.QMainWindow):
         }
 
         self.settings_acquire_event.set()
+        # Playback of the new file starts right away.
+        self.control.write(pause = False)
 
     # RESULTS MENU / WINDOW
 
@@ -2489,66 +2542,60 @@ class App(QtGui.QMainWindow):
         for key, value in arguments.items():
             self.__dict__[key] = value
 
-    # Start the main GUI window refresh loop
+    # Start the main GUI window refresh loop. Captures are ingested by one timer and
+    # the plots are drawn by another one at the target frame rate, so the GUI does not
+    # spin when idle nor fall behind the acquisition when the drawing is slow.
     def start_update(self):
-        self._update()
-
-    # Calculate frames per seconds
+        self.ingest_timer = QtCore.QTimer()
+        self.ingest_timer.timeout.connect(self._ingest)
+        self.ingest_timer.start(self.ingest_interval)
+        self.render_timer = QtCore.QTimer()
+        self.render_timer.timeout.connect(self._render)
+        self.render_timer.start(int(round(1000 / max(1, self.target_fps))))
+
+    # Measure frames per second and the captures ingested per second over a second.
     def _fps(self):
+        self.counter += 1
         now = tm()
         dt = now - self.lastupdate
-        if dt <= 0:
-            dt = 0.000000000001
-        self.lastupdate = now
-        self.fps = self.fps * 0.9 + (1.0 / dt) * 0.1
+        if dt >= 1.:
+            self.fps = self.counter / dt
+            self.ingest_rate = self.ingested_captures / dt
+            self.lastupdate = now
+            self.counter = 0
+            self.ingested_captures = 0
 
     def set_window_status_bar(self):
         text = 'Start time: ' + self.start_time_str
         text += ' | Now: ' + strftime("%H:%M:%S")
-        text += ' | Frame Rate:  {fps:.1f} FPS'.format(fps = self.fps)
+        text += ' | Frame Rate:  {fps:.1f}/{target} FPS'.format(fps = self.fps, target = self.target_fps)
+        # Captures waiting in the ring, the largest batch ingested in a tick and the ingestion rate.
+        text += ' | Backlog: %s (max %s, %.0f/s)' % (self.signal_spectrum_ring.pending(), self.ingest_backlog, self.ingest_rate)
+        # Captures and waveforms dropped, because the GUI could not keep up.
+        text += ' | Dropped: %s/%s' % self.signal_spectrum_ring.overruns()
+        # Time from the latest setting change to the worker applying it.
+        text += ' | Control latency: %.1fms' % (self.control.get_latency() * 1000)
         self.label.setText(text)
+        self.ingest_backlog = 0
 
     def set_discriminators(self, values):
         self.discriminator_values = values
 
+    # Time difference histogram is rebinned from the stored time differences.
     def set_bin_count(self, count):
         self.bin_count = count
+        if self.histogram_data.rebin(bin_count = count):
+            self.histogramplotp.setData(*self.histogram_data.histogram())
 
     def add_widget(self, widget):
         self.mainbox.layout().addWidget(widget)
 
     # DATA MENU ACTIONS
     def pause(self):
-        picoscope = self.settings_acquire_value['value']['picoscope']
-        self.settings_acquire_value["value"] = {
-            'sub_loop': True,
-            'main_loop': True,
-            'pause': True,
-            'sleep': (.1, .1),
-            'playback_file': self.playback_file,
-            'spectrum_low_limits': self.spectrum_low_limits,
-            'spectrum_high_limits': self.spectrum_high_limits,
-            # Picoscope settings
-            'picoscope': picoscope,
-            'sca_module_settings': self.sca_module_settings
-        }
-        self.settings_acquire_event.set()
+        self.control.write(pause = True)
 
     def resume(self):
-        picoscope = self.settings_acquire_value['value']['picoscope']
-        self.settings_acquire_value["value"] = {
-            'sub_loop': True,
-            'main_loop': True,
-            'pause': False,
-            'sleep': (.1, .1),
-            'playback_file': self.playback_file,
-            'spectrum_low_limits': self.spectrum_low_limits,
-            'spectrum_high_limits': self.spectrum_high_limits,
-            # Picoscope settings
-            'picoscope': picoscope,
-            'sca_module_settings': self.sca_module_settings
-        }
-        self.settings_acquire_event.set()
+        self.control.write(pause = False)
 
     def stop(self):
         self.collect_data = False
@@ -2683,19 +2730,7 @@ class App(QtGui.QMainWindow):
     # QUIT MENU ACTION
     def quit(self):
         # Close worker and main program loops and processes.
-        self.settings_acquire_value["value"] = {
-            'sub_loop': False,
-            'main_loop': False,
-            'pause': True,
-            'sleep': (1, 1),
-            'playback_file': '',
-            'spectrum_low_limits': [],
-            'spectrum_high_limits': [],
-            # Picoscope settings
-            'picoscope': {},
-            'sca_module_settings': {}
-        }
-        self.settings_acquire_event.set()
+        self.control.write(main_loop = False, pause = True)
         # Native close method call.
         self.close()
 
@@ -2735,266 +2770,248 @@ class App(QtGui.QMainWindow):
                 # Phase spectrum.
                 return xF, np.angle(yF)
 
-    # MAIN GUI UPDATE LOOP
-    def _update(self):
+    # Update counters and accumulators with a single capture and mark the plots that
+    # have new data. Plots are drawn by the render loop, not for every capture.
+    # Data contains the channel buffers or None, if the waveform was dropped.
+    def _update_signal_spectrum(self, data, triggers):
 
-        if not self.settings_acquire_value['value']['pause']:
+        if self.collect_data and data is not None:
+            for channel, value in enumerate(data):
+                self._save_channel_spectrums_data([str(channel), ','.join(map(str, value))])
 
-            # Signal spectrum histogram event and GUI update.
-            if self.signal_spectrum_acquire_event.is_set():
+        time_differences = triggers[2]
 
-                data, triggers = self.signal_spectrum_acquire_value["value"]
+        self.signal_spectrum_clicks_detector_a += triggers[0]
+        self.signal_spectrum_clicks_detector_b += triggers[1]
 
-                if self.collect_data:
-                    for channel, value in enumerate(data):
-                        self._save_channel_spectrums_data([str(channel), ','.join(map(str, value))])
+        voltage_range_a = VOLTAGE_RANGES[self.voltage_ranges[2]]
+        voltage_range_b = VOLTAGE_RANGES[self.voltage_ranges[3]]
 
-                time_differences = triggers[2]
+        signals_data = [[],[],[],[]]
 
-                self.signal_spectrum_clicks_detector_a += triggers[0]
-                self.signal_spectrum_clicks_detector_b += triggers[1]
+        maxes = [[], []]
 
-                voltage_range_a = VOLTAGE_RANGES[self.settings_acquire_value['value']['picoscope']['voltage_range'][2]]
-                voltage_range_b = VOLTAGE_RANGES[self.settings_acquire_value['value']['picoscope']['voltage_range'][3]]
+        # Pulses are analyzed by the worker in every detection mode. Only the heights
+        # and the time differences of the result record are aggregated here.
+        if triggers[0] > 0 or triggers[1] > 0:
+            maxes = [triggers[3], triggers[4]]
 
-                self.signals_data = [[],[],[],[]]
+        time_differences_n = len(time_differences)
 
-                maxes = [[], []]
+        self.signal_spectrum_clicks_coincidences += time_differences_n
 
-                if triggers[0] > 0 or triggers[1] > 0:
+        self.clicks_detector_a_s += len(maxes[0])
+        self.clicks_detector_b_s += len(maxes[1])
+        self.clicks_detector_a_b_s += time_differences_n
 
-                    if self.pulse_detection_mode == 0:
-                        maxes = [triggers[3], triggers[4]]
-                    else:
+        self.channels_pulse_height_value_data.append((len(maxes[0]), len(maxes[1]), time_differences_n))
 
-                        # TODO: use get_max_heights_and_time_differences, check that maxes come in same format!
-
-                        time_differences = []
-                        #m1 = max(data[2])
-                        #m2 = max(data[3])
-                        peaks_a, peaks_b = [], []
-                        # For timebase 52 these are 1, for timebase 2 these are 10...
-                        pulse_width = 1
-                        pulse_distance = 1
-                        threshold = 0
-                        #if triggers[0] > 0:
-                        #if m1 < self.spectrum_high_limits[2]:
-                        d1 = baseline_correction_and_limit(data[2], self.spectrum_low_limits[2], self.spectrum_high_limits[2])
-                        # Width and distance parameters depends of the timebase. Bigger the timebase (smaller the resolution)
-                        # smaller the width and distance needs to be in the find_peak algorithm used in the raising edges finder.
-                        peaks_a = raising_edges_for_raw_pulses(d1 > 0, width=pulse_width, distance=pulse_distance, threshold=threshold)
-                        #if triggers[1] > 0:
-                        #if m2 < self.spectrum_high_limits[3]:
-                        d2 = baseline_correction_and_limit(data[3], self.spectrum_low_limits[3], self.spectrum_high_limits[3])
-                        peaks_b = raising_edges_for_raw_pulses(d2 > 0, width=pulse_width, distance=pulse_distance, threshold=threshold)
-
-                        # Center position of the buffers.
-                        ld1 = len(d1) / 2
-                        ld2 = len(d2) / 2
-
-                        peaks_left = [
-                            [(i, abs(i - ld1), d1[i]) for i in peaks_a if i > ld1 and d1[i] < self.spectrum_high_limits[2]][:1],
-                            [(i, abs(i - ld2), d2[i]) for i in peaks_b if i > ld2 and d2[i] < self.spectrum_high_limits[3]][:1]
-                        ]
-
-                        peaks_right = [
-                            [(i, abs(ld1 - i), d1[i]) for i in peaks_a if i < ld1 and d1[i] < self.spectrum_high_limits[2]][-1:],
-                            [(i, abs(ld2 - i), d2[i]) for i in peaks_b if i < ld2 and d2[i] < self.spectrum_high_limits[3]][-1:]
-                        ]
-
-                        peaks_left[0].extend(peaks_right[0])
-                        peaks_left[1].extend(peaks_right[1])
-
-                        peaks = [
-                            (lambda a: [([a[0][0], a[0][2]] if a[0][1] > a[1][1] else [a[1][0], a[1][2]]) if len(a) > 1 else [a[0][0], a[0][2]]] if len(a) > 0 else [])(peaks_left[0]),
-                            (lambda a: [([a[0][0], a[0][2]] if a[0][1] > a[1][1] else [a[1][0], a[1][2]]) if len(a) > 1 else [a[0][0], a[0][2]]] if len(a) > 0 else [])(peaks_left[1])
-                        ]
-
-                        # maxes = [
-                        #     (lambda a: [(a[0][2] if a[0][1] > a[1][1] else a[1][2]) if len(a) > 1 else a[0][2]] if len(a) > 0 else [])(peaks_left[0]),
-                        #     (lambda a: [(a[0][2] if a[0][1] > a[1][1] else a[1][2]) if len(a) > 1 else a[0][2]] if len(a) > 0 else [])(peaks_left[1])
-                        # ]
-
-                        maxes = [[a[1] for a in peaks[0][-1:]], [a[1] for a in peaks[1][-1:]]]
-
-                        for i, t in peaks[0]:
-                            for j, u in peaks[1]:
-                                # timebase_n per unit!
-                                time_differences.append((i-j))
-
-                        # maxes = [
-                        #     [d1[i] for i in peaks_a if d1[i] < self.spectrum_high_limits[2]],
-                        #     [d2[i] for i in peaks_b if d2[i] < self.spectrum_high_limits[3]]
-                        # ]
-
-                        #if 0 < (len(peaks_a) * len(peaks_b)):
-                        # for i in peaks_a:
-                        #     for j in peaks_b:
-                        #         if d1[i] < self.spectrum_high_limits[2] and d2[j] < self.spectrum_high_limits[3]:
-                        #             time_differences.append((i-j)) # 2ns per unit!
-
-                time_differences_n = len(time_differences)
-
-                self.signal_spectrum_clicks_coincidences += time_differences_n
-
-                self.clicks_detector_a_s += len(maxes[0])
-                self.clicks_detector_b_s += len(maxes[1])
-                self.clicks_detector_a_b_s += time_differences_n
-
-                self.channels_pulse_height_value_data.append((len(maxes[0]), len(maxes[1]), time_differences_n))
-
-                def fit_function(x, *coeffs):
-                    return np.polyval(coeffs, x)
-
-                if len(maxes[0]) > 0:
-
-                    self.signals_data[0] = data[0]
-                    self.signals_data[2] = data[2]
-
-                    new_maxes = [(voltage_range_a * m / self.spectrum_time_window) for m in maxes[0]]
-                    self.signal_spectrum_data_a.extendleft(new_maxes)
-
-                    #y, x = np.histogram(self.signal_spectrum_data_a, bins = np.linspace(0, voltage_range_a, self.bin_count))
-                    y, x = np.histogram(self.signal_spectrum_data_a, bins = np.linspace(0, voltage_range_a, self.spectra_bin_count))
-                    if self.logarithmic_y_scale == 0 or len(self.signal_spectrum_data_a) < 2:
-                        self.signal_spectrum_plot_a.setData(x, y)
-                    else:
-                        self.signal_spectrum_plot_a.setData(*self.log(x, y, voltage_range_a))
-                    self.signal_spectrum_plot.setLabel('left', self.signal_spectrum_plot_left_label % (self.signal_spectrum_clicks_detector_a, self.logarithmic_scale if max(y) > self.logarithmic_scale_threshold else ""))
-
-                    if False:
-                        centers = x[:-1] + np.diff(x)[0] / 2
-                        norm_y = y / y.sum()
-                        norm_y_ma = Series(norm_y).rolling(1, center=True).mean().values * ((max(y) * 20) if max(y) < self.logarithmic_scale_threshold else (max(y)/2))
-                        self.histogramplotp_curve_a.setData(centers, norm_y_ma)
-
-                    if False:
-                        peaks = find_peaks(norm_y_ma, width = 2, distance = 2, threshold = 0.2)[0]
-
-                        for i, peak in enumerate(peaks[:5]):
-                            if i < len(self.lines_a)-1:
-                                self.lines_a[i].setValue(centers[peak])
-                                self.lines_a[i].setZValue(9999)
-                            else:
-                                center_line = pg.InfiniteLine(
-                                    pos=centers[peak],
-                                    angle=90,
-                                    pen=self.orange_color,
-                                    movable=False
-                                )
-                                self.lines_a.append(center_line)
-                                self.signal_spectrum_plot.addItem(center_line)
-
-                    #def f(x, N, a):
-                        #return N * x ** a
-
-                    #def f(x, *coeffs):
-                    #    return np.polyval(coeffs, x)
-
-                    # Optimize.
-                    #popt, pcov = scipy.optimize.curve_fit(fit_function, x[:-1], y, p0 = np.ones(12))
-                    #self.histogramplotp_curve_a.setData(x[:-1], fit_function(x[:-1], *popt))
-
-                    #perr = np.sqrt(np.diag(pcov))
-                    #self.histogramplotp_curve_a.setData(x[:-1], popt[0] * x[:-1] ** popt[1])
-                    #self.histogramplotp_curve_b.setData(x[:-1], (popt[0]+perr[1]) * x[:-1] ** (popt[1]+perr[1]))
-
-                if len(maxes[1]) > 0:
-
-                    self.signals_data[1] = data[1]
-                    self.signals_data[3] = data[3]
-
-                    new_maxes = [(voltage_range_b * m / self.spectrum_time_window) for m in maxes[1]]
-                    self.signal_spectrum_data_b.extendleft(new_maxes)
-
-                    y, x = np.histogram(self.signal_spectrum_data_b, bins = np.linspace(0, voltage_range_b, self.spectra_bin_count))
-                    if self.logarithmic_y_scale == 0 or len(self.signal_spectrum_data_b) < 2:
-                        self.signal_spectrum_plot_b.setData(x, y)
-                    else:
-                        self.signal_spectrum_plot_b.setData(*self.log(x, y, voltage_range_b))
-                    self.signal_spectrum_plot.setLabel('right', self.signal_spectrum_plot_right_label % (self.signal_spectrum_clicks_detector_b, self.logarithmic_scale if max(y) > self.logarithmic_scale_threshold else ""))
-
-                    if False:
-                        centers = x[:-1] + np.diff(x)[0] / 2
-                        norm_y = y / y.sum()
-                        norm_y_ma = Series(norm_y).rolling(1, center=True).mean().values * ((max(y) * 20) if max(y) < self.logarithmic_scale_threshold else (max(y)/2))
-                        self.histogramplotp_curve_b.setData(centers, norm_y_ma)
-
-                    if False:
-                        peaks = find_peaks(norm_y_ma, width = 2, distance = 2, threshold = 0.2)[0]
-
-                        for i, peak in enumerate(peaks[:5]):
-                            if i < len(self.lines_b)-1:
-                                self.lines_b[i].setValue(centers[peak])
-                                self.lines_a[i].setZValue(9999)
-                            else:
-                                center_line = pg.InfiniteLine(
-                                    pos=centers[peak],
-                                    angle=90,
-                                    pen='g',
-                                    movable=False
-                                )
-                                self.lines_b.append(center_line)
-                                self.signal_spectrum_plot.addItem(center_line)
-
-                if len(maxes[0]) > 0 or len(maxes[1]) > 0:
-                    if self.signal and self.signal.update_graph:
-                        self.signal.update(coincidence = (len(peaks_a) * len(peaks_b) > 0))
-
-                if time_differences_n > 0:
-
-                    if self.collect_data:
-                        self._save_time_histogram_data(map(str, time_differences))
-
-                    # COINCIDENCE SPECTRUM A
-                    new_maxes = [(voltage_range_a * x / self.spectrum_time_window) for x in maxes[0]]
-                    self.time_difference_spectrum_data_a.extendleft(new_maxes)
-                    y, x = np.histogram(self.time_difference_spectrum_data_a, bins = np.linspace(0, voltage_range_a, self.spectra_bin_count))
-                    if self.logarithmic_y_scale == 0 or len(self.time_difference_spectrum_data_a) < 2:
-                        self.time_difference_spectrum_plot_a.setData(x, y)
-                    else:
-                        self.time_difference_spectrum_plot_a.setData(*self.log(x, y, voltage_range_a))
-                    #self.time_difference_spectrum_plot.setLabel('left', "Channel A counts (%s)" % len(self.time_difference_spectrum_data_a))
-
-                    # COINCIDENCE SPECTRUM B
-                    new_maxes = [(voltage_range_b * x / self.spectrum_time_window) for x in maxes[1]]
-                    self.time_difference_spectrum_data_b.extendleft(new_maxes)
-                    y, x = np.histogram(self.time_difference_spectrum_data_b, bins = np.linspace(0, voltage_range_b, self.spectra_bin_count))
-                    if self.logarithmic_y_scale == 0 or len(self.time_difference_spectrum_data_b) < 2:
-                        self.time_difference_spectrum_plot_b.setData(x, y)
-                    else:
-                        self.time_difference_spectrum_plot_b.setData(*self.log(x, y, voltage_range_b))
+        if len(maxes[0]) > 0:
 
-                    self.time_difference_spectrum_plot.setLabel('right', self.coincidence_count_graph_label % (self.signal_spectrum_clicks_coincidences, self.logarithmic_scale if max(y) > self.logarithmic_scale_threshold else ""))
+            if data is not None:
+                signals_data[0] = data[0]
+                signals_data[2] = data[2]
 
-                    # TIME DIFFERENCE HISTOGRAM
-                    self.histogram_data.extend(time_differences)
-                    y, x = np.histogram(self.histogram_data, bins = np.linspace(-self.time_window, self.time_window, self.bin_count))
-                    if self.logarithmic_y_scale == 0 or len(self.histogram_data) < 2:
-                        self.histogramplotp.setData(x, y)
-                    else:
-                        self.histogramplotp.setData(*self.log(x, y, self.time_window))
-
-                    self.histogramplot.setLabel('left', self.coincidence_count_graph_label % (self.signal_spectrum_clicks_coincidences, self.logarithmic_scale if max(y) > self.logarithmic_scale_threshold else ""))
-
-                    # Adding spots to the scatter plot.
-                    scatter = pg.ScatterPlotItem(pxMode=False)
-                    for a, b in zip(maxes[0], maxes[1]):
-                        scatter.addPoints([{
-                            'pos': (
-                                # Change digital value to voltage.
-                                voltage_range_a * a / self.spectrum_time_window,
-                                voltage_range_b * b / self.spectrum_time_window
-                            ),
-                            'pen': None,
-                            'size': .25,
-                            # Change color of the spot depending on what channel was triggered.
-                            'brush': self.symbolBrush[triggers[5]] if triggers[5] != None else 'w'
-                        }])
-                    self.scatterplot.addItem(scatter)
-
-                self.signal_spectrum_acquire_event.clear()
+            # Only the bins of the new heights and the aged out heights are updated.
+            self.signal_spectrum_data_a.rebin(0, voltage_range_a)
+            self.signal_spectrum_data_a.extend(np.multiply(maxes[0], voltage_range_a / self.spectrum_time_window))
+            self.dirty_plots.add('signal_spectrum_a')
+
+        if len(maxes[1]) > 0:
+
+            if data is not None:
+                signals_data[1] = data[1]
+                signals_data[3] = data[3]
+
+            self.signal_spectrum_data_b.rebin(0, voltage_range_b)
+            self.signal_spectrum_data_b.extend(np.multiply(maxes[1], voltage_range_b / self.spectrum_time_window))
+            self.dirty_plots.add('signal_spectrum_b')
+
+        # Signals window shows the latest capture of the frame, which passes its filter.
+        if len(maxes[0]) > 0 or len(maxes[1]) > 0:
+            if self.signal and self.signal.update_graph and (not self.signal.filter_coincidences or time_differences_n > 0):
+                self.signals_data = signals_data
+                self.signals_coincidence = time_differences_n > 0
+                self.dirty_plots.add('signals')
+
+        if time_differences_n > 0:
 
+            if self.collect_data:
+                self._save_time_histogram_data(map(str, time_differences))
+
+            # COINCIDENCE SPECTRA
+            self.time_difference_spectrum_data_a.rebin(0, voltage_range_a)
+            self.time_difference_spectrum_data_a.extend(np.multiply(maxes[0], voltage_range_a / self.spectrum_time_window))
+            self.time_difference_spectrum_data_b.rebin(0, voltage_range_b)
+            self.time_difference_spectrum_data_b.extend(np.multiply(maxes[1], voltage_range_b / self.spectrum_time_window))
+
+            # TIME DIFFERENCE HISTOGRAM
+            self.histogram_data.extend(time_differences)
+
+            # Adding spots to the scatter ring, one for each pair.
+            self.scatter_data.extend(
+                # Change digital value to voltage.
+                np.multiply(triggers[6], voltage_range_a / self.spectrum_time_window),
+                np.multiply(triggers[7], voltage_range_b / self.spectrum_time_window),
+                # Change color of the spot depending on what channel was triggered.
+                triggers[5] if triggers[5] != None else len(self.symbolBrush)
+            )
+
+            self.dirty_plots.update(('coincidence_spectra', 'time_difference_histogram', 'scatter'))
+
+    def draw_signal_spectrum_a(self):
+
+        voltage_range_a = VOLTAGE_RANGES[self.voltage_ranges[2]]
+
+        y, x = self.signal_spectrum_data_a.histogram()
+        if self.logarithmic_y_scale == 0 or len(self.signal_spectrum_data_a) < 2:
+            self.signal_spectrum_plot_a.setData(x, y)
+        else:
+            self.signal_spectrum_plot_a.setData(*self.log(x, y, voltage_range_a))
+        self.signal_spectrum_plot.setLabel('left', self.signal_spectrum_plot_left_label % (self.signal_spectrum_clicks_detector_a, self.logarithmic_scale if max(y) > self.logarithmic_scale_threshold else ""))
+
+        if False:
+            centers = x[:-1] + np.diff(x)[0] / 2
+            norm_y = y / y.sum()
+            norm_y_ma = Series(norm_y).rolling(1, center=True).mean().values * ((max(y) * 20) if max(y) < self.logarithmic_scale_threshold else (max(y)/2))
+            self.histogramplotp_curve_a.setData(centers, norm_y_ma)
+
+        if False:
+            peaks = find_peaks(norm_y_ma, width = 2, distance = 2, threshold = 0.2)[0]
+
+            for i, peak in enumerate(peaks[:5]):
+                if i < len(self.lines_a)-1:
+                    self.lines_a[i].setValue(centers[peak])
+                    self.lines_a[i].setZValue(9999)
+                else:
+                    center_line = pg.InfiniteLine(
+                        pos=centers[peak],
+                        angle=90,
+                        pen=self.orange_color,
+                        movable=False
+                    )
+                    self.lines_a.append(center_line)
+                    self.signal_spectrum_plot.addItem(center_line)
+
+        #def f(x, N, a):
+            #return N * x ** a
+
+        #def f(x, *coeffs):
+        #    return np.polyval(coeffs, x)
+
+        # Optimize.
+        #popt, pcov = scipy.optimize.curve_fit(fit_function, x[:-1], y, p0 = np.ones(12))
+        #self.histogramplotp_curve_a.setData(x[:-1], fit_function(x[:-1], *popt))
+
+        #perr = np.sqrt(np.diag(pcov))
+        #self.histogramplotp_curve_a.setData(x[:-1], popt[0] * x[:-1] ** popt[1])
+        #self.histogramplotp_curve_b.setData(x[:-1], (popt[0]+perr[1]) * x[:-1] ** (popt[1]+perr[1]))
+
+    def draw_signal_spectrum_b(self):
+
+        voltage_range_b = VOLTAGE_RANGES[self.voltage_ranges[3]]
+
+        y, x = self.signal_spectrum_data_b.histogram()
+        if self.logarithmic_y_scale == 0 or len(self.signal_spectrum_data_b) < 2:
+            self.signal_spectrum_plot_b.setData(x, y)
+        else:
+            self.signal_spectrum_plot_b.setData(*self.log(x, y, voltage_range_b))
+        self.signal_spectrum_plot.setLabel('right', self.signal_spectrum_plot_right_label % (self.signal_spectrum_clicks_detector_b, self.logarithmic_scale if max(y) > self.logarithmic_scale_threshold else ""))
+
+        if False:
+            centers = x[:-1] + np.diff(x)[0] / 2
+            norm_y = y / y.sum()
+            norm_y_ma = Series(norm_y).rolling(1, center=True).mean().values * ((max(y) * 20) if max(y) < self.logarithmic_scale_threshold else (max(y)/2))
+            self.histogramplotp_curve_b.setData(centers, norm_y_ma)
+
+        if False:
+            peaks = find_peaks(norm_y_ma, width = 2, distance = 2, threshold = 0.2)[0]
+
+            for i, peak in enumerate(peaks[:5]):
+                if i < len(self.lines_b)-1:
+                    self.lines_b[i].setValue(centers[peak])
+                    self.lines_a[i].setZValue(9999)
+                else:
+                    center_line = pg.InfiniteLine(
+                        pos=centers[peak],
+                        angle=90,
+                        pen='g',
+                        movable=False
+                    )
+                    self.lines_b.append(center_line)
+                    self.signal_spectrum_plot.addItem(center_line)
+
+    def draw_coincidence_spectra(self):
+
+        voltage_range_a = VOLTAGE_RANGES[self.voltage_ranges[2]]
+        voltage_range_b = VOLTAGE_RANGES[self.voltage_ranges[3]]
+
+        # COINCIDENCE SPECTRUM A
+        y, x = self.time_difference_spectrum_data_a.histogram()
+        if self.logarithmic_y_scale == 0 or len(self.time_difference_spectrum_data_a) < 2:
+            self.time_difference_spectrum_plot_a.setData(x, y)
+        else:
+            self.time_difference_spectrum_plot_a.setData(*self.log(x, y, voltage_range_a))
+        #self.time_difference_spectrum_plot.setLabel('left', "Channel A counts (%s)" % len(self.time_difference_spectrum_data_a))
+
+        # COINCIDENCE SPECTRUM B
+        y, x = self.time_difference_spectrum_data_b.histogram()
+        if self.logarithmic_y_scale == 0 or len(self.time_difference_spectrum_data_b) < 2:
+            self.time_difference_spectrum_plot_b.setData(x, y)
+        else:
+            self.time_difference_spectrum_plot_b.setData(*self.log(x, y, voltage_range_b))
+
+        self.time_difference_spectrum_plot.setLabel('right', self.coincidence_count_graph_label % (self.signal_spectrum_clicks_coincidences, self.logarithmic_scale if max(y) > self.logarithmic_scale_threshold else ""))
+
+    def draw_time_difference_histogram(self):
+
+        y, x = self.histogram_data.histogram()
+        if self.logarithmic_y_scale == 0 or len(self.histogram_data) < 2:
+            self.histogramplotp.setData(x, y)
+        else:
+            self.histogramplotp.setData(*self.log(x, y, self.time_window))
+
+        self.histogramplot.setLabel('left', self.coincidence_count_graph_label % (self.signal_spectrum_clicks_coincidences, self.logarithmic_scale if max(y) > self.logarithmic_scale_threshold else ""))
+
+    # Redraw the plots that have new data since the previous frame.
+    def draw_plots(self):
+
+        dirty_plots = self.dirty_plots
+        self.dirty_plots = set()
+
+        if 'signal_spectrum_a' in dirty_plots:
+            self.draw_signal_spectrum_a()
+        if 'signal_spectrum_b' in dirty_plots:
+            self.draw_signal_spectrum_b()
+        if 'signals' in dirty_plots and self.signal and self.signal.update_graph:
+            self.signal.update(coincidence = self.signals_coincidence)
+        if 'coincidence_spectra' in dirty_plots:
+            self.draw_coincidence_spectra()
+        if 'time_difference_histogram' in dirty_plots:
+            self.draw_time_difference_histogram()
+        if 'scatter' in dirty_plots:
+            self.update_time_difference_scatter()
+
+    # INGESTION LOOP
+    # Drain all captures published since the previous tick into the counters and the
+    # accumulators. Ingestion is cheap, so it keeps up with the acquisition even when
+    # the rendering is slower.
+    def _ingest(self):
+
+        if not self.control.get('pause'):
+            captures = self.signal_spectrum_ring.drain()
+            for data, triggers in captures:
+                self._update_signal_spectrum(data, triggers)
+            self.ingested_captures += len(captures)
+            self.ingest_backlog = max(self.ingest_backlog, len(captures))
+
+    # RENDER LOOP
+    # Run by the render timer at the target frame rate.
+    def _render(self):
+
+        if not self.control.get('pause'):
+
+            self.draw_plots()
             # Line graph GUI update - collect data for a second and then come here inside if clause.
             now = tm()
 
@@ -3022,31 +3039,19 @@ class App(QtGui.QMainWindow):
                     for channel, value in enumerate(channels_data):
                         data[channel] += value
 
-                # Remove last value and add new to the start of the stack.
-                for channel in range(3):
-                    self.plot_values[channel].pop(0)
-                    self.plot_values[channel].append(data[channel])
-                    if self.collect_data:
+                # Add the rates of the second to the history, which aggregates the minute and hour levels.
+                self.rate_history.append(data)
+                if self.collect_data:
+                    for channel in range(3):
                         self._save_time_graph_data(map(str, [now - self.collect_start_time, channel, data[channel]]))
 
                 # Reset values.
                 self.channels_pulse_height_value_data = []
                 self.lasttime = now;
 
-                # Forward pointer in the line graph.
-                self.pointer += 1
-
                 self.lineplot.setLabel('bottom', self.timeline_bottom_label % timedelta(seconds = int(round(self.total_experiment_time, 0))))
 
-                # A (SCA C).
-                self.lineplota.setPos(self.pointer, 0)
-                self.lineplota.setData(self.plot_values[0])
-                # B (SCA D).
-                self.lineplotb.setPos(self.pointer, 0)
-                self.lineplotb.setData(self.plot_values[1])
-                # A & B coincidence.
-                self.lineplotc.setPos(self.pointer, 0)
-                self.lineplotc.setData(self.plot_values[2])
+                self.draw_line_graph()
 
                 self.rate_bar_graph.setOpts(height = data)
 
@@ -3100,5 +3105,3 @@ class App(QtGui.QMainWindow):
 
         # Update frames per second label in status bar.
         self._fps()
-        QtCore.QTimer.singleShot(1, self._update)
-        self.counter += 1
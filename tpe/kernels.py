@@ -0,0 +1,130 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+#
+# Compiled detection kernels for the raw pulse detection mode.
+#
+# Kernels are compiled with numba, if it is installed (pip install numba).
+# Otherwise the NumPy implementation in functions.py is used. Both give the
+# same results. Run the benchmark with: python -m tpe.kernels
+
+import numpy as np
+
+try:
+    from numba import njit
+    has_numba = True
+except ImportError:
+    has_numba = False
+
+BACKENDS = ("auto", "numpy", "numba")
+
+# Backend in use. Set from the detection_backend configuration.
+backend = "numpy"
+
+def set_backend(name = "auto"):
+    global backend
+    if name not in BACKENDS:
+        raise ValueError("Detection backend must be one of these: %s." % ", ".join(BACKENDS))
+    if name == "numba" and not has_numba:
+        print("Numba is not installed, using NumPy for the pulse detection.")
+        name = "numpy"
+    elif name == "auto":
+        name = "numba" if has_numba else "numpy"
+    backend = name
+    return backend
+
+def use_kernels():
+    return backend == "numba"
+
+# Single pass over the raw channel. Baseline is subtracted and values inside the low
+# limit are zeroed like in baseline_correction_and_limit. Peaks are the middles of the
+# runs of positive values, which do not touch the ends of the buffer, like find_peaks
+# gives for the boolean signal. Returns count of the peaks from the overlap onwards and
+# the nearest peaks right and left from the centre that are below the high limit.
+def _raw_pulse_candidates(data, mean, low_limit, high_limit, overlap):
+    n = len(data)
+    centre = n / 2
+    count = 0
+    right = -1
+    left = -1
+    run_start = -1
+    for i in range(n):
+        value = data[i] - mean
+        if value < low_limit and value > -low_limit:
+            value = 0.
+        if value > 0:
+            if run_start < 0:
+                run_start = i
+        elif run_start >= 0:
+            if run_start > 0:
+                peak = (run_start + i - 1) // 2
+                if peak >= overlap:
+                    count += 1
+                    height = data[peak] - mean
+                    if height < high_limit:
+                        if peak > centre:
+                            if right < 0:
+                                right = peak
+                        elif peak < centre:
+                            left = peak
+            run_start = -1
+    return count, right, left
+
+if has_numba:
+    raw_pulse_candidates = njit(cache = True, nogil = True)(_raw_pulse_candidates)
+else:
+    raw_pulse_candidates = _raw_pulse_candidates
+
+# Kernel version of select_raw_pulse in functions.py. Mean is taken with NumPy,
+# because its pairwise summation differs from a plain loop in the last bits.
+def select_raw_pulse(data, low_limit, high_limit, overlap = 0):
+    data = np.asarray(data)
+    mean = data.mean()
+    count, right, left = raw_pulse_candidates(data, mean, low_limit, high_limit, overlap)
+    centre = len(data) / 2
+    if right < 0 and left < 0:
+        return count, -1, 0
+    if right < 0 or (left >= 0 and abs(right - centre) <= abs(left - centre)):
+        peak = left
+    else:
+        peak = right
+    return count, peak, data[peak] - mean
+
+# Benchmark and compare the NumPy and the kernel backends with synthetic raw pulses.
+if __name__ == "__main__":
+
+    import sys
+    from time import perf_counter
+    from . import functions, kernels
+
+    rng = np.random.default_rng(19680801)
+    captures = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    samples = int(sys.argv[2]) if len(sys.argv) > 2 else 5000
+
+    buffers = rng.normal(0, 200, (captures, 4, samples)).astype(np.int16)
+    for capture in buffers:
+        for channel in (2, 3):
+            for start in rng.integers(0, samples - 100, rng.integers(0, 5)):
+                capture[channel][start:start + 60] += rng.integers(1000, 20000, dtype = np.int16)
+
+    low_limits = [0, 0, 1024, 1024]
+    high_limits = [32767, 32767, 30000, 30000]
+
+    # Kernels run as pure python without numba, which is slow but shows that the
+    # results are identical.
+    def run(name, count):
+        # Module is run as __main__, so the backend is set to the imported module.
+        kernels.backend = name
+        # First call compiles the kernels.
+        functions.get_max_heights_and_time_differences(buffers[0], low_limits, high_limits, 1)
+        start = perf_counter()
+        results = [functions.get_max_heights_and_time_differences(b, low_limits, high_limits, 1) for b in buffers[:count]]
+        return results, (perf_counter() - start) / count
+
+    count = captures if has_numba else min(captures, 50)
+    reference, numpy_time = run("numpy", count)
+    results, kernel_time = run("numba", count)
+
+    print("Captures: %s Samples: %s" % (count, samples))
+    print("NumPy: %.1f us per capture" % (1e6 * numpy_time))
+    print("%s: %.1f us per capture (%.1fx)" % ("Numba" if has_numba else "Pure python kernels", 1e6 * kernel_time, numpy_time / kernel_time))
+    print("Identical results: %s" % all(repr(a) == repr(b) for a, b in zip(reference, results)))
@@ -7,9 +7,10 @@ from time import sleep
 from datetime import datetime
 from tpe.workers import multi_worker, main_program
 from multiprocessing import Process, Manager, Event
-from tpe.configs import load_config
+from tpe.configs import load_config, raw_filter_settings
 from tpe.arguments import load_args
 from tpe.functions import step2_json_file, step3_json_file
+from tpe.sharedmemory import CaptureRing, ControlBlock
 
 # Add multi process targets to the list
 def add_process(target, name = "", args = None):
@@ -30,9 +31,18 @@ def stop_sub_prosesses():
         process.terminate()
         sleep(.1)
 
+# Release shared memory blocks created by the main program
+def unlink_shared_memory():
+    for shared in shared_memory:
+        shared.unlink()
+    shared_memory.clear()
+
 # Multi threaded process list.
 processes = []
 
+# Shared memory blocks between the processes.
+shared_memory = []
+
 # Main python program executed when run from the console.
 def main():
 
@@ -192,6 +202,15 @@ def main():
             application_configuration["spectrum_time_window"] = args.spectrum_range
             # What is the stack max size of the spectrum histogram?
             application_configuration["spectrum_queue_size"] = args.spectrum_queue_size
+            # How many points the coincidence scatter plot keeps and when it turns into a density image?
+            application_configuration["scatter_queue_size"] = args.scatter_queue_size
+            application_configuration["scatter_density_threshold"] = args.scatter_density_threshold
+            application_configuration["scatter_density_bins"] = config.get("scatter_density_bins", 128)
+            # Pulse rate time line levels.
+            application_configuration["rate_history_levels"] = config.get("rate_history_levels", [[1, 120], [60, 1440], [3600, 720]])
+            # GUI frame rate and how often the published captures are ingested.
+            application_configuration["target_fps"] = args.target_fps
+            application_configuration["ingest_interval"] = config.get("ingest_interval", 10)
             # Main directory where all experiments are stored.
             application_configuration["experiments_dir"] = args.experiments_dir
             # Individual experiment sub directory.
@@ -241,15 +260,25 @@ def main():
 
             application_configuration["store_waveforms"] = args.store_waveforms
             application_configuration["store_waveforms_channels"] = args.store_waveforms_channels
+            application_configuration["waveform_format"] = args.waveform_format
+            application_configuration["waveform_compression"] = args.waveform_compression
             application_configuration["store_statistics"] = args.store_statistics
+            application_configuration["statistics_format"] = args.statistics_format
             application_configuration["execution_time"] = args.execution_time
             application_configuration["pulse_detection_mode"] = args.pulse_detection_mode
+            application_configuration["coincidence_window"] = args.coincidence_window
+            application_configuration["coincidence_window_unit"] = args.coincidence_window_unit
+            application_configuration["coincidence_pairing"] = args.coincidence_pairing
+            application_configuration["pulse_height_pre_samples"] = args.pulse_height_pre_samples
+            application_configuration["pulse_height_post_samples"] = args.pulse_height_post_samples
+            application_configuration["pulse_timing"] = args.pulse_timing
+            application_configuration["cfd_fraction"] = args.cfd_fraction
+            application_configuration["raw_filter"] = dict(config.get("raw_filter", raw_filter_settings), enabled = args.raw_filter)
+            application_configuration["detection_backend"] = args.detection_backend
             application_configuration["detector_geometry"] = args.detector_geometry
             application_configuration["channel_colors"] = args.channel_colors
 
             arguments = [
-                # Share signal spectrum dictionary between processes.
-                "signal_spectrum_acquire_",
                 # Settings tobe shared between processes, app, and scope.
                 # Can be modified in the GUI widget.
                 "settings_acquire_"
@@ -261,20 +290,47 @@ def main():
                 multiprocessing_arguments[key + "event"] = Event()
                 multiprocessing_arguments[key + "value"] = manager.dict()
 
+            # Captures are passed from the worker to the GUI via shared memory rings.
+            multiprocessing_arguments["signal_spectrum_ring"] = CaptureRing(
+                config.get("result_ring_slots", 4096),
+                config.get("waveform_ring_slots", 32),
+                config.get("waveform_ring_samples", 16384),
+                config.get("result_ring_values", 262144)
+            )
+            shared_memory.append(multiprocessing_arguments["signal_spectrum_ring"])
+
+            # Pause, resume, quit, spectrum limits and trigger changes are passed from
+            # the GUI to the worker via versioned control block in shared memory.
+            multiprocessing_arguments["control"] = ControlBlock()
+            shared_memory.append(multiprocessing_arguments["control"])
+
             playback_file = args.playback_file if args.playback_file != None else ""
 
             application_configuration["playback_file"] = playback_file
 
             multiprocessing_arguments["main_process_id"] = os.getpid()
             multiprocessing_arguments["time_window"] = time_window
+            multiprocessing_arguments["timebase_n"] = block_mode_timebase_settings["timebase_n"]
             multiprocessing_arguments["headless_mode"] = application_configuration["headless_mode"]
             multiprocessing_arguments["pulse_source"] = application_configuration["pulse_source"]
             multiprocessing_arguments["chance_rate"] = application_configuration["chance_rate"]
             multiprocessing_arguments["background_rate"] = application_configuration["background_rate"]
             multiprocessing_arguments["store_waveforms"] = application_configuration["store_waveforms"]
             multiprocessing_arguments["store_waveforms_channels"] = application_configuration["store_waveforms_channels"]
+            multiprocessing_arguments["waveform_format"] = application_configuration["waveform_format"]
+            multiprocessing_arguments["waveform_compression"] = application_configuration["waveform_compression"]
             multiprocessing_arguments["store_statistics"] = application_configuration["store_statistics"]
+            multiprocessing_arguments["statistics_format"] = application_configuration["statistics_format"]
             multiprocessing_arguments["pulse_detection_mode"] = application_configuration["pulse_detection_mode"]
+            multiprocessing_arguments["coincidence_window"] = application_configuration["coincidence_window"]
+            multiprocessing_arguments["coincidence_window_unit"] = application_configuration["coincidence_window_unit"]
+            multiprocessing_arguments["coincidence_pairing"] = application_configuration["coincidence_pairing"]
+            multiprocessing_arguments["pulse_height_pre_samples"] = application_configuration["pulse_height_pre_samples"]
+            multiprocessing_arguments["pulse_height_post_samples"] = application_configuration["pulse_height_post_samples"]
+            multiprocessing_arguments["pulse_timing"] = application_configuration["pulse_timing"]
+            multiprocessing_arguments["cfd_fraction"] = application_configuration["cfd_fraction"]
+            multiprocessing_arguments["raw_filter"] = application_configuration["raw_filter"]
+            multiprocessing_arguments["detection_backend"] = application_configuration["detection_backend"]
             multiprocessing_arguments["execution_time"] = application_configuration["execution_time"]
             multiprocessing_arguments["experiments_dir"] = application_configuration["experiments_dir"]
             multiprocessing_arguments["experiment_dir"] = application_configuration["experiment_dir"]
@@ -294,11 +350,22 @@ def main():
                 picoscope_settings["units"] = streaming_mode_settings["units"]
                 picoscope_settings["buffer_size"] = streaming_mode_settings["buffer_size"]
                 picoscope_settings["buffer_count"] = streaming_mode_settings["buffer_count"]
-            elif picoscope_mode == "block":
+                # Tail carried over between the chunks and the ring buffer size in chunks.
+                picoscope_settings["overlap"] = streaming_mode_settings.get("overlap", 128)
+                picoscope_settings["ring_chunks"] = streaming_mode_settings.get("ring_chunks", 16)
+                picoscope_settings["software_trigger"] = streaming_mode_settings.get("software_trigger", {"enabled": 0})
+            elif picoscope_mode == "block" or picoscope_mode == "rapid":
                 # Block mode settings:
                 picoscope_settings["block_mode_trigger_settings"] = block_mode_trigger_settings
                 picoscope_settings["block_mode_timebase_settings"] = block_mode_timebase_settings
                 picoscope_settings["advanced_trigger_settings"] = advanced_trigger_settings
+                picoscope_settings["capture_wait_mode"] = args.capture_wait_mode
+                # Rapid mode uses block mode settings and captures several triggers per run.
+                if picoscope_mode == "rapid":
+                    picoscope_settings["rapid_mode_segments"] = args.rapid_mode_segments
+
+            picoscope_settings["acquisition_queue_size"] = config.get("acquisition_queue_size", 1)
+            picoscope_settings["detection_processes"] = args.detection_processes
 
             # Note, these are settings that MUST be given from the application!
             settings = {
@@ -321,6 +388,14 @@ def main():
             multiprocessing_arguments["settings_acquire_event"].set()
             multiprocessing_arguments["settings_acquire_event"].clear()
 
+            multiprocessing_arguments["control"].write(
+                main_loop = True,
+                pause = False,
+                spectrum_low_limits = settings["spectrum_low_limits"],
+                spectrum_high_limits = settings["spectrum_high_limits"],
+                trigger = block_mode_trigger_settings
+            )
+
             # Save configuration files.
             file_json = os.path.join(args.experiments_dir, experiment_dir, 'application_configuration.json')
             with open(file_json, "w") as file:
@@ -372,3 +447,6 @@ def main():
         # ctrl-q works as a shortcut to quit application from the GUI.
         # Terminate all processes that are stored to the global process list.
         stop_sub_prosesses()
+
+        # Release shared memory after the processes using it have been stopped.
+        unlink_shared_memory()
@@ -0,0 +1,449 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+#
+# Shared memory rings for passing the captures from the data acquisition
+# process to the GUI process without pickling them through the manager.
+
+import numpy as np
+from time import time as tm
+from multiprocessing import shared_memory
+
+# Header fields of the ring: sequence number of the next write, sequence number
+# of the next read and the count of records dropped, because the ring was full.
+WRITE_SEQ = 0
+READ_SEQ = 1
+OVERRUNS = 2
+HEADER_SIZE = 8 * 8
+
+# Attach to shared memory created by another process. Sub processes are started by
+# multiprocessing and share the resource tracker of the creator, thus the creator
+# process is the one that unlinks the memory.
+def attach_shared_memory(name):
+    return shared_memory.SharedMemory(name = name)
+
+# Single producer, single consumer ring of fixed size records in shared memory.
+# Every record has a seq field, which is set to the sequence number of the write.
+# Producer never blocks nor overwrites unread records. If the ring is full, the
+# record is dropped and counted as an overrun. Ring is pickled by the shared memory
+# name, so it can be given to the sub processes as an argument.
+class SharedRing():
+
+    def __init__(self, dtype, capacity, name = None):
+        self.dtype = np.dtype(dtype)
+        self.capacity = capacity
+        self.owner = name is None
+        if self.owner:
+            self.shm = shared_memory.SharedMemory(create = True, size = HEADER_SIZE + self.dtype.itemsize * capacity)
+        else:
+            self.shm = attach_shared_memory(name)
+        self._map()
+        if self.owner:
+            self.header[:] = 0
+
+    def _map(self):
+        self.header = np.ndarray((HEADER_SIZE // 8,), dtype = np.int64, buffer = self.shm.buf)
+        self.slots = np.ndarray((self.capacity,), dtype = self.dtype, buffer = self.shm.buf, offset = HEADER_SIZE)
+        self.reserved = None
+
+    def __getstate__(self):
+        return {"name": self.shm.name, "dtype": self.dtype, "capacity": self.capacity}
+
+    def __setstate__(self, state):
+        self.dtype = state["dtype"]
+        self.capacity = state["capacity"]
+        self.owner = False
+        self.shm = attach_shared_memory(state["name"])
+        self._map()
+
+    # PRODUCER
+
+    # Return the next free slot to be filled in place, or None if the ring is full.
+    def reserve(self):
+        seq = self.header[WRITE_SEQ]
+        if seq - self.header[READ_SEQ] >= self.capacity:
+            self.header[OVERRUNS] += 1
+            self.reserved = None
+            return None
+        self.reserved = self.slots[seq % self.capacity]
+        self.reserved["seq"] = seq
+        return self.reserved
+
+    # Publish the reserved slot. Write sequence number is updated after the record
+    # is complete, so the consumer never sees a partially written record.
+    def commit(self):
+        if self.reserved is not None:
+            self.reserved = None
+            self.header[WRITE_SEQ] += 1
+            return self.header[WRITE_SEQ] - 1
+        return -1
+
+    # Drop the reserved slot, which could not be completed. It is counted as an overrun.
+    def cancel(self):
+        if self.reserved is not None:
+            self.reserved = None
+            self.header[OVERRUNS] += 1
+
+    # CONSUMER
+
+    def pending(self):
+        return int(self.header[WRITE_SEQ] - self.header[READ_SEQ])
+
+    # Copy all unread records and release their slots to the producer.
+    def read(self, limit = None):
+        start = self.header[READ_SEQ]
+        end = self.header[WRITE_SEQ]
+        if limit is not None:
+            end = min(end, start + limit)
+        records = self.slots[np.arange(start, end) % self.capacity].copy()
+        self.header[READ_SEQ] = end
+        return records
+
+    def overruns(self):
+        return int(self.header[OVERRUNS])
+
+    def close(self):
+        self.header = None
+        self.slots = None
+        self.reserved = None
+        self.shm.close()
+
+    def unlink(self):
+        self.close()
+        if self.owner:
+            self.shm.unlink()
+
+# Single producer, single consumer ring of float64 values in shared memory for the
+# variable length lists of the result records. Values of a record are written to
+# consecutive positions, which wrap around the end of the ring, and the record has
+# the position of its first value. Positions only grow, like the sequence numbers.
+class ValueRing():
+
+    def __init__(self, capacity, name = None):
+        self.capacity = capacity
+        self.owner = name is None
+        if self.owner:
+            self.shm = shared_memory.SharedMemory(create = True, size = HEADER_SIZE + 8 * capacity)
+        else:
+            self.shm = attach_shared_memory(name)
+        self._map()
+        if self.owner:
+            self.header[:] = 0
+
+    def _map(self):
+        self.header = np.ndarray((HEADER_SIZE // 8,), dtype = np.int64, buffer = self.shm.buf)
+        self.values = np.ndarray((self.capacity,), dtype = np.float64, buffer = self.shm.buf, offset = HEADER_SIZE)
+
+    def __getstate__(self):
+        return {"name": self.shm.name, "capacity": self.capacity}
+
+    def __setstate__(self, state):
+        self.capacity = state["capacity"]
+        self.owner = False
+        self.shm = attach_shared_memory(state["name"])
+        self._map()
+
+    # PRODUCER
+
+    # Write the values after the committed values and return their position, or
+    # None if the unread values leave no room for them. Values are published with
+    # the result record, that has the position.
+    def write(self, values):
+        position = int(self.header[WRITE_SEQ])
+        if position + len(values) - self.header[READ_SEQ] > self.capacity:
+            return None
+        self.values[(position + np.arange(len(values))) % self.capacity] = values
+        return position
+
+    def commit(self, count):
+        self.header[WRITE_SEQ] += count
+
+    # CONSUMER
+
+    def read(self, position, count):
+        return self.values[(position + np.arange(count)) % self.capacity]
+
+    # Release the values before the position to the producer.
+    def release(self, position):
+        self.header[READ_SEQ] = position
+
+    def close(self):
+        self.header = None
+        self.values = None
+        self.shm.close()
+
+    def unlink(self):
+        self.close()
+        if self.owner:
+            self.shm.unlink()
+
+# Lists of the result record in the order they are stored in the value ring.
+RESULT_VALUES = ("time_differences", "heights_a", "heights_b", "pair_heights_a", "pair_heights_b")
+
+result_dtype = np.dtype([
+    ("seq", np.int64),
+    # Sequence number of the waveform record or -1 if the waveform was not stored.
+    ("waveform_seq", np.int64),
+    ("l1", np.int32),
+    ("l2", np.int32),
+    # -1 when no trigger channel is given.
+    ("trigger_channel", np.int8),
+    # Position of the first value of the record in the value ring and the full
+    # lengths of the lists: time differences, pulse heights and the heights of
+    # the paired pulses, one for each time difference.
+    ("values_start", np.int64),
+    ("n_time_differences", np.int32),
+    ("n_heights_a", np.int32),
+    ("n_heights_b", np.int32),
+    ("n_pair_heights_a", np.int32),
+    ("n_pair_heights_b", np.int32)
+])
+
+def waveform_dtype(samples):
+    return np.dtype([
+        ("seq", np.int64),
+        ("length", np.int32),
+        ("data", np.int16, (4, samples))
+    ])
+
+# Capture ring has separate rings for the compact per capture results and for the
+# waveforms. Results are small, so their ring is long and the GUI can count every
+# capture. Lists of the results go to a value ring, so they are never truncated.
+# Waveforms are large and only needed for the signal plots, so their ring is short
+# and dropping them does not affect the counts.
+class CaptureRing():
+
+    def __init__(self, result_slots = 4096, waveform_slots = 32, waveform_samples = 16384, result_values = 262144):
+        self.results = SharedRing(result_dtype, result_slots)
+        self.values = ValueRing(result_values)
+        self.waveforms = SharedRing(waveform_dtype(waveform_samples), waveform_slots)
+        self.waveform_samples = waveform_samples
+        # Waveforms read by the consumer before their result records.
+        self.pending_waveforms = {}
+
+    # Called by the producer for every capture with pulses. Record has the complete
+    # results of the capture, so the consumer does not need to analyze the waveform.
+    def publish(self, buffers, l1, l2, time_differences, heights_a, heights_b, trigger_channel = None,
+                pair_heights_a = (), pair_heights_b = ()):
+
+        slot = self.results.reserve()
+        if slot is None:
+            return False
+
+        lists = (time_differences, heights_a, heights_b, pair_heights_a, pair_heights_b)
+        flat = np.concatenate([np.asarray(values, dtype = np.float64).ravel() for values in lists])
+        position = self.values.write(flat)
+        # Record without its values is dropped as an overrun of the result ring.
+        if position is None:
+            self.results.cancel()
+            return False
+
+        # Waveform is stored only for the records, which have room in the rings.
+        waveform_seq = -1
+        if buffers is not None:
+            waveform = self.waveforms.reserve()
+            if waveform is not None:
+                length = min(len(buffers[0]), self.waveform_samples)
+                for i, buffer in enumerate(buffers[:4]):
+                    waveform["data"][i][:length] = buffer[:length]
+                waveform["length"] = length
+                waveform_seq = self.waveforms.commit()
+
+        slot["waveform_seq"] = waveform_seq
+        slot["l1"] = l1
+        slot["l2"] = l2
+        slot["trigger_channel"] = -1 if trigger_channel is None else trigger_channel
+        slot["values_start"] = position
+        for key, values in zip(RESULT_VALUES, lists):
+            slot["n_" + key] = len(values)
+        self.values.commit(len(flat))
+        self.results.commit()
+        return True
+
+    # Called by the consumer. Returns all unread captures in order as (buffers, triggers)
+    # tuples, where triggers are: pulse counts, time differences, heights, the trigger
+    # channel and the heights of the paired pulses. Buffers are None, if the waveform
+    # was dropped.
+    def drain(self):
+        waveforms = self.pending_waveforms
+        for record in self.waveforms.read():
+            waveforms[int(record["seq"])] = record
+        captures = []
+        last_waveform_seq = -1
+        records = self.results.read()
+        if len(records) == 0:
+            return captures
+        # Values of the records are consecutive in the value ring, so they are read at once.
+        counts = np.stack([records["n_" + key] for key in RESULT_VALUES], axis = 1).astype(np.int64)
+        start = int(records["values_start"][0])
+        end = int(records["values_start"][-1] + counts[-1].sum())
+        values = self.values.read(start, end - start).tolist()
+        self.values.release(end)
+        for record, record_counts in zip(records, counts.tolist()):
+            if record["waveform_seq"] >= 0:
+                last_waveform_seq = record["waveform_seq"]
+            waveform = waveforms.get(int(record["waveform_seq"]))
+            buffers = None if waveform is None else waveform["data"][:, :waveform["length"]]
+            position = int(record["values_start"]) - start
+            lists = []
+            for count in record_counts:
+                lists.append(values[position:position + count])
+                position += count
+            time_differences, heights_a, heights_b, pair_heights_a, pair_heights_b = lists
+            captures.append((
+                buffers,
+                (
+                    int(record["l1"]),
+                    int(record["l2"]),
+                    time_differences,
+                    heights_a,
+                    heights_b,
+                    None if record["trigger_channel"] < 0 else int(record["trigger_channel"]),
+                    pair_heights_a,
+                    pair_heights_b
+                )
+            ))
+        # Keep the waveforms whose result records have not arrived yet.
+        if last_waveform_seq >= 0:
+            self.pending_waveforms = {seq: record for seq, record in waveforms.items() if seq > last_waveform_seq}
+        return captures
+
+    # Result records waiting for the consumer.
+    def pending(self):
+        return self.results.pending()
+
+    # Dropped results and waveforms.
+    def overruns(self):
+        return self.results.overruns(), self.waveforms.overruns()
+
+    def close(self):
+        self.results.close()
+        self.values.close()
+        self.waveforms.close()
+
+    def unlink(self):
+        self.results.unlink()
+        self.values.unlink()
+        self.waveforms.unlink()
+
+# Control block fields. Version is increased by one before and after the writer
+# changes the fields, so it is odd while a write is in progress.
+control_dtype = np.dtype([
+    ("version", np.int64),
+    # Wall clock time of the latest change.
+    ("changed_time", np.float64),
+    # Version applied by the worker and the time it took from the change to apply it.
+    ("applied_version", np.int64),
+    ("applied_latency", np.float64),
+    ("main_loop", np.int8),
+    ("pause", np.int8),
+    ("spectrum_low_limits", np.int32, (4,)),
+    ("spectrum_high_limits", np.int32, (4,)),
+    ("trigger_enabled", np.int8),
+    ("trigger_channel", np.int8),
+    ("trigger_alternate_channel", np.int8)
+])
+
+# Control block replaces the manager dictionary for the frequent setting changes:
+# pause, resume, quit, spectrum limits and the trigger. The GUI process is the only
+# writer. Workers compare the version once per loop and get only the changed fields.
+# Settings that need the scope to be reinitialized still go through the manager.
+class ControlBlock():
+
+    def __init__(self, name = None):
+        self.owner = name is None
+        if self.owner:
+            self.shm = shared_memory.SharedMemory(create = True, size = control_dtype.itemsize)
+        else:
+            self.shm = attach_shared_memory(name)
+        self._map()
+        if self.owner:
+            self.fields[:] = np.zeros(1, dtype = control_dtype)
+            self.fields["main_loop"] = 1
+
+    def _map(self):
+        self.fields = np.ndarray((1,), dtype = control_dtype, buffer = self.shm.buf)
+        self.version = self.fields["version"]
+        # Version and values the reader has already seen.
+        self.seen_version = -1
+        self.seen = {}
+
+    def __getstate__(self):
+        return {"name": self.shm.name}
+
+    def __setstate__(self, state):
+        self.owner = False
+        self.shm = attach_shared_memory(state["name"])
+        self._map()
+
+    # WRITER
+
+    # Change the given fields. Trigger is given as a dictionary in the same format
+    # as the simple trigger settings.
+    def write(self, **values):
+        fields = self.fields
+        self.version[0] += 1
+        for key, value in values.items():
+            if key == "trigger":
+                fields["trigger_enabled"] = value["enabled"]
+                fields["trigger_channel"] = value["channel"]
+                fields["trigger_alternate_channel"] = value["alternate_channel"]
+            else:
+                fields[key] = value
+        fields["changed_time"] = tm()
+        self.version[0] += 1
+
+    def get(self, key):
+        value = self.fields[key][0]
+        return value.tolist() if key.endswith("limits") else bool(value)
+
+    # Seconds from the latest applied change to the worker applying it.
+    def get_latency(self):
+        return float(self.fields["applied_latency"][0])
+
+    # READER
+
+    def _snapshot(self, record):
+        return {
+            "main_loop": bool(record["main_loop"]),
+            "pause": bool(record["pause"]),
+            "spectrum_low_limits": record["spectrum_low_limits"].tolist(),
+            "spectrum_high_limits": record["spectrum_high_limits"].tolist(),
+            "trigger": {
+                "enabled": int(record["trigger_enabled"]),
+                "channel": int(record["trigger_channel"]),
+                "alternate_channel": bool(record["trigger_alternate_channel"])
+            }
+        }
+
+    # Return the fields changed since the previous call. If the version has not
+    # changed, or the writer is in the middle of a write, nothing is returned and
+    # the change is picked up on the next call.
+    def changes(self):
+        version = self.version[0]
+        if version == self.seen_version or version % 2 == 1:
+            return {}
+        record = self.fields[0].copy()
+        if self.version[0] != version:
+            return {}
+        snapshot = self._snapshot(record)
+        changes = {key: value for key, value in snapshot.items() if self.seen.get(key) != value}
+        self.seen = snapshot
+        self.seen_version = version
+        self.fields["applied_version"] = version
+        self.fields["applied_latency"] = tm() - record["changed_time"]
+        return changes
+
+    # Forget the seen values, so the next call returns all fields.
+    def reset(self):
+        self.seen_version = -1
+        self.seen = {}
+
+    def close(self):
+        self.fields = None
+        self.version = None
+        self.shm.close()
+
+    def unlink(self):
+        self.close()
+        if self.owner:
+            self.shm.unlink()
@@ -0,0 +1,631 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+#
+# Binary event list files.
+#
+# Every stored capture is a fixed size record in the event file, and the pulse
+# heights and the time differences of the capture are records in a side table,
+# which is a second file next to it. Both files start with the same header, which
+# has the hash of the measurement configuration and the length of a capture. A file
+# is continued after a restart only with the same configuration and capture length,
+# otherwise the records go to the next segment file: events.1.tpe, events.2.tpe...
+#
+# Records are collected to blocks in memory and appended to the files a block at a
+# time. Files are read with memory maps, so even long runs are not loaded to memory.
+# Running totals and rates of the old statistics.csv files are not stored, because
+# they can be derived from the records, see statistics_columns.
+#
+# Waveform archive has the same header followed by chunks. Every chunk has a fixed
+# size chunk header with the capture metadata and the int16 samples of the stored
+# channels, which can be delta coded and compressed. File is grown in large steps,
+# and the chunk header is written after the data, so a chunk is only seen after it
+# has been completely written.
+#
+# Playback reader opens both the waveform archives and the old waveform.csv files
+# with a memory map and an index of the capture offsets, which is cached next to the
+# file, so the captures are read one at a time and in any order.
+
+import os, csv, json, hashlib, zlib, mmap
+import numpy as np
+from threading import Thread
+from queue import Queue, Empty, Full
+from time import time as tm
+
+try:
+    import lz4.frame
+    has_lz4 = True
+except ImportError:
+    has_lz4 = False
+
+EVENT_FILE_MAGIC = b"TPEEVNT1"
+WAVEFORM_FILE_MAGIC = b"TPEWAVE1"
+EVENT_FILE_VERSION = 2
+
+# Channels of the pulse records.
+PULSE_A = 0
+PULSE_B = 1
+TIME_DIFFERENCE = 2
+
+header_dtype = np.dtype([
+    ("magic", "S8"),
+    ("version", "<u4"),
+    ("record_size", "<u4"),
+    ("created", "<f8"),
+    # Length of one capture in seconds.
+    ("buffer_length", "<f8"),
+    ("configuration_hash", "S40"),
+    ("reserved", "S56")
+])
+
+capture_dtype = np.dtype([
+    # Capture number since the start of the measurement.
+    ("capture", "<u8"),
+    ("time", "<f8"),
+    # Seconds from the start of the measurement without the breaks between the sessions.
+    ("elapsed", "<f8"),
+    # Channel of the capture, Chn of statistics.csv, or -1.
+    ("capture_channel", "i1"),
+    ("count_a", "<u4"),
+    ("count_b", "<u4"),
+    ("coincidences", "<u4"),
+    # Pulse records of the capture in the side table.
+    ("pulse_start", "<u8"),
+    ("pulse_count", "<u4")
+])
+
+pulse_dtype = np.dtype([
+    # PULSE_A, PULSE_B or TIME_DIFFERENCE.
+    ("channel", "i1"),
+    # Sample index of the pulse in the capture, in the stream for the software trigger, or -1.
+    ("sample", "<i8"),
+    # Pulse height or time difference.
+    ("value", "<f4")
+])
+
+def pulse_file(path):
+    return path + ".pulses"
+
+# Hash of the settings the events were measured with, for example the picoscope
+# settings and the pulse detection arguments.
+def configuration_hash(configuration):
+    return hashlib.sha1(json.dumps(configuration, sort_keys = True, default = str).encode()).hexdigest()
+
+def read_header(path, magic = EVENT_FILE_MAGIC):
+    header = np.fromfile(path, dtype = header_dtype, count = 1)
+    if len(header) < 1 or header["magic"][0] != magic:
+        raise ValueError("Not an %s file: %s" % ("event" if magic == EVENT_FILE_MAGIC else "waveform", path))
+    return header[0]
+
+def write_header(path, dtype, configuration_hash = "", buffer_length = 0., created = None, magic = EVENT_FILE_MAGIC):
+    header = np.zeros(1, dtype = header_dtype)
+    header["magic"] = magic
+    header["version"] = EVENT_FILE_VERSION
+    header["record_size"] = dtype.itemsize
+    header["created"] = tm() if created is None else created
+    header["buffer_length"] = buffer_length
+    header["configuration_hash"] = configuration_hash.encode()
+    with open(path, "wb") as f:
+        f.write(header.tobytes())
+
+# Records in the file, a partly written record at the end is left out.
+def record_count(path, dtype):
+    return (os.path.getsize(path) - header_dtype.itemsize) // dtype.itemsize
+
+# Path of the n:th segment of the file, events.tpe, events.1.tpe, events.2.tpe...
+def segment_file(path, n):
+    if n == 0:
+        return path
+    root, extension = os.path.splitext(path)
+    return "%s.%s%s" % (root, n, extension)
+
+# First segment, which is new or has the same configuration and capture length.
+def file_segment(path, configuration_hash = "", buffer_length = 0., magic = EVENT_FILE_MAGIC):
+    n = 0
+    while True:
+        segment = segment_file(path, n)
+        if not os.path.isfile(segment) or os.path.getsize(segment) < header_dtype.itemsize:
+            return segment
+        header = read_header(segment, magic)
+        if header["configuration_hash"].decode() == configuration_hash and float(header["buffer_length"]) == buffer_length:
+            return segment
+        n += 1
+
+class EventWriter():
+
+    # Existing file of the same configuration is appended, so a measurement can be
+    # continued after a restart. Created is the start time of the session, and the
+    # elapsed time is continued from the last capture of the file. Capture numbers
+    # are continued by the caller from the last_capture.
+    def __init__(self, path, configuration_hash = "", buffer_length = 0., created = None,
+                 block_size = 4096, flush_interval = 10.):
+        path = file_segment(path, configuration_hash, buffer_length)
+        self.path = path
+        self.flush_interval = flush_interval
+        for file, dtype in ((path, capture_dtype), (pulse_file(path), pulse_dtype)):
+            if os.path.isfile(file) and os.path.getsize(file) >= header_dtype.itemsize:
+                read_header(file)
+                # Drop a partly written record, for example after a power cut.
+                os.truncate(file, header_dtype.itemsize + record_count(file, dtype) * dtype.itemsize)
+            else:
+                write_header(file, dtype, configuration_hash, buffer_length, created)
+        self.header = read_header(path)
+        self.session_start = tm() if created is None else created
+        self.last_capture = 0
+        self.elapsed_offset = 0.
+        count = record_count(path, capture_dtype)
+        if count > 0:
+            last = np.fromfile(path, dtype = capture_dtype, count = 1,
+                               offset = header_dtype.itemsize + (count - 1) * capture_dtype.itemsize)[0]
+            self.last_capture = int(last["capture"])
+            self.elapsed_offset = float(last["elapsed"])
+        self.pulse_offset = record_count(pulse_file(path), pulse_dtype)
+        self.captures = np.zeros(block_size, dtype = capture_dtype)
+        self.pulses = np.zeros(block_size * 8, dtype = pulse_dtype)
+        self.n_captures = 0
+        self.n_pulses = 0
+        self.capture_stream = open(path, "ab")
+        self.pulse_stream = open(pulse_file(path), "ab")
+        self.last_flush = tm()
+
+    def _pulses(self, channel, values, samples):
+        n = len(values)
+        pulses = self.pulses[self.n_pulses:self.n_pulses + n]
+        pulses["channel"] = channel
+        pulses["value"] = values
+        pulses["sample"] = -1
+        samples = samples[:n]
+        pulses["sample"][:len(samples)] = samples
+        self.n_pulses += n
+
+    # Coincidences are the count of the time differences, unless given.
+    def append(self, capture, time, capture_channel, count_a, count_b, time_differences,
+               heights_a, heights_b, indexes_a = (), indexes_b = (), coincidences = None):
+        n = len(heights_a) + len(heights_b) + len(time_differences)
+        if self.n_captures == len(self.captures) or self.n_pulses + n > len(self.pulses):
+            self.flush()
+        if n > len(self.pulses):
+            self.pulses = np.zeros(n, dtype = pulse_dtype)
+        record = self.captures[self.n_captures]
+        record["capture"] = capture
+        record["time"] = time
+        record["elapsed"] = self.elapsed_offset + time - self.session_start
+        record["capture_channel"] = -1 if capture_channel is None else capture_channel
+        record["count_a"] = count_a
+        record["count_b"] = count_b
+        record["coincidences"] = len(time_differences) if coincidences is None else coincidences
+        record["pulse_start"] = self.pulse_offset + self.n_pulses
+        record["pulse_count"] = n
+        self.n_captures += 1
+        self._pulses(PULSE_A, heights_a, indexes_a)
+        self._pulses(PULSE_B, heights_b, indexes_b)
+        self._pulses(TIME_DIFFERENCE, time_differences, ())
+        if time - self.last_flush > self.flush_interval:
+            self.flush()
+
+    # Append the collected blocks to the files. Pulses are written first, so the
+    # captures in the file never refer to missing pulses.
+    def flush(self):
+        self.pulse_stream.write(self.pulses[:self.n_pulses].tobytes())
+        self.pulse_stream.flush()
+        self.capture_stream.write(self.captures[:self.n_captures].tobytes())
+        self.capture_stream.flush()
+        self.pulse_offset += self.n_pulses
+        self.n_captures = 0
+        self.n_pulses = 0
+        self.last_flush = tm()
+
+    def close(self):
+        self.flush()
+        self.capture_stream.close()
+        self.pulse_stream.close()
+
+def _memmap(path, dtype):
+    count = record_count(path, dtype)
+    if count < 1:
+        return np.zeros(0, dtype = dtype)
+    return np.memmap(path, dtype = dtype, mode = "r", offset = header_dtype.itemsize, shape = (count,))
+
+# Memory mapped event file. Captures and pulses are structured arrays.
+class EventFile():
+
+    def __init__(self, path):
+        self.path = path
+        self.header = read_header(path)
+        self.configuration_hash = self.header["configuration_hash"].decode()
+        self.buffer_length = float(self.header["buffer_length"])
+        self.captures = _memmap(path, capture_dtype)
+        self.pulses = _memmap(pulse_file(path), pulse_dtype)
+
+    def __len__(self):
+        return len(self.captures)
+
+    # Pulse records of the capture.
+    def capture_pulses(self, i):
+        start = int(self.captures["pulse_start"][i])
+        return self.pulses[start:start + int(self.captures["pulse_count"][i])]
+
+    # Index of the capture of every pulse record.
+    def pulse_captures(self):
+        captures = np.full(len(self.pulses), -1, dtype = np.int64)
+        counts = self.captures["pulse_count"].astype(np.int64)
+        starts = self.captures["pulse_start"].astype(np.int64)
+        # Running number of the pulse over the captures plus the gap to its start in the side table.
+        gaps = starts - (np.cumsum(counts) - counts)
+        captures[np.repeat(gaps, counts) + np.arange(counts.sum())] = np.repeat(np.arange(len(self.captures)), counts)
+        return captures
+
+    # Heights of the channel or the time differences of all captures.
+    def values(self, channel):
+        return np.asarray(self.pulses["value"][self.pulses["channel"] == channel])
+
+# Columns of the old statistics.csv format. Running totals and rates are taken over
+# the stored captures, so they match the csv file, when every capture was stored.
+def statistics_columns(events):
+    captures = events.captures
+    n = len(captures)
+    capture = captures["capture"].astype(np.int64)
+    time = captures["time"].astype(np.float64)
+    elapsed = captures["elapsed"].astype(np.float64)
+    count_a = captures["count_a"].astype(np.int64)
+    count_b = captures["count_b"].astype(np.int64)
+    coincidences = captures["coincidences"].astype(np.int64)
+    total_a = np.cumsum(count_a)
+    total_b = np.cumsum(count_b)
+    total_coincidences = np.cumsum(coincidences)
+    sample_size = events.buffer_length * capture
+    with np.errstate(divide = "ignore", invalid = "ignore"):
+        rate_a = total_a / sample_size
+        rate_b = total_b / sample_size
+        elapsed_rate = total_coincidences / elapsed
+        sample_rate = total_coincidences / sample_size
+    # First time difference and the highest pulses of every capture.
+    pulse_captures = events.pulse_captures()
+    first = {}
+    for channel in (PULSE_A, PULSE_B, TIME_DIFFERENCE):
+        first[channel] = np.full(n, np.nan)
+        selected = (events.pulses["channel"] == channel) & (pulse_captures >= 0)
+        if channel == TIME_DIFFERENCE:
+            # Records of a capture are in order, so the last write of reversed records is the first one.
+            first[channel][pulse_captures[selected][::-1]] = events.pulses["value"][selected][::-1]
+        else:
+            np.fmax.at(first[channel], pulse_captures[selected], events.pulses["value"][selected])
+    return {
+        "RateCount": capture,
+        "Time": time,
+        "Elapsed": elapsed,
+        "A": count_a,
+        "B": count_b,
+        "TotA": total_a,
+        "TotB": total_b,
+        "RateA": rate_a,
+        "RateB": rate_b,
+        "Cnc": coincidences,
+        "TotCnc": total_coincidences,
+        "ElapsedCncRate": elapsed_rate,
+        "SampleCncRate": sample_rate,
+        "TimeDifference": first[TIME_DIFFERENCE],
+        "APulseHeight": first[PULSE_A],
+        "BPulseHeight": first[PULSE_B],
+        "SampleSize": sample_size,
+        "Chn": captures["capture_channel"].astype(np.int64)
+    }
+
+# Convert an old statistics.csv file to an event file. Csv rows have only the first
+# time difference and the highest pulses, so the event file has the same. Capture
+# numbers of the csv file start from one after every restart, and the sessions are
+# continued in the event file like the restarts of the measurement.
+def convert_statistics_csv(csv_path, path, configuration_hash = ""):
+    writer = None
+    last_capture = 0
+    capture_offset = 0
+    buffer_length = 0.
+    with open(csv_path, newline = "") as f:
+        for row in csv.reader(f, delimiter = ";"):
+            if len(row) < 18:
+                continue
+            capture, time, elapsed, count_a, count_b = int(row[0]), float(row[1]), float(row[2]), int(row[3]), int(row[4])
+            if writer is not None and capture <= last_capture:
+                writer.close()
+                writer = None
+            last_capture = capture
+            if writer is None:
+                if capture_offset == 0 and capture > 0:
+                    buffer_length = float(row[16]) / capture
+                writer = EventWriter(path, configuration_hash, buffer_length, time - elapsed)
+                capture_offset = writer.last_capture
+            writer.append(
+                capture_offset + capture,
+                time,
+                None if row[17] in ("", "None") else int(row[17]),
+                count_a,
+                count_b,
+                [float(row[13])] if row[13] != "" and int(row[9]) > 0 else [],
+                [float(row[14])] if row[14] != "" and count_a > 0 else [],
+                [float(row[15])] if row[15] != "" and count_b > 0 else [],
+                coincidences = int(row[9])
+            )
+    if writer is not None:
+        writer.close()
+    return writer is not None
+
+# Chunk header of the waveform archive.
+CHUNK_SYNC = 0x4B4E4843
+
+COMPRESSIONS = {"none": 0, "zlib": 1, "lz4": 2}
+
+chunk_dtype = np.dtype([
+    # CHUNK_SYNC in every written chunk, zero in the preallocated space.
+    ("sync", "<u4"),
+    ("capture", "<u8"),
+    ("time", "<f8"),
+    # Channel that triggered the capture or -1.
+    ("trigger_channel", "i1"),
+    # Bit i is set, if the channel i is stored.
+    ("channel_mask", "u1"),
+    ("compression", "u1"),
+    ("samples", "<u4"),
+    # Bytes of the chunk data after the chunk header.
+    ("size", "<u4")
+])
+
+# Mask of the channels from the channel letters, for example ABCD.
+def channel_mask(channels):
+    return sum(1 << i for i, channel in enumerate("ABCD") if channel in channels)
+
+def mask_channels(mask):
+    return [i for i in range(8) if mask & (1 << i)]
+
+# Samples of the channels are coded as the differences of the consecutive samples,
+# which wrap around in int16 and are restored exactly with a cumulative sum.
+def encode_chunk(data, compression):
+    if compression == 0:
+        return data.tobytes()
+    delta = np.empty_like(data)
+    delta[:, :1] = data[:, :1]
+    np.subtract(data[:, 1:], data[:, :-1], out = delta[:, 1:])
+    if compression == 2:
+        return lz4.frame.compress(delta.tobytes())
+    return zlib.compress(delta.tobytes(), 1)
+
+def decode_chunk(payload, compression, channels, samples):
+    if compression == 0:
+        return np.frombuffer(payload, dtype = np.int16).reshape(channels, samples)
+    if compression == 2:
+        payload = lz4.frame.decompress(payload)
+    else:
+        payload = zlib.decompress(payload)
+    delta = np.frombuffer(payload, dtype = np.int16).reshape(channels, samples)
+    return np.cumsum(delta, axis = 1, dtype = np.int16)
+
+# Offsets and times of the complete chunks of the waveform archive and the end of the last one.
+def chunk_index(path):
+    offsets = []
+    times = []
+    size = os.path.getsize(path)
+    offset = header_dtype.itemsize
+    with open(path, "rb") as f:
+        while offset + chunk_dtype.itemsize <= size:
+            f.seek(offset)
+            chunk = np.frombuffer(f.read(chunk_dtype.itemsize), dtype = chunk_dtype)[0]
+            end = offset + chunk_dtype.itemsize + int(chunk["size"])
+            if chunk["sync"] != CHUNK_SYNC or end > size:
+                break
+            offsets.append(offset)
+            times.append(float(chunk["time"]))
+            offset = end
+    return offsets, times, offset
+
+def chunk_offsets(path):
+    offsets, times, end = chunk_index(path)
+    return offsets, end
+
+class WaveformWriter():
+
+    # Existing archive of the same configuration is appended after its last complete
+    # chunk, other configurations go to the next segment like the event files.
+    def __init__(self, path, compression = "zlib", configuration_hash = "", buffer_length = 0., created = None,
+                 growth = 64 * 1024 * 1024):
+        path = file_segment(path, configuration_hash, buffer_length, WAVEFORM_FILE_MAGIC)
+        self.path = path
+        self.compression = COMPRESSIONS[compression if compression != "lz4" or has_lz4 else "zlib"]
+        self.growth = growth
+        if os.path.isfile(path) and os.path.getsize(path) >= header_dtype.itemsize:
+            read_header(path, WAVEFORM_FILE_MAGIC)
+        else:
+            write_header(path, chunk_dtype, configuration_hash, buffer_length, created, WAVEFORM_FILE_MAGIC)
+        offsets, self.end = chunk_offsets(path)
+        self.last_capture = 0
+        if len(offsets) > 0:
+            self.last_capture = int(np.fromfile(path, dtype = chunk_dtype, count = 1, offset = offsets[-1])[0]["capture"])
+        self.allocated = os.path.getsize(path)
+        self.file = open(path, "r+b")
+
+    # Grow the file in large steps instead of for every chunk.
+    def _reserve(self, size):
+        if self.end + size > self.allocated:
+            self.allocated = self.end + size + self.growth
+            self.file.truncate(self.allocated)
+
+    # Data has the samples of the channels in the mask as rows.
+    def write(self, capture, time, trigger_channel, data, mask):
+        data = np.ascontiguousarray(data, dtype = np.int16)
+        payload = encode_chunk(data, self.compression)
+        chunk = np.zeros(1, dtype = chunk_dtype)
+        chunk["sync"] = CHUNK_SYNC
+        chunk["capture"] = capture
+        chunk["time"] = time
+        chunk["trigger_channel"] = -1 if trigger_channel is None else trigger_channel
+        chunk["channel_mask"] = mask
+        chunk["compression"] = self.compression
+        chunk["samples"] = data.shape[1]
+        chunk["size"] = len(payload)
+        self._reserve(chunk_dtype.itemsize + len(payload))
+        self.file.seek(self.end + chunk_dtype.itemsize)
+        self.file.write(payload)
+        self.file.seek(self.end)
+        self.file.write(chunk.tobytes())
+        self.end += chunk_dtype.itemsize + len(payload)
+
+    def flush(self):
+        self.file.flush()
+
+    # Preallocated space after the last chunk is removed.
+    def close(self):
+        self.file.truncate(self.end)
+        self.file.close()
+
+# Writes the waveforms in its own thread, so compression and file writes are not done
+# in the acquisition loop. Waveforms are dropped, if the thread can not keep up.
+class WaveformArchiveThread(Thread):
+
+    def __init__(self, writer, queue_size = 64):
+        Thread.__init__(self, daemon = True)
+        self.writer = writer
+        self.queue = Queue(maxsize = queue_size)
+        self.running = True
+        self.dropped = 0
+        self.error = None
+
+    # Channels of the mask are copied, because the capture buffers are reused. Nothing
+    # is stored without channels, and waveforms are dropped after a write error.
+    def put(self, capture, time, trigger_channel, buffers, mask):
+        channels = mask_channels(mask)
+        if len(channels) == 0:
+            return
+        if self.error is not None:
+            self.dropped += 1
+            return
+        data = np.array([buffers[i] for i in channels], dtype = np.int16)
+        try:
+            self.queue.put_nowait((capture, time, trigger_channel, data, mask))
+        except Full:
+            self.dropped += 1
+
+    def run(self):
+        try:
+            while self.running or not self.queue.empty():
+                try:
+                    item = self.queue.get(timeout = 0.1)
+                except Empty:
+                    continue
+                self.writer.write(*item)
+        except Exception as e:
+            self.error = e
+            # Failed and still queued waveforms are not written.
+            self.dropped += 1 + self.queue.qsize()
+        finally:
+            self.writer.close()
+
+    # Queued waveforms are written before the archive is closed.
+    def stop(self):
+        self.running = False
+        self.join()
+
+# Index of the captures of a playback file. Cache is used while the size and the
+# modification time of the file are the same as when the index was built.
+def playback_index_file(path):
+    return path + ".index"
+
+# Offsets of the capture starts in a waveform.csv file. Every capture starts with
+# the row of the channel 0, so the file is scanned for the lines starting with "0;".
+def csv_capture_offsets(data, block_size = 64 * 1024 * 1024):
+    offsets = [np.zeros(1, dtype = np.int64)] if data[:2] == b"0;" else []
+    for start in range(0, len(data), block_size):
+        block = np.frombuffer(data[start:start + block_size + 2], dtype = np.uint8)
+        lines = np.flatnonzero((block[:-2] == ord("\n")) & (block[1:-1] == ord("0")) & (block[2:] == ord(";")))
+        offsets.append(start + lines[lines < block_size] + 1)
+    return np.concatenate(offsets) if offsets else np.zeros(0, dtype = np.int64)
+
+def load_playback_index(path):
+    stat = os.stat(path)
+    try:
+        with np.load(playback_index_file(path)) as index:
+            if int(index["size"]) == stat.st_size and int(index["mtime"]) == stat.st_mtime_ns:
+                return index["offsets"], index["times"], int(index["end"])
+    except (OSError, KeyError, ValueError):
+        pass
+    return None
+
+def save_playback_index(path, offsets, times, end):
+    stat = os.stat(path)
+    try:
+        with open(playback_index_file(path), "wb") as f:
+            np.savez(f, size = stat.st_size, mtime = stat.st_mtime_ns, offsets = offsets, times = times, end = end)
+    except OSError:
+        # Index is only a cache, the file is indexed again on the next open.
+        pass
+
+# Captures of a playback file as int16 arrays with a row per channel. Archive chunks
+# without compression are views to the memory map, other chunks and csv rows are
+# decoded when the capture is read. Times are known for the archives only.
+class PlaybackReader():
+
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, "rb")
+        self.data = mmap.mmap(self.file.fileno(), 0, access = mmap.ACCESS_READ)
+        self.archive = self.data[:len(WAVEFORM_FILE_MAGIC)] == WAVEFORM_FILE_MAGIC
+        index = load_playback_index(path)
+        if index is None:
+            if self.archive:
+                offsets, times, end = chunk_index(path)
+            else:
+                offsets = csv_capture_offsets(self.data)
+                times, end = np.full(len(offsets), np.nan), len(self.data)
+            index = (np.asarray(offsets, dtype = np.int64), np.asarray(times, dtype = np.float64), end)
+            save_playback_index(path, *index)
+        self.offsets, self.times, self.end = index
+        if len(self.offsets) < 1:
+            self.close()
+            raise ValueError("No captures in the playback file: %s" % path)
+        self.position = 0
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def _range(self, i):
+        return int(self.offsets[i]), int(self.offsets[i + 1]) if i + 1 < len(self.offsets) else self.end
+
+    # Stored rows of the capture and the channels of the rows.
+    def capture(self, i):
+        start, end = self._range(i)
+        if self.archive:
+            chunk = np.frombuffer(self.data[start:start + chunk_dtype.itemsize], dtype = chunk_dtype)[0]
+            channels = mask_channels(int(chunk["channel_mask"]))
+            payload = memoryview(self.data)[start + chunk_dtype.itemsize:end]
+            return decode_chunk(payload, int(chunk["compression"]), len(channels), int(chunk["samples"])), channels
+        rows = [np.fromstring(line.decode(), dtype = np.int64, sep = ";")[1:] for line in self.data[start:end].splitlines() if line.strip()]
+        return np.array(rows, dtype = np.int16), list(range(len(rows)))
+
+    # Rows of the channels A-D in the same order as the capture buffers of the scope.
+    # Channels that were not stored are zeros.
+    def buffers(self, i, channel_count = 4):
+        data, channels = self.capture(i)
+        buffers = [np.zeros(data.shape[1], dtype = np.int16) for channel in range(channel_count)]
+        for row, channel in zip(data, channels):
+            if channel < channel_count:
+                buffers[channel] = row
+        return buffers
+
+    def seek(self, i):
+        self.position = i % len(self.offsets)
+
+    # Seek to the first capture at or after the time.
+    def seek_time(self, time):
+        if np.isnan(self.times).all():
+            raise ValueError("No capture times in the playback file: %s" % self.path)
+        self.seek(min(int(np.searchsorted(self.times, time)), len(self.offsets) - 1))
+
+    # Buffers of the next capture. Playback starts again from the first capture after the last one.
+    def next(self):
+        buffers = self.buffers(self.position)
+        self.seek(self.position + 1)
+        return buffers
+
+    # Memory map is released with the last capture view, if views are still in use.
+    def close(self):
+        try:
+            self.data.close()
+        except BufferError:
+            pass
+        self.file.close()
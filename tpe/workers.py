@@ -9,15 +9,25 @@ import sys, os, signal
 os.environ["FOR_DISABLE_CONSOLE_CTRL_HANDLER"] = "1"
 
 from datetime import datetime
+from threading import Thread
+from itertools import repeat
+from queue import Queue, Empty, Full
 from random import randint as random, uniform
 from pyqtgraph.Qt import QtGui
-from time import sleep, time as tm
+from time import sleep, time as tm, perf_counter
 from . gui import App
 from . functions import baseline_correction_and_limit, \
                         raising_edges_for_raw_pulses, \
                         raising_edges_for_square_pulses, \
                         get_max_heights_and_time_differences, \
-                        load_buffers, write_buffers
+                        get_max_heights_and_time_differences_batch, \
+                        split_batch_results, \
+                        extract_events, \
+                        write_buffers
+from . detection import DetectionPool
+from . dsp import create_raw_filters
+from . storage import EventWriter, WaveformWriter, WaveformArchiveThread, PlaybackReader, configuration_hash, channel_mask
+from . import kernels
 
 # For nicer console output.
 import colorama
@@ -26,37 +36,106 @@ colorama.init()
 # Make random number more random with the seed.
 np.random.seed(19680801)
 
+# Coincidence window of zero means the whole buffer.
+def get_coincidence_window(arguments):
+    window = arguments.get("coincidence_window_samples", arguments["coincidence_window"])
+    return window if window > 0 else None
+
+# Sample interval of the block and rapid mode timebase in seconds.
+def get_timebase_sample_interval(timebase_n):
+    return 2 / 500000000 if timebase_n == 2 else (timebase_n - 2) / 125000000
+
+# Coincidence window given in nanoseconds is converted to samples with the sample
+# interval of the captures in seconds, when the timebase is known.
+def set_coincidence_window_samples(arguments, sample_interval):
+    window = arguments["coincidence_window"]
+    if arguments.get("coincidence_window_unit", "samples") == "ns" and window > 0:
+        window = max(1, int(round(window * 1e-9 / sample_interval)))
+    arguments["coincidence_window_samples"] = window
+
+# Raw channel window around the SCA edge for the pulse heights.
+def get_height_window(arguments):
+    return (arguments["pulse_height_pre_samples"], arguments["pulse_height_post_samples"])
+
 def process_buffers(buffers, settings, arguments, trigger_channel,
-                    signal_spectrum_acquire_value, signal_spectrum_acquire_event):
+                    signal_spectrum_ring, overlap = 0, detection = None, filters = None):
 
-    l1, l2, m1, m2, pulse_heights, time_differences = \
-        get_max_heights_and_time_differences(
+    # Detection may have been done already by the detection pool.
+    if detection is None:
+        detection = get_max_heights_and_time_differences(
             buffers,
             settings["spectrum_low_limits"],
             settings["spectrum_high_limits"],
-            arguments["pulse_detection_mode"]
+            arguments["pulse_detection_mode"],
+            overlap,
+            get_coincidence_window(arguments),
+            arguments["coincidence_pairing"] == "nearest",
+            get_height_window(arguments),
+            arguments["pulse_timing"],
+            arguments["cfd_fraction"],
+            filters
         )
+    l1, l2, heights_a, heights_b, pulse_heights, time_differences, indexes_a, indexes_b, \
+        pair_heights_a, pair_heights_b = detection
     # Auto trigger setting forces trigger to release in Picoscope after certain amount of time,
     # if there was no activity, and PS will try again.
     # Thus, data may be empty and it will be unnecessary to send it to GUI.
     if (l1 > 0 or l2 > 0) and not arguments["headless_mode"]:
         # Pass raw signal data without any correction and limits to the plotter and
-        # spectrum. Actually, the time difference part can also be moved to the GUI
-        # multi processing thread so that this part of the retrieving data from picoscope
-        # is as simple and streamlined as possible.
-        signal_spectrum_acquire_value["value"] = (
+        # spectrum. Every capture is queued to the shared memory ring, so the GUI gets
+        # all of them even if several captures arrive between the GUI frames.
+        signal_spectrum_ring.publish(
             buffers,
-            (l1, l2, time_differences,
-                #[bcl[2][i] for i in a1],
-                #[bcl[3][i] for i in a2],
-                [m1] if l1 > 0 else [],
-                [m2] if l2 > 0 else [],
-                trigger_channel
-            )
+            l1, l2, time_differences,
+            heights_a,
+            heights_b,
+            trigger_channel,
+            pair_heights_a,
+            pair_heights_b
         )
-        signal_spectrum_acquire_event.set()
 
-    return (l1, l2, time_differences, pulse_heights)
+    # Heights and indexes of all pulses are returned for the event file.
+    return (l1, l2, time_differences, pulse_heights, (heights_a, heights_b, indexes_a, indexes_b))
+
+# Process a streamed chunk with the software trigger. Only the event records with
+# the raw pulse windows are kept, so the chunk buffers can be reused right away.
+def process_events(buffers, settings, arguments, overlap, chunk_start, trigger_settings,
+                   signal_spectrum_ring):
+
+    events, l1, l2, time_differences, pair_heights = extract_events(
+        buffers,
+        overlap,
+        chunk_start,
+        trigger_settings["pre_trigger_samples"],
+        trigger_settings["post_trigger_samples"],
+        trigger_settings["threshold"],
+        trigger_settings["coincidence_window"]
+    )
+
+    time_differences = time_differences.tolist()
+    heights_a = events["height"][events["channel"] == 0].tolist()
+    heights_b = events["height"][events["channel"] == 1].tolist()
+
+    pulse_heights = [(
+        heights_a[-1] if len(heights_a) > 0 else 0,
+        heights_b[-1] if len(heights_b) > 0 else 0
+    )]
+
+    if len(events) > 0 and not arguments["headless_mode"]:
+        # Only the window around the latest event is sent to the plotter.
+        edge = events["sample"][-1] - chunk_start
+        start = edge - trigger_settings["pre_trigger_samples"]
+        end = edge + trigger_settings["post_trigger_samples"]
+        signal_spectrum_ring.publish(
+            [buffer[start:end] for buffer in buffers],
+            len(heights_a), len(heights_b), time_differences,
+            heights_a,
+            heights_b,
+            None,
+            *pair_heights
+        )
+
+    return (l1, l2, time_differences, pulse_heights, events)
 
 def __process_buffers(buffers, settings, arguments, trigger_channel,
                     signal_spectrum_acquire_value, signal_spectrum_acquire_event):
@@ -126,6 +205,18 @@ def __process_buffers(buffers, settings, arguments, trigger_channel,
 
     return (l1, l2, time_differences, pulse_heights)
 
+# Apply the changed fields of the shared memory control block to the worker settings.
+# Checking for changes is a single version compare, so this is called on every loop.
+def apply_control_changes(control, settings):
+    changes = control.changes()
+    for key in ("pause", "spectrum_low_limits", "spectrum_high_limits"):
+        if key in changes:
+            settings[key] = changes[key]
+    if "main_loop" in changes and not changes["main_loop"]:
+        settings["main_loop"] = False
+        settings["sub_loop"] = False
+    return changes
+
 # Simulator worker for pulse rate meter, channel line graph,
 # time difference and detector spectrum histograms.
 def simulator_worker(arguments, verbose):
@@ -136,10 +227,11 @@ def simulator_worker(arguments, verbose):
     settings_acquire_event = arguments["settings_acquire_event"]
     settings_acquire_value = arguments["settings_acquire_value"]
 
-    signal_spectrum_acquire_event = arguments["signal_spectrum_acquire_event"]
-    signal_spectrum_acquire_value = arguments["signal_spectrum_acquire_value"]
+    signal_spectrum_ring = arguments["signal_spectrum_ring"]
+    control = arguments["control"]
 
     settings = settings_acquire_value["value"]
+    apply_control_changes(control, settings)
 
     start_time = tm()
 
@@ -169,15 +261,13 @@ def simulator_worker(arguments, verbose):
                 # spectrum. Actually, the time difference part can also be moved to the GUI
                 # multi processing thread so that this part of the retrieving data from picoscope
                 # is as simple and streamlined as possible.
-                signal_spectrum_acquire_value["value"] = (
+                signal_spectrum_ring.publish(
                     buffers,
-                    (l1, l2, time_differences,
-                        [m1] if l1 > 0 else [],
-                        [m2] if l2 > 0 else [],
-                        trigger_channel
-                    )
+                    l1, l2, time_differences,
+                    [m1] if l1 > 0 else [],
+                    [m2] if l2 > 0 else [],
+                    trigger_channel
                 )
-                signal_spectrum_acquire_event.set()
 
                 # If execution time has exceeded, stop loops and application.
                 if execution_time > 0 and tm() > execution_time:
@@ -185,11 +275,16 @@ def simulator_worker(arguments, verbose):
                     settings["sub_loop"] = False
                     settings["main_loop"] = False
 
-            # Pause, sub loop or main loop can be triggers in the application.
-            # In those cases other new settings might be arriving too like
-            # a new playback file etc.
+            # Pause, resume, quit and spectrum limits come from the control block.
+            changes = apply_control_changes(control, settings)
+            if verbose and changes:
+                print(changes)
+
+            # Other new settings might be arriving too like a new playback file etc.
             if settings_acquire_event.is_set():
                 settings = settings_acquire_value["value"]
+                control.reset()
+                apply_control_changes(control, settings)
                 if verbose:
                     print(settings)
                 settings_acquire_event.clear()
@@ -203,23 +298,25 @@ def simulator_worker(arguments, verbose):
 
     return settings
 
-def _playback_worker(playback_buffers, arguments, settings, verbose):
+def _playback_worker(playback_reader, arguments, settings, verbose):
 
     # Gather events and values to lessen dictionary loop ups in the while loop.
     settings_acquire_event = arguments["settings_acquire_event"]
     settings_acquire_value = arguments["settings_acquire_value"]
 
-    signal_spectrum_acquire_event = arguments["signal_spectrum_acquire_event"]
-    signal_spectrum_acquire_value = arguments["signal_spectrum_acquire_value"]
+    signal_spectrum_ring = arguments["signal_spectrum_ring"]
+    control = arguments["control"]
+
+    # Raw channel filters track the baseline over the played back captures.
+    filters = create_raw_filters(arguments["raw_filter"])
+
+    # Playback files are recorded with the timebase of the configuration.
+    set_coincidence_window_samples(arguments, get_timebase_sample_interval(arguments["timebase_n"]))
 
     # Reset settings to update values in the processes.
     settings_acquire_value["value"] = settings
     settings_acquire_event.set()
 
-    # We will loop playback buffers meaning original data will be started again
-    # from the beginning in the playback mode.
-    work_buffers = playback_buffers[:]
-
     start_time = tm()
 
     execution_time = (start_time + arguments["execution_time"]) if arguments["execution_time"] > 0 else 0
@@ -229,17 +326,13 @@ def _playback_worker(playback_buffers, arguments, settings, verbose):
         # It is possible to pause data retrieval from the application menu.
         if not settings["pause"]:
 
-            if len(work_buffers) < 1:
-                print("reload playback buffers")
-                work_buffers = playback_buffers[:]
-
-            # Retrieve stored playback buffers in the same order than they were saved.
-            # TODO: By using rotating index, we could find out the line from the file and parse
-            # it for more robust and scalable version of using playback files...
-            buffers = work_buffers.pop(0)
+            # Captures are played in the same order than they were saved, and
+            # started again from the beginning after the last one.
+            if playback_reader.position == len(playback_reader) - 1 and verbose:
+                print("restart playback")
+            buffers = playback_reader.next()
 
-            process_buffers(buffers, settings, arguments, None,
-                signal_spectrum_acquire_value, signal_spectrum_acquire_event)
+            process_buffers(buffers, settings, arguments, None, signal_spectrum_ring, filters = filters)
 
             # If execution time has exceeded, stop loops and application.
             if execution_time > 0 and tm() > execution_time:
@@ -247,11 +340,16 @@ def _playback_worker(playback_buffers, arguments, settings, verbose):
                 settings["sub_loop"] = False
                 settings["main_loop"] = False
 
-        # Pause, sub loop or main loop can be triggers in the application.
-        # In those cases other new settings might be arriving too like
-        # a new playback file etc.
+        # Pause, resume, quit and spectrum limits come from the control block.
+        changes = apply_control_changes(control, settings)
+        if verbose and changes:
+            print(changes)
+
+        # Other new settings might be arriving too like a new playback file etc.
         if settings_acquire_event.is_set():
             settings = settings_acquire_value["value"]
+            control.reset()
+            apply_control_changes(control, settings)
             if verbose:
                 print(settings)
             settings_acquire_event.clear()
@@ -267,6 +365,8 @@ def playback_worker(arguments, playback_file, verbose, playback_fail = False):
     settings_acquire_event = arguments["settings_acquire_event"]
     settings_acquire_value = arguments["settings_acquire_value"]
 
+    control = arguments["control"]
+
     # Note, these are settings that MUST be given from the application!
     settings = settings_acquire_value["value"]
 
@@ -274,6 +374,9 @@ def playback_worker(arguments, playback_file, verbose, playback_fail = False):
 
         if playback_fail:
 
+            # Quit may come from the control block while waiting.
+            apply_control_changes(control, settings)
+
             # Wait for action from the application and try using playback file again.
             if settings_acquire_event.is_set():
                 settings = settings_acquire_value["value"]
@@ -295,24 +398,22 @@ def playback_worker(arguments, playback_file, verbose, playback_fail = False):
 
             try:
 
-                # Load playback buffer data to memory and run _worker helper.
-                # TODO: At the moment array.pop is ued to retrieve four channels
-                # data from the momery. More scalable versions requires retrieving
-                # data from file by increasing and restarted index.
-                # Thus playback feature is useful for testing and development purposes
-                # only since collecting real experiment data may take gigabytes of data,
-                # because three measurements will take time from minutes to hours.
-                playback_buffers = load_buffers(settings["playback_file"])
+                # Playback file is memory mapped and indexed, so only the played
+                # capture is read from the file, however long the recording is.
+                playback_reader = PlaybackReader(settings["playback_file"])
 
                 # _playback_worker has a while loop as long as sub_loop is True.
                 # Only when sub loop stops, settings are returned and main loop starts the phase.
-                settings = _playback_worker(playback_buffers, arguments, settings, verbose)
+                try:
+                    settings = _playback_worker(playback_reader, arguments, settings, verbose)
+                finally:
+                    playback_reader.close()
 
                 # If main_loop is true, we will continue and recall _playback_worker.
                 # If not, then we are about to quit the application.
 
             except Exception as e:
-                print("Could not open playback file: %" % settings["playback_file"])
+                print("Could not open playback file: %s (%s)" % (settings["playback_file"], e))
                 # Start waiting new playback file event.
                 playback_fail = True
 
@@ -321,19 +422,132 @@ def playback_worker(arguments, playback_file, verbose, playback_fail = False):
 
     return settings
 
+# Acquisition thread captures blocks from the PicoScope and hands the filled buffers
+# to the processing loop via a bounded queue. The next block is armed as soon as the
+# previous transfer is done, so the scope is not idle while the captures are processed.
+# Driver calls release the GIL, thus capturing and processing overlap. Buffers are views
+# to the buffer pool of the PicoScope module, so the pool must have at least two slots
+# more than the queue size: one is being filled and one is being processed.
+class AcquisitionThread(Thread):
+
+    def __init__(self, ps, picoscope_mode, trigger_settings, sleep_time = 0.01, queue_size = 1):
+        Thread.__init__(self, daemon = True)
+        self.ps = ps
+        self.picoscope_mode = picoscope_mode
+        self.trigger_settings = trigger_settings
+        self.sleep_time = sleep_time
+        self.queue = Queue(maxsize = queue_size)
+        self.running = True
+        self.paused = False
+        self.error = None
+        # Trigger settings changed by the application, applied between the captures.
+        self.pending_trigger = None
+        # Wall time spent waiting for the triggers and transferring data versus
+        # all other time, including waiting for the space in the queue.
+        self.armed_time = 0.
+        self.idle_time = 0.
+
+    def run(self):
+        ps = self.ps
+        trigger_settings = self.trigger_settings
+        try:
+            previous = perf_counter()
+            while self.running:
+
+                if self.paused:
+                    sleep(self.sleep_time)
+                    previous = perf_counter()
+                    continue
+
+                if self.pending_trigger is not None:
+                    was_enabled = trigger_settings["enabled"] == 1
+                    trigger_settings.update(self.pending_trigger)
+                    self.pending_trigger = None
+                    if was_enabled or trigger_settings["enabled"] == 1:
+                        ps.set_trigger(**trigger_settings)
+
+                armed = perf_counter()
+                ps.start_capture(sleep_time = self.sleep_time)
+                done = perf_counter()
+                self.idle_time += armed - previous
+                self.armed_time += done - armed
+
+                if self.picoscope_mode == "rapid":
+                    # All captures of the run come as one (segments, channels, samples) array.
+                    captures = ps.get_buffers()
+                else:
+                    captures = (list(ps.get_buffers()),)
+
+                # Trigger channel is stored with the captures, because the channel may
+                # alternate before the processing loop handles them. Stream chunks carry
+                # their absolute start sample.
+                capture_start = ps.get_chunk_start() if self.picoscope_mode == "stream" else 0
+                item = (captures, trigger_settings["channel"], capture_start)
+                while self.running:
+                    try:
+                        self.queue.put(item, timeout = 0.1)
+                        break
+                    except Full:
+                        pass
+
+                # If single channel trigger is set to alternate,
+                # swap the trigger channel between 0 and 1.
+                if trigger_settings["alternate_channel"] == True:
+                    trigger_settings["channel"] = 1 if trigger_settings["channel"] == 0 else 0
+                    # Revoke trigger only if it is enabled.
+                    if trigger_settings["enabled"] == 1:
+                        ps.set_trigger(**trigger_settings)
+                ps.init_capture()
+
+                previous = done
+
+        except Exception as e:
+            self.error = e
+
+    def stop(self):
+        self.running = False
+        # Capture may be waiting for a trigger without a timeout.
+        if hasattr(self.ps, "cancel_wait"):
+            self.ps.cancel_wait()
+        self.join()
+
+    def update_trigger(self, trigger):
+        self.pending_trigger = trigger
+
+    # Percentage of the wall time the scope has been armed or transferring data.
+    def get_armed_ratio(self):
+        total = self.armed_time + self.idle_time
+        return (100 * self.armed_time / total) if total > 0 else 0
+
+# Tail of the stream chunks must hold the whole event window and the earlier
+# coincidence partner of the events cut by the software trigger.
+def get_stream_overlap(overlap, software_trigger):
+    if software_trigger["enabled"] == 1:
+        overlap = max(
+            overlap,
+            software_trigger["pre_trigger_samples"] + software_trigger["post_trigger_samples"],
+            software_trigger["post_trigger_samples"] + software_trigger["coincidence_window"]
+        )
+    return overlap
+
 def picoscope_worker(arguments, ps, picoscope_mode, verbose):
 
     # Gather events and values to lessen dictionary loop ups in the while loop.
     settings_acquire_event = arguments["settings_acquire_event"]
     settings_acquire_value = arguments["settings_acquire_value"]
 
-    signal_spectrum_acquire_event = arguments["signal_spectrum_acquire_event"]
-    signal_spectrum_acquire_value = arguments["signal_spectrum_acquire_value"]
+    signal_spectrum_ring = arguments["signal_spectrum_ring"]
+    control = arguments["control"]
 
     settings = settings_acquire_value["value"]
 
     csv_waveform_file = os.path.join(arguments["experiments_dir"], arguments["experiment_dir"], "waveform.csv")
     csv_statistics_file = os.path.join(arguments["experiments_dir"], arguments["experiment_dir"], "statistics.csv")
+    event_file = os.path.join(arguments["experiments_dir"], arguments["experiment_dir"], "events.tpe")
+    waveform_file = os.path.join(arguments["experiments_dir"], arguments["experiment_dir"], "waveforms.tpw")
+    waveform_format = arguments.get("waveform_format", "binary")
+    waveform_mask = channel_mask(arguments["store_waveforms_channels"])
+    statistics_format = arguments.get("statistics_format", "binary")
 
     pulse_source = arguments["pulse_source"]
     chance_rate = arguments["chance_rate"]
@@ -341,14 +555,38 @@ def picoscope_worker(arguments, ps, picoscope_mode, verbose):
 
     while settings["main_loop"]:
 
+        # Statistics and waveforms are written until the scope is reinitialized.
+        event_writer = None
+        statistics_csv = None
+        waveform_archive = None
+        # Threads and processes, which are stopped on restart, quit and error.
+        acquisition = None
+        detection_pool = None
+
         try:
 
             settings["sub_loop"] = True
 
+            # Settings from the manager may be older than the latest control block changes.
+            control.reset()
+            control_changes = apply_control_changes(control, settings)
+
             # TODO: Own voltage for each channel!
             ps.set_channels(voltage_range = settings["picoscope"]["voltage_range"])
 
-            block_mode_trigger_settings = settings["picoscope"]["block_mode_trigger_settings"]
+            if picoscope_mode == "stream":
+                # Streaming has no hardware trigger.
+                block_mode_trigger_settings = {"enabled": 0, "channel": 0, "alternate_channel": False}
+            else:
+                block_mode_trigger_settings = settings["picoscope"]["block_mode_trigger_settings"]
+                block_mode_trigger_settings.update(control_changes.get("trigger", {}))
+
+            # Samples carried over from the previous stream chunk.
+            overlap = 0
+
+            # Software trigger cuts events from the streamed chunks.
+            software_trigger = settings["picoscope"].get("software_trigger", {"enabled": 0}) if picoscope_mode == "stream" else {"enabled": 0}
+            events = None
 
             init = True
 
@@ -366,30 +604,67 @@ def picoscope_worker(arguments, ps, picoscope_mode, verbose):
 
             coincidence_count = 0
 
+            acquisition_queue_size = settings["picoscope"].get("acquisition_queue_size", 1)
+
             if picoscope_mode == "stream":
                 init = ps.set_buffers(buffer_size = settings["picoscope"]["buffer_size"],
                                       buffer_count = settings["picoscope"]["buffer_count"],
                                       interval = settings["picoscope"]["interval"],
-                                      units = settings["picoscope"]["units"])
-            elif picoscope_mode == "block":
+                                      units = settings["picoscope"]["units"],
+                                      overlap_samples = get_stream_overlap(settings["picoscope"].get("overlap", 128), software_trigger),
+                                      ring_chunks = settings["picoscope"].get("ring_chunks", 16),
+                                      pool_size = acquisition_queue_size + 2,
+                                      sleep_time = settings["picoscope"]["sleep_time"])
+                overlap = ps.get_overlap()
 
-                init = ps.set_buffers(
-                        block_mode_trigger_settings,
-                        settings["picoscope"]["block_mode_timebase_settings"],
-                        settings["picoscope"]["advanced_trigger_settings"]
-                )
-                timebase_n = settings["picoscope"]["block_mode_timebase_settings"]["timebase_n"]
+                # Chunks follow each other without gaps, so the buffer length is the live time of one chunk.
+                buffer_length_ns = ps.get_chunk_length()
+
+                set_coincidence_window_samples(arguments, ps.get_sample_interval())
+
+                timebase_conversion = 1 / buffer_length_ns
 
-                if timebase_n == 2:
-                    buffer_length_ns = arguments["time_window"] * 2 / 500000000
+                print("\n")
+                console_line = "Source: %s Sample interval: %ss Chunk: %s samples Overlap: %s samples Chunk length: %ss"
+                print(console_line % (pulse_source, ps.get_sample_interval(), settings["picoscope"]["buffer_size"] * settings["picoscope"]["buffer_count"], overlap, buffer_length_ns))
+                print("\n")
+            elif picoscope_mode == "block" or picoscope_mode == "rapid":
+
+                # Buffer pool must hold the queued captures, the one being processed
+                # and the one being filled by the acquisition thread.
+                buffer_pool_size = acquisition_queue_size + 2
+
+                if picoscope_mode == "rapid":
+                    init = ps.set_buffers(
+                            block_mode_trigger_settings,
+                            settings["picoscope"]["block_mode_timebase_settings"],
+                            settings["picoscope"]["advanced_trigger_settings"],
+                            settings["picoscope"]["rapid_mode_segments"],
+                            buffer_pool_size
+                    )
                 else:
-                    buffer_length_ns = arguments["time_window"] * (timebase_n - 2) / 125000000
+                    init = ps.set_buffers(
+                            block_mode_trigger_settings,
+                            settings["picoscope"]["block_mode_timebase_settings"],
+                            settings["picoscope"]["advanced_trigger_settings"],
+                            buffer_pool_size
+                    )
+                # Wait for triggers by a driver callback or a back-off poller instead of spinning.
+                ps.set_wait_mode(settings["picoscope"].get("capture_wait_mode", "callback"))
+
+                timebase_n = settings["picoscope"]["block_mode_timebase_settings"]["timebase_n"]
+
+                buffer_length_ns = arguments["time_window"] * get_timebase_sample_interval(timebase_n)
+
+                set_coincidence_window_samples(arguments, get_timebase_sample_interval(timebase_n))
 
                 timebase_conversion = 1 / buffer_length_ns
 
                 print("\n")
                 console_line = "Source: %s Timebase: %s Time window: %sns Buffer length: %ss Time conversion: 1/%d"
                 print(console_line % (pulse_source, timebase_n, arguments["time_window"], buffer_length_ns, timebase_conversion))
+                if picoscope_mode == "rapid":
+                    print("Rapid mode segments: %s" % settings["picoscope"]["rapid_mode_segments"])
                 print("\n")
             else:
                 print("Picoscope mode not supported. Halting the main loop.")
@@ -403,54 +678,226 @@ def picoscope_worker(arguments, ps, picoscope_mode, verbose):
 
             td, ph1, ph2 = (0, 0, 0)
 
+            configuration = configuration_hash({
+                "picoscope": settings["picoscope"],
+                "spectrum_low_limits": settings["spectrum_low_limits"],
+                "spectrum_high_limits": settings["spectrum_high_limits"],
+                "pulse_detection_mode": arguments["pulse_detection_mode"],
+                "coincidence_window": arguments["coincidence_window"],
+                "coincidence_window_unit": arguments.get("coincidence_window_unit", "samples"),
+                "pulse_timing": arguments["pulse_timing"],
+                "raw_filter": arguments["raw_filter"]
+            })
+
+            if arguments["store_statistics"] > 0:
+                # Event file is the canonical record of the captures. It is appended over the
+                # restarts with the same configuration, others go to a new segment file.
+                if statistics_format != "csv":
+                    event_writer = EventWriter(event_file, configuration, buffer_length_ns, start_time)
+                # Old csv format is kept open for the session instead of opening it for every row.
+                if statistics_format != "binary":
+                    statistics_csv = open(csv_statistics_file, "a")
+
+            # Waveforms are compressed and written by a thread of their own.
+            if arguments["store_waveforms"] > 0 and waveform_format == "binary":
+                waveform_archive = WaveformArchiveThread(
+                    WaveformWriter(waveform_file, arguments.get("waveform_compression", "zlib"), configuration, buffer_length_ns, start_time)
+                )
+                waveform_archive.start()
+
+            # Capture numbers of the files continue from the earlier sessions.
+            capture_offset = max(
+                event_writer.last_capture if event_writer is not None else 0,
+                waveform_archive.writer.last_capture if waveform_archive is not None else 0
+            )
+
+            # Pulse detection can be fanned out to a pool of processes. Results are
+            # handled in the capture order. Software trigger does its own detection.
+            # Coincidence window in samples is known, when the timebase has been set.
+            detection_processes = settings["picoscope"].get("detection_processes", 0)
+            if detection_processes > 0 and software_trigger["enabled"] == 0:
+                detection_pool = DetectionPool(
+                    detection_processes,
+                    arguments["pulse_detection_mode"],
+                    get_coincidence_window(arguments),
+                    arguments["coincidence_pairing"] == "nearest",
+                    height_window = get_height_window(arguments),
+                    timing = arguments["pulse_timing"],
+                    cfd_fraction = arguments["cfd_fraction"],
+                    raw_filter = arguments["raw_filter"]
+                )
+                detection_pool.start()
+
+            # Raw channel filters keep their baselines and buffers over the captures.
+            filters = create_raw_filters(arguments["raw_filter"]) if detection_pool is None else None
+
+            # Capturing runs in its own thread and this loop processes the captures.
+            acquisition = AcquisitionThread(
+                ps,
+                picoscope_mode,
+                block_mode_trigger_settings,
+                settings["picoscope"]["sleep_time"],
+                acquisition_queue_size
+            )
+            if settings["sub_loop"]:
+                acquisition.start()
+
             while settings["sub_loop"]:
 
-                # It is possible to pause data retrieval from the application menu.
-                if not settings["pause"]:
+                # Pause, resume, quit, spectrum limits and trigger come from the control block
+                # without leaving the loop. Trigger is not used in the streaming mode.
+                control_changes = apply_control_changes(control, settings)
+                if control_changes:
+                    if "trigger" in control_changes and picoscope_mode != "stream":
+                        acquisition.update_trigger(control_changes["trigger"])
+                    if verbose:
+                        print(control_changes, "latency: %.2fms" % (control.get_latency() * 1000))
 
-                    ps.start_capture(sleep_time = settings["picoscope"]["sleep_time"])
+                acquisition.paused = settings["pause"]
 
-                    buffers = list(ps.get_buffers())
+                if acquisition.error is not None:
+                    raise acquisition.error
 
-                    trigger_channel = None if block_mode_trigger_settings["enabled"] == 0 else block_mode_trigger_settings["channel"]
-                    sca_a_pulse_count, sca_b_pulse_count, time_differences, pulse_heights = \
-                        process_buffers(
-                            buffers,
-                            settings,
-                            arguments,
-                            trigger_channel,
-                            signal_spectrum_acquire_value,
-                            signal_spectrum_acquire_event
-                        )
+                # Captures stay in the queue while paused and are processed on resume.
+                captures, capture_channel, capture_start = None, None, 0
+                if not settings["pause"]:
+                    try:
+                        captures, capture_channel, capture_start = acquisition.queue.get(timeout = 0.1)
+                    except Empty:
+                        pass
 
-                    # Get recording flag from application (initialized from argument parser).
-                    if (arguments["store_waveforms"] == 1 and sca_a_pulse_count > 0 and sca_b_pulse_count > 0) or \
-                        arguments["store_waveforms"] == 2:
-                        store = []
-                        if "A" in arguments["store_waveforms_channels"]:
-                            store.append(buffers[0])
-                        if "B" in arguments["store_waveforms_channels"]:
-                            store.append(buffers[1])
-                        if "C" in arguments["store_waveforms_channels"]:
-                            store.append(buffers[2])
-                        if "D" in arguments["store_waveforms_channels"]:
-                            store.append(buffers[3])
-                        write_buffers(store, csv_waveform_file)
-
-                    coincidence_count += (sca_a_pulse_count * sca_b_pulse_count)
-
-                    # Take rate count from the other channel than the triggered.
-                    # Trigger channel will always contain at least one pulse but in reality pulses are
-                    # randomly distributed in time. Thus, taking a number of pulses at random places
-                    # over time should give us best idea of the average pulse rate.
-                    # This will require some good length of the buffer because too small buffer
-                    # would reduce the average hit of the pulses if pulse rate is very low...
-
-                    if False:
-                        if start_channel == block_mode_trigger_settings["channel"]:
+                # It is possible to pause data retrieval from the application menu.
+                if not settings["pause"] and (captures is not None or (detection_pool is not None and detection_pool.pending() > 0)):
+
+                    if detection_pool is not None:
+                        # Results of the earlier captures come while the latest ones are detected.
+                        processed = detection_pool.map(
+                            captures if captures is not None else (),
+                            settings["spectrum_low_limits"],
+                            settings["spectrum_high_limits"],
+                            overlap,
+                            capture_channel
+                        )
+                    else:
+                        if picoscope_mode == "rapid" and arguments["pulse_detection_mode"] == 0 and software_trigger["enabled"] == 0 and filters is None:
+                            # All captures of the run are detected in one vectorized pass.
+                            detections = split_batch_results(
+                                get_max_heights_and_time_differences_batch(
+                                    captures,
+                                    get_coincidence_window(arguments),
+                                    arguments["coincidence_pairing"] == "nearest",
+                                    height_window = get_height_window(arguments),
+                                    timing = arguments["pulse_timing"],
+                                    cfd_fraction = arguments["cfd_fraction"]
+                                )
+                            )
+                        else:
+                            detections = repeat(None)
+                        processed = ((buffers, capture_channel, detection) for buffers, detection in zip(captures, detections))
+
+                    handled = False
+
+                    for buffers, capture_channel, detection in processed:
+
+                        handled = True
+
+                        trigger_channel = None if block_mode_trigger_settings["enabled"] == 0 else capture_channel
+
+                        if software_trigger["enabled"] == 1:
+                            sca_a_pulse_count, sca_b_pulse_count, time_differences, pulse_heights, events = \
+                                process_events(
+                                    buffers,
+                                    settings,
+                                    arguments,
+                                    overlap,
+                                    capture_start,
+                                    software_trigger,
+                                    signal_spectrum_ring
+                                )
+                            a = events["channel"] == 0
+                            b = events["channel"] == 1
+                            pulses = (events["height"][a], events["height"][b], events["sample"][a], events["sample"][b])
+                        else:
+                            sca_a_pulse_count, sca_b_pulse_count, time_differences, pulse_heights, pulses = \
+                                process_buffers(
+                                    buffers,
+                                    settings,
+                                    arguments,
+                                    trigger_channel,
+                                    signal_spectrum_ring,
+                                    overlap,
+                                    detection,
+                                    filters
+                                )
+
+                        if events is not None:
+                            # Store the raw channel windows of the triggered events only.
+                            if arguments["store_waveforms"] > 0:
+                                for event in events:
+                                    if arguments["store_waveforms"] == 2 or event["partners"] > 0:
+                                        if waveform_archive is not None:
+                                            # Event windows are from the raw channels C and D.
+                                            waveform_archive.put(capture_offset + rate_count + 1, tm(), event["channel"], [None, None, *event["waveform"]], waveform_mask & 0b1100)
+                                            continue
+                                        store = []
+                                        if "C" in arguments["store_waveforms_channels"]:
+                                            store.append(event["waveform"][0])
+                                        if "D" in arguments["store_waveforms_channels"]:
+                                            store.append(event["waveform"][1])
+                                        write_buffers(store, csv_waveform_file)
+
+                        # Get recording flag from application (initialized from argument parser).
+                        elif (arguments["store_waveforms"] == 1 and sca_a_pulse_count > 0 and sca_b_pulse_count > 0) or \
+                            arguments["store_waveforms"] == 2:
+                            if waveform_archive is not None:
+                                # Capture is counted below.
+                                waveform_archive.put(capture_offset + rate_count + 1, tm(), trigger_channel, buffers, waveform_mask)
+                            else:
+                                store = []
+                                if "A" in arguments["store_waveforms_channels"]:
+                                    store.append(buffers[0])
+                                if "B" in arguments["store_waveforms_channels"]:
+                                    store.append(buffers[1])
+                                if "C" in arguments["store_waveforms_channels"]:
+                                    store.append(buffers[2])
+                                if "D" in arguments["store_waveforms_channels"]:
+                                    store.append(buffers[3])
+                                write_buffers(store, csv_waveform_file)
+
+                        # Only the pulse pairs inside the coincidence window are counted.
+                        coincidence_count += len(time_differences)
+
+                        # Take rate count from the other channel than the triggered.
+                        # Trigger channel will always contain at least one pulse but in reality pulses are
+                        # randomly distributed in time. Thus, taking a number of pulses at random places
+                        # over time should give us best idea of the average pulse rate.
+                        # This will require some good length of the buffer because too small buffer
+                        # would reduce the average hit of the pulses if pulse rate is very low...
+
+                        if False:
+                            if start_channel == capture_channel:
+                                rate_count += 1
+
+                            if capture_channel == 1:
+                                rate_a += sca_a_pulse_count
+                                if counts_max_a < sca_a_pulse_count:
+                                    counts_max_a = sca_a_pulse_count
+                                if counts_min_a > sca_a_pulse_count:
+                                    counts_min_a = sca_a_pulse_count
+                                rate_a_avg = timebase_conversion * rate_a / rate_count
+
+                                rate_ab = rate_a + rate_b
+                                rate_ab_avg = timebase_conversion * rate_ab / (rate_count * 2)
+                            else:
+                                rate_b += sca_b_pulse_count
+                                if counts_max_b < sca_b_pulse_count:
+                                    counts_max_b = sca_b_pulse_count
+                                if counts_min_b > sca_b_pulse_count:
+                                    counts_min_b = sca_b_pulse_count
+                                rate_b_avg = timebase_conversion * rate_b / rate_count
+                        else:
                             rate_count += 1
 
-                        if block_mode_trigger_settings["channel"] == 1:
                             rate_a += sca_a_pulse_count
                             if counts_max_a < sca_a_pulse_count:
                                 counts_max_a = sca_a_pulse_count
@@ -458,113 +905,117 @@ def picoscope_worker(arguments, ps, picoscope_mode, verbose):
                                 counts_min_a = sca_a_pulse_count
                             rate_a_avg = timebase_conversion * rate_a / rate_count
 
-                            rate_ab = rate_a + rate_b
-                            rate_ab_avg = timebase_conversion * rate_ab / (rate_count * 2)
-                        else:
                             rate_b += sca_b_pulse_count
                             if counts_max_b < sca_b_pulse_count:
                                 counts_max_b = sca_b_pulse_count
                             if counts_min_b > sca_b_pulse_count:
                                 counts_min_b = sca_b_pulse_count
                             rate_b_avg = timebase_conversion * rate_b / rate_count
-                    else:
-                        rate_count += 1
-
-                        rate_a += sca_a_pulse_count
-                        if counts_max_a < sca_a_pulse_count:
-                            counts_max_a = sca_a_pulse_count
-                        if counts_min_a > sca_a_pulse_count:
-                            counts_min_a = sca_a_pulse_count
-                        rate_a_avg = timebase_conversion * rate_a / rate_count
-
-                        rate_b += sca_b_pulse_count
-                        if counts_max_b < sca_b_pulse_count:
-                            counts_max_b = sca_b_pulse_count
-                        if counts_min_b > sca_b_pulse_count:
-                            counts_min_b = sca_b_pulse_count
-                        rate_b_avg = timebase_conversion * rate_b / rate_count
-
-                        rate_ab = rate_a + rate_b
-                        rate_ab_avg = timebase_conversion * rate_ab / (rate_count * 2)
-
-                    # Calculate, how many pulses there are in a second in average?
-                    # Time window is in nanoseconds, so this needs to be converted to seconds by multiplying with 1000000000.
-                    # Problem of getting real rate is difficult. We count number of pulses per every sweep with a trigger.
-                    # So there will be at least opne pulse per every sweep. But we are not getting data for every time point
-                    # so we miss a lot of data. One way of trying to get around this is to have a long time window and count all
-                    # pulses in there. But it can still have same problem because for high precision buffer we have a limit of 20000ns
-                    # for every bugger and if the rate of the interesting signals is much slower than once in a 20 micro seconds
-                    # the calculation will be biassed. But for high rate constant signals, that should be ok.
-                    # Question for Tandem Experiment is, if there are gamma peaks coming once in every 20 microseconds so that
-                    # the rate calculated here is correct?
-                    console_line = "Samples: %s/%ss Elapsed: %ss | A: %s/s (cnt/min/max: %s/%s/%s) | B: %s/s (cnt/min/max: %s/%s/%s) | CHC rate: %s (500ns) | CNC rate elps/smpl: %s/%s (cnt: %s) | %s-%s-%s \033[A"
-
-                    time_now = tm()
-
-                    elapsed_time = time_now - start_time
-
-                    td = td if len(time_differences) < 1 else time_differences[0]
-                    ph1 = ph1 if len(pulse_heights) < 1 else pulse_heights[0][0]
-                    ph2 = ph2 if len(pulse_heights) < 1 else pulse_heights[0][1]
-
-                    data = (
-                        rate_count,
-                        round(buffer_length_ns * rate_count, 1),
-                        round(elapsed_time, 1),
-                        round(rate_a_avg, 1),
-                        rate_a,
-                        counts_min_a,
-                        counts_max_a,
-                        round(rate_b_avg, 1),
-                        rate_b,
-                        counts_min_b,
-                        counts_max_b,
-                        round(rate_a_avg * rate_b_avg * 5*10**-7, 3),
-                        round(coincidence_count / elapsed_time, 3),
-                        round(coincidence_count / (buffer_length_ns * rate_count), 3),
-                        coincidence_count,
-                        td,
-                        round(ph1, 1),
-                        round(ph2, 1)
-                    )
 
-                    print(console_line % data)
-
-                    if arguments["store_statistics"] > 0:
-                        if (arguments["store_statistics"] == 1 and sca_a_pulse_count > 0 and sca_b_pulse_count > 0) or \
-                           (arguments["store_statistics"] == 2 and (sca_a_pulse_count > 0 or sca_b_pulse_count > 0)) or \
-                            arguments["store_statistics"] == 3:
-                            data = (
-                                rate_count,
-                                time_now,
-                                elapsed_time,
-                                sca_a_pulse_count,
-                                sca_b_pulse_count,
-                                rate_a,
-                                rate_b,
-                                rate_a_avg,
-                                rate_b_avg,
-                                sca_a_pulse_count * sca_b_pulse_count,
-                                coincidence_count,
-                                coincidence_count / elapsed_time,
-                                coincidence_count / (buffer_length_ns * rate_count),
-                                "" if len(time_differences) < 1 else time_differences[0],
-                                "" if len(pulse_heights) < 1 else pulse_heights[0][0],
-                                "" if len(pulse_heights) < 1 else pulse_heights[0][1],
-                                buffer_length_ns * rate_count,
-                                block_mode_trigger_settings["channel"]
+                            rate_ab = rate_a + rate_b
+                            rate_ab_avg = timebase_conversion * rate_ab / (rate_count * 2)
+
+                        # Calculate, how many pulses there are in a second in average?
+                        # Time window is in nanoseconds, so this needs to be converted to seconds by multiplying with 1000000000.
+                        # Problem of getting real rate is difficult. We count number of pulses per every sweep with a trigger.
+                        # So there will be at least opne pulse per every sweep. But we are not getting data for every time point
+                        # so we miss a lot of data. One way of trying to get around this is to have a long time window and count all
+                        # pulses in there. But it can still have same problem because for high precision buffer we have a limit of 20000ns
+                        # for every bugger and if the rate of the interesting signals is much slower than once in a 20 micro seconds
+                        # the calculation will be biassed. But for high rate constant signals, that should be ok.
+                        # Question for Tandem Experiment is, if there are gamma peaks coming once in every 20 microseconds so that
+                        # the rate calculated here is correct?
+                        console_line = "Samples: %s/%ss Elapsed: %ss | A: %s/s (cnt/min/max: %s/%s/%s) | B: %s/s (cnt/min/max: %s/%s/%s) | CHC rate: %s (500ns) | CNC rate elps/smpl: %s/%s (cnt: %s) | %s-%s-%s \033[A"
+
+                        time_now = tm()
+
+                        elapsed_time = time_now - start_time
+
+                        td = td if len(time_differences) < 1 else time_differences[0]
+                        ph1 = ph1 if len(pulse_heights) < 1 else pulse_heights[0][0]
+                        ph2 = ph2 if len(pulse_heights) < 1 else pulse_heights[0][1]
+
+                        console_data = (
+                            rate_count,
+                            round(buffer_length_ns * rate_count, 1),
+                            round(elapsed_time, 1),
+                            round(rate_a_avg, 1),
+                            rate_a,
+                            counts_min_a,
+                            counts_max_a,
+                            round(rate_b_avg, 1),
+                            rate_b,
+                            counts_min_b,
+                            counts_max_b,
+                            round(rate_a_avg * rate_b_avg * 5*10**-7, 3),
+                            round(coincidence_count / elapsed_time, 3),
+                            round(coincidence_count / (buffer_length_ns * rate_count), 3),
+                            coincidence_count,
+                            td,
+                            round(ph1, 1),
+                            round(ph2, 1)
+                        )
+
+                        if arguments["store_statistics"] > 0:
+                            if (arguments["store_statistics"] == 1 and sca_a_pulse_count > 0 and sca_b_pulse_count > 0) or \
+                               (arguments["store_statistics"] == 2 and (sca_a_pulse_count > 0 or sca_b_pulse_count > 0)) or \
+                                arguments["store_statistics"] == 3:
+                                data = (
+                                    rate_count,
+                                    time_now,
+                                    elapsed_time,
+                                    sca_a_pulse_count,
+                                    sca_b_pulse_count,
+                                    rate_a,
+                                    rate_b,
+                                    rate_a_avg,
+                                    rate_b_avg,
+                                    len(time_differences),
+                                    coincidence_count,
+                                    coincidence_count / elapsed_time,
+                                    coincidence_count / (buffer_length_ns * rate_count),
+                                    "" if len(time_differences) < 1 else time_differences[0],
+                                    "" if len(pulse_heights) < 1 else pulse_heights[0][0],
+                                    "" if len(pulse_heights) < 1 else pulse_heights[0][1],
+                                    buffer_length_ns * rate_count,
+                                    capture_channel
+                                )
+                                if event_writer is not None:
+                                    event_writer.append(
+                                        capture_offset + rate_count,
+                                        time_now,
+                                        capture_channel,
+                                        sca_a_pulse_count,
+                                        sca_b_pulse_count,
+                                        time_differences,
+                                        *pulses
+                                    )
+                                if statistics_csv is not None:
+                                    print(*data, sep = ";", file = statistics_csv)
+
+                    if handled:
+                        console_output = console_line % console_data
+                        # Wake-up latency from the block ready state to the worker.
+                        if picoscope_mode == "stream":
+                            # Share of the streamed samples that reached the processing.
+                            stream = ps.get_stream_stats()
+                            console_output = "Live: %.1f%% (overruns: %s) | %s" % (100 * stream["live_time"], stream["overruns"], console_output)
+                        else:
+                            latency = ps.get_wakeup_latency_stats()
+                            console_output = "Wake-up p50/p99: %.2f/%.2fms | %s" % (latency["p50"], latency["p99"], console_output)
+                        if picoscope_mode == "rapid":
+                            # Captures per second of the latest run shows how much dead time is left between the triggers.
+                            console_output = "Captures: %d/s | %s" % (ps.get_capture_rate(), console_output)
+                        # Share of the wall time the scope has been armed instead of waiting for the processing.
+                        console_output = "Armed: %.1f%% | %s" % (acquisition.get_armed_ratio(), console_output)
+                        # Waveforms the archive thread could not keep up with or could not write.
+                        if waveform_archive is not None and (waveform_archive.dropped > 0 or waveform_archive.error is not None):
+                            console_output = "Waveforms dropped: %s%s | %s" % (
+                                waveform_archive.dropped,
+                                "" if waveform_archive.error is None else " (archive error: %s)" % waveform_archive.error,
+                                console_output
                             )
-                            f = open(csv_statistics_file, "a")
-                            print(*data, sep = ";", file = f)
-                            f.close()
-                    # If single channel trigger is set to alternate,
-                    # swap the trigger channel between 0 and 1.
-                    if block_mode_trigger_settings["alternate_channel"] == True:
-                        block_mode_trigger_settings["channel"] = 1 if block_mode_trigger_settings["channel"] == 0 else 0
-                        # Revoke trigger only if it is enabled.
-                        if block_mode_trigger_settings["enabled"] == 1:
-                            ps.set_trigger(**block_mode_trigger_settings)
-                    ps.init_capture()
+                        print(console_output)
 
                     # If execution time has exceeded, stop loops and application.
                     if execution_time > 0 and tm() > execution_time:
@@ -573,9 +1024,8 @@ def picoscope_worker(arguments, ps, picoscope_mode, verbose):
                         settings["sub_loop"] = False
                         settings["main_loop"] = False
 
-                # Pause, sub loop or main loop can be triggers in the application.
-                # In those cases other new settings might be arriving too like
-                # a new playback file etc.
+                # Other settings changes from the application require the scope
+                # to be reinitialized.
                 if settings_acquire_event.is_set():
                     settings = settings_acquire_value["value"]
                     # Temporarily get out from the loop.
@@ -591,6 +1041,23 @@ def picoscope_worker(arguments, ps, picoscope_mode, verbose):
             print(e)
             settings["main_loop"] = False
 
+        finally:
+            # Device must not be used by the acquisition thread while it is reinitialized.
+            if acquisition is not None and acquisition.is_alive():
+                acquisition.stop()
+            # Captures still in the detection pool are dropped on restart.
+            if detection_pool is not None:
+                detection_pool.stop()
+            # Blocks of the event file and the queued waveforms still in memory are written on restart and quit.
+            if event_writer is not None:
+                event_writer.close()
+            if statistics_csv is not None:
+                statistics_csv.close()
+            if waveform_archive is not None:
+                waveform_archive.stop()
+                if waveform_archive.dropped > 0 or waveform_archive.error is not None:
+                    print("Waveform archive dropped %s waveforms. %s" % (waveform_archive.dropped, waveform_archive.error or ""))
+
     print("\r\n")
 
 # Picoscope worker for pulse rate meter, channel line graph,
@@ -602,6 +1069,9 @@ def multi_worker(picoscope_mode, arguments, playback_file = "", verbose = False)
 
     has_picoscope = False
 
+    # Compiled pulse detection kernels, if available.
+    print("Pulse detection backend: %s" % kernels.set_backend(arguments["detection_backend"]))
+
     if picoscope_mode != None:
 
         import ctypes
@@ -628,9 +1098,6 @@ def multi_worker(picoscope_mode, arguments, playback_file = "", verbose = False)
         elif picoscope_mode == "block":
             from . import PS2000aBlockMode as ps
         elif picoscope_mode == "rapid":
-            # TODO
-            print("Rapid mode not implemented yet!")
-            sys.exit(0)
             from . import PS2000aRapidMode as ps
 
         print("Opening Picoscope...")